@@ -4,17 +4,25 @@ os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 # --- Imports ---
-import shutil
-from datetime import datetime
-
+import csv
+import hmac
+import io
+import json
+import math
+import multiprocessing
+import time
+import uuid
+from collections import Counter
+from datetime import date, datetime, timedelta
+from functools import wraps
+
+import click
 import pandas as pd
 import requests
-import plotly.express as px
-import plotly.io as pio
 
 from flask import (
-    Flask, flash, redirect, render_template, request,
-    send_file, url_for
+    Flask, Response, flash, g, has_request_context, jsonify, redirect, render_template, request,
+    send_file, stream_with_context, url_for
 )
 from flask_login import (
     LoginManager, UserMixin, current_user,
@@ -23,12 +31,24 @@ from flask_login import (
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
 from flask_wtf.recaptcha import RecaptchaField
+from sqlalchemy import delete, false as sa_false, func, insert, inspect as sa_inspect, select, text, tuple_
 from werkzeug.security import check_password_hash, generate_password_hash
 from wtforms import PasswordField, StringField, SubmitField
 from wtforms.validators import EqualTo, InputRequired, Length, ValidationError
 
-from forecast import analyze_product_categories, create_seasonal_forecast
-from pso_lstm import run_lstm_pso_forecast
+from audit import create_writer
+from backup import latest_manifest, list_manifests, restore_backup, stream_backup
+from profiling import (
+    METRICS_TOKEN, PROFILE_REQUESTS, Profile, prometheus_text, recorder, span, summary as span_summary,
+)
+from ingest import INDEX_MAX_N, cached_summary, category_breakdown, load_cube, top_n
+from jobs import (
+    ACTIVE_STATUSES, APPEND_FOLDER, MODEL_CONFIG, JobQueue, cached_forecast, registry, run_append_pipeline,
+    run_forecast_pipeline,
+)
+from registry import model_key
+from serving import FORECAST_MAX_HORIZON, MODELS, ForecastBatcher
+from upload_store import UPLOAD_FOLDER, UploadStore
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -66,9 +86,13 @@ login_manager.init_app(app)
 login_manager.login_view = "login"
 
 # --- File Paths ---
-UPLOAD_FOLDER = "uploads"
 PLOT_FOLDER = "static/plots"
 BACKUP_FOLDER = "backups"
+LOG_PAGE_SIZE = int(os.environ.get("LOG_PAGE_SIZE", "100"))
+LOG_EXPORT_CHUNK = 1000
+LOG_RETENTION_DAYS = int(os.environ.get("LOG_RETENTION_DAYS", "90"))
+# PostgreSQL advisory lock key that serializes log rollups across web workers and cron.
+LOG_ROLLUP_LOCK = 0x6C6F6773
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PLOT_FOLDER, exist_ok=True)
 os.makedirs(BACKUP_FOLDER, exist_ok=True)
@@ -80,6 +104,8 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
+    # Granted with `flask grant-admin USERNAME`; guards the destructive maintenance routes.
+    is_admin = db.Column(db.Boolean, nullable=False, default=False, server_default=sa_false())
 
     def __repr__(self):
         return f"User('{self.username}')"
@@ -87,15 +113,54 @@ class User(UserMixin, db.Model):
 
 class Log(db.Model):
     """Log model for application actions."""
+    # (timestamp, id) is the order the log viewer pages through, newest first.
+    __table_args__ = (db.Index("ix_log_timestamp_id", "timestamp", "id"),)
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    action = db.Column(db.String(100), nullable=False)
+    action = db.Column(db.String(100), nullable=False, index=True)
     details = db.Column(db.String(200))
+    username = db.Column(db.String(20), index=True)
 
     def __repr__(self):
         return f"Log('{self.timestamp}', '{self.action}', '{self.details}')"
 
 
+class LogDailyCount(db.Model):
+    """Per-day, per-action count of log entries older than the retention window."""
+    day = db.Column(db.Date, primary_key=True)
+    action = db.Column(db.String(100), primary_key=True)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Job(db.Model):
+    """Background forecast job with its final state and per-stage timings."""
+    id = db.Column(db.String(32), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    status = db.Column(db.String(20), nullable=False, default="queued")
+    username = db.Column(db.String(20))
+    filename = db.Column(db.String(200))
+    stage_timings = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "filename": self.filename,
+            "username": self.username,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "stages": json.loads(self.stage_timings) if self.stage_timings else {},
+            "result": json.loads(self.result) if self.result else None,
+            "error": self.error,
+        }
+
+    def __repr__(self):
+        return f"Job('{self.id}', '{self.status}')"
+
+
 # --- WTForms ---
 class RegisterForm(FlaskForm):
     """Form for user registration."""
@@ -139,15 +204,174 @@ def load_user(user_id):
     return User.query.get(int(user_id))
 
 
-def log_to_database(action, details=""):
-    """Logs an action to the database."""
-    new_log = Log(action=action, details=details)
-    db.session.add(new_log)
+def admin_required(view):
+    """Restricts a login_required view to administrators."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_admin:
+            log_to_database("Access Denied", f"User {current_user.username} tried {request.endpoint}.")
+            flash("Only administrators can do that.", "danger")
+            return redirect(url_for("upload_page"))
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def insert_logs(rows):
+    """Bulk-inserts a batch of audit rows in one transaction; runs on the audit writer thread."""
+    with app.app_context():
+        try:
+            with span("db.log_commit"):
+                db.session.execute(insert(Log), rows)
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+audit_log = create_writer(insert_logs)
+
+
+def log_to_database(action, details="", username=None):
+    """Queues an action for the audit log; rows are written in batches by a background thread."""
+    if username is None and has_request_context() and current_user.is_authenticated:
+        username = current_user.username
+    audit_log.log(action, details, username)
+
+
+def upgrade_log_schema():
+    """Adds the log and user columns and the indexes introduced after the tables were first created,
+    which create_all skips for existing tables."""
+    user_columns = {column["name"] for column in sa_inspect(db.engine).get_columns(User.__tablename__)}
+    if "is_admin" not in user_columns:
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {User.__tablename__} ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT FALSE"))
+    columns = {column["name"] for column in sa_inspect(db.engine).get_columns(Log.__tablename__)}
+    if "username" not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {Log.__tablename__} ADD COLUMN username VARCHAR(20)"))
+    for index in Log.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def init_database():
+    """Creates missing tables and upgrades existing ones. Runs when the module is imported, since
+    gunicorn imports app:app and never runs the __main__ block."""
+    with app.app_context():
+        try:
+            db.create_all()
+            upgrade_log_schema()
+        except Exception as e:
+            print(f"[ERROR] Could not create tables: {e}")
+
+
+# Skipped in spawned children, which re-import this module when it is run as a script.
+if multiprocessing.parent_process() is None:
+    init_database()
+
+
+def rollup_logs(retention_days=LOG_RETENTION_DAYS):
+    """Folds log entries older than retention_days into LogDailyCount and deletes them."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
     try:
+        if db.engine.dialect.name == "postgresql":
+            # Concurrent rollups would otherwise read and bump the same LogDailyCount rows.
+            db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOG_ROLLUP_LOCK})
+        # Counts the rows this delete actually removed, so a row deleted by a concurrent rollup is never
+        # counted twice and one written after the cutoff is never dropped uncounted.
+        deleted = db.session.execute(
+            delete(Log).where(Log.timestamp < cutoff).returning(func.date(Log.timestamp), Log.action),
+            execution_options={"synchronize_session": False},
+        ).all()
+        totals = Counter((date.fromisoformat(str(day)), action) for day, action in deleted)  # SQLite returns dates as text
+        for (value, action), entries in totals.items():
+            row = db.session.get(LogDailyCount, (value, action)) or LogDailyCount(day=value, action=action, entries=0)
+            row.entries += entries
+            db.session.add(row)
         db.session.commit()
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"ERROR - Failed to commit log entry: {e}")
+        raise
+    rolled = len(deleted)
+    print(f"[LOGS] Rolled {rolled} entries older than {cutoff:%Y-%m-%d} into daily counts")
+    return rolled
+
+
+@app.cli.command("rollup-logs")
+def rollup_logs_command():
+    """Rolls up old log entries; meant to be run daily from cron."""
+    rollup_logs()
+
+
+@app.cli.command("grant-admin")
+@click.argument("username")
+def grant_admin_command(username):
+    """Makes a registered user an administrator."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username}.")
+    user.is_admin = True
+    db.session.commit()
+    print(f"[USERS] {username} is now an administrator")
+
+
+def persist_job(record):
+    """Stores the final state of a background job next to the audit log."""
+    with app.app_context():
+        job = db.session.get(Job, record["id"]) or Job(id=record["id"])
+        job.status = record.get("status", "failed")
+        job.stage_timings = json.dumps(record.get("stages", {}))
+        job.result = json.dumps(record["result"]) if record.get("result") else None
+        job.error = record.get("error")
+        if record.get("finished_at"):
+            job.finished_at = datetime.utcfromtimestamp(record["finished_at"])
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"ERROR - Failed to commit job {job.id}: {e}")
+
+        if job.status == "finished":
+            log_to_database("Forecast Generation", f"Generated ARIMA and LSTM-PSO forecast for {job.filename} (job {job.id}).",
+                            job.username)
+            search = record["result"].get("arima_order")
+            if search and "arima_order_search" in record.get("stages", {}):
+                log_to_database(
+                    "ARIMA Order Search",
+                    f"{job.filename}: picked {tuple(search['order'])}x{tuple(search['seasonal_order'])} "
+                    f"in {search['seconds']:.1f}s ({search['full_fits']} full of {search['cheap_fits']} cheap fits"
+                    f"{', budget hit' if search['timed_out'] else ''}).",
+                    job.username,
+                )
+        else:
+            log_to_database("File Processing Error", f"Error processing {job.filename} (job {job.id}): {job.error}", job.username)
+
+
+def job_status(job_id):
+    """Returns the state of a job owned by the current user (or any job, for an administrator): the
+    live state, falling back to the persisted row. None when there is no such job for them."""
+    record = job_queue.get(job_id)
+    if record is not None:
+        record.pop("traceback", None)
+        if record.get("follows") and record["status"] not in ACTIVE_STATUSES:
+            job = db.session.get(Job, job_id)
+            if job is None or job.status in ACTIVE_STATUSES:
+                # A joined job has no worker of its own to persist it.
+                persist_job(record)
+    else:
+        job = db.session.get(Job, job_id)
+        record = job.to_dict() if job else None
+    if record is None or (record.get("username") != current_user.username and not current_user.is_admin):
+        return None
+    return record
+
+
+job_queue = JobQueue(on_done=persist_job)
+forecast_batcher = ForecastBatcher()
+if job_queue.preload:
+    job_queue.warm()
+    forecast_batcher.warm()
+upload_store = UploadStore()
 
 
 # --- Context Processors ---
@@ -161,12 +385,31 @@ def inject_navigation():
             ("Reports", url_for("reports")),
             ("Logs", url_for("view_logs")),
             ("Backup", url_for("backup")),
-            ("Restore", url_for("restore")),
+            *([("Restore", url_for("restore"))] if current_user.is_authenticated and current_user.is_admin else []),
             ("Change Username", url_for("change_username")),
         ]
     )
 
 
+# --- Request Instrumentation ---
+@app.before_request
+def start_request_span():
+    """Starts timing the request, and a profile capture when PROFILE_REQUESTS is on and a logged-in
+    user passes ?profile=1."""
+    g.request_start = time.perf_counter()
+    profile = PROFILE_REQUESTS and request.args.get("profile") == "1" and current_user.is_authenticated
+    g.profile = Profile(f"request-{request.endpoint}").start() if profile else None
+
+
+@app.teardown_request
+def finish_request_span(exc=None):
+    """Records the request's wall time and saves any profile capture."""
+    if "request_start" in g:
+        recorder.record(f"request.{request.endpoint or 'unknown'}", time.perf_counter() - g.request_start)
+    if g.get("profile") is not None:
+        print(f"[PROFILE] Saved {g.profile.stop()}")
+
+
 # --- Routes ---
 @app.route("/")
 def landing():
@@ -267,44 +510,219 @@ def upload():
         return redirect(url_for("upload_page"))
 
     if file:
-        filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
-        log_to_database("File Upload", f"User {current_user.username} uploaded file: {file.filename}")
+        with span("upload.save"):
+            data_hash, filepath, new = upload_store.save(file.stream, file.filename, current_user.username)
+        log_to_database("File Upload", f"User {current_user.username} uploaded file: {file.filename}"
+                                       f"{'' if new else ' (content already stored)'}")
 
         try:
-            df = pd.read_csv(filepath, parse_dates=["transaction_date"])
-            analyze_product_categories(df)
-            forecast_results, arima_metrics = create_seasonal_forecast(df)
-            log_to_database("Forecast Generation", "Generated ARIMA forecast.")
-            lstm_metrics = run_lstm_pso_forecast(df.set_index("transaction_date")["quantity_sold"].resample("MS").sum())
-            log_to_database("Forecast Generation", "Generated LSTM-PSO forecast.")
-
-            preview_table = df.head().to_html(classes="table table-bordered")
-
-            return render_template(
-                "forecast_dashboard.html",
-                plot1=url_for("static", filename="plots/category_seasonal_plot.png"),
-                plot2=url_for("static", filename="plots/category_total_sales_plot.png"),
-                plot3=url_for("static", filename="plots/final_seasonal_forecast_plot.png"),
-                plot4=url_for("static", filename="plots/lstm_pso_forecast.png"),
-                mape_arima=arima_metrics["MAPE"],
-                rmse_arima=arima_metrics["RMSE"],
-                r2_arima=arima_metrics["R2"],
-                mape_lstm=lstm_metrics["MAPE"],
-                rmse_lstm=lstm_metrics["RMSE"],
-                r2_lstm=lstm_metrics["R2"],
-                table_preview=preview_table,
-            )
+            with span("upload.preview"):
+                preview_table = pd.read_csv(filepath, nrows=5).to_html(classes="table table-bordered")
+
+            with span("upload.registry_lookup"):
+                key, cached = cached_forecast(filepath, uuid.uuid4().hex, data_hash=data_hash)
+            if cached is not None:
+                log_to_database("Forecast Generation", f"Served stored forecast {key} for {file.filename}.")
+                return render_template(
+                    "forecast_dashboard.html",
+                    plot1=url_for("static", filename=cached["plots"][0]),
+                    plot2=url_for("static", filename=cached["plots"][1]),
+                    plot3=url_for("static", filename=cached["plots"][2]),
+                    plot4=url_for("static", filename=cached["plots"][3]),
+                    mape_arima=cached["arima"]["MAPE"],
+                    rmse_arima=cached["arima"]["RMSE"],
+                    r2_arima=cached["arima"]["R2"],
+                    mape_lstm=cached["lstm"]["MAPE"],
+                    rmse_lstm=cached["lstm"]["RMSE"],
+                    r2_lstm=cached["lstm"]["R2"],
+                    categories=cached.get("categories"),
+                    product_stats=cached.get("product_stats"),
+                    backtest=cached.get("backtest"),
+                    span_summary=span_summary(),
+                    table_preview=preview_table,
+                )
+
+            job = Job(id=uuid.uuid4().hex, username=current_user.username, filename=file.filename)
+            db.session.add(job)
+            with span("upload.db_commit"):
+                db.session.commit()
+            with span("upload.submit"):
+                # Keyed on the content hash in the shared job store, so the same file uploaded again to
+                # any web worker while its first forecast is still running joins that job.
+                job_id = job_queue.submit(
+                    run_forecast_pipeline, filepath, job_id=job.id, dedupe_key=data_hash,
+                    username=current_user.username, filename=file.filename, data_hash=data_hash
+                )
+            if job_id != job.id:
+                # The user polls their own job id, which reports the running job's progress.
+                job_queue.follow(job.id, job_id, username=current_user.username, filename=file.filename)
+                log_to_database("Forecast Queued", f"Joined running forecast job {job_id} for {file.filename}.")
+                return render_template("forecast_dashboard.html", job_id=job.id, table_preview=preview_table,
+                                       span_summary=span_summary())
+            log_to_database("Forecast Queued", f"Queued forecast job {job_id} for {file.filename}.")
+
+            return render_template("forecast_dashboard.html", job_id=job_id, table_preview=preview_table,
+                                   span_summary=span_summary())
         except Exception as e:
+            db.session.rollback()
             flash(f"Error processing file: {e}", "danger")
             log_to_database("File Processing Error", f"Error processing {file.filename}: {e}")
             return render_template("index.html", table_preview=None, error=str(e))
     flash("An unexpected error occurred during file upload.", "danger")
     return redirect(url_for("upload_page"))
 
+
+@app.route("/upload/<filename>/append", methods=["POST"])
+@login_required
+def append_upload(filename):
+    """Appends new transactions to an uploaded file and updates its stored forecast models."""
+    filename = os.path.basename(filename)
+    file = request.files.get("file")
+    if upload_store.resolve(filename) is None:
+        flash("File not found.", "danger")
+        return redirect(url_for("reports"))
+    if file is None or file.filename == "":
+        flash("No selected file.", "danger")
+        return redirect(url_for("reports"))
+
+    os.makedirs(APPEND_FOLDER, exist_ok=True)
+    new_path = os.path.join(APPEND_FOLDER, f"{uuid.uuid4().hex}.csv")
+    file.save(new_path)
+    log_to_database("File Append", f"User {current_user.username} appended {file.filename} to {filename}")
+    try:
+        job = Job(id=uuid.uuid4().hex, username=current_user.username, filename=filename)
+        db.session.add(job)
+        db.session.commit()
+        job_id = job_queue.submit(
+            run_append_pipeline, filename, new_path, current_user.username, job_id=job.id,
+            username=current_user.username, filename=filename
+        )
+        log_to_database("Forecast Queued", f"Queued forecast update {job_id} for {filename}.")
+        return render_template("forecast_dashboard.html", job_id=job_id, span_summary=span_summary())
+    except Exception as e:
+        db.session.rollback()
+        flash(f"Error processing file: {e}", "danger")
+        log_to_database("File Processing Error", f"Error appending to {filename}: {e}")
+        return redirect(url_for("reports"))
+
+
+@app.route("/jobs/<job_id>")
+@login_required
+def job_detail(job_id):
+    """Reports the status and per-stage timings of a forecast job."""
+    record = job_status(job_id)
+    if record is None:
+        return jsonify({"error": "Job not found."}), 404
+    record.pop("result", None)
+    return jsonify(record)
+
+
+@app.route("/jobs/<job_id>/result")
+@login_required
+def job_result(job_id):
+    """Returns the plots and metrics of a finished forecast job."""
+    record = job_status(job_id)
+    if record is None:
+        return jsonify({"error": "Job not found."}), 404
+    if record["status"] == "failed":
+        return jsonify({"status": "failed", "error": record.get("error")}), 500
+    if record["status"] != "finished":
+        return jsonify({"status": record["status"]}), 202
+
+    result = dict(record["result"])
+    result["plots"] = [url_for("static", filename=plot) for plot in result["plots"]]
+    return jsonify({"status": "finished", **result})
+
+
+@app.route("/metrics")
+def metrics():
+    """Exports span timings and peak memory of the app and its workers in Prometheus text format.
+    Requires METRICS_TOKEN as a bearer token when set, and a scrape from the same host otherwise."""
+    if METRICS_TOKEN:
+        allowed = hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+    else:
+        allowed = request.remote_addr in ("127.0.0.1", "::1")
+    if not allowed:
+        return Response("Forbidden\n", status=403, mimetype="text/plain")
+    return Response(prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/models")
+@login_required
+def list_models():
+    """Lists the fitted models stored in the registry."""
+    return jsonify(registry.list())
+
+
+@app.route("/models/<key>/invalidate", methods=["POST"])
+@login_required
+@admin_required
+def invalidate_model(key):
+    """Removes a stored model so the next upload of its data retrains it."""
+    if not registry.invalidate(key):
+        return jsonify({"error": "Model not found."}), 404
+    log_to_database("Model Invalidated", f"User {current_user.username} invalidated stored model {key}.")
+    return jsonify({"invalidated": key})
+
+@app.route("/api/forecast", methods=["POST"])
+@login_required
+def api_forecast():
+    """Forecasts horizon months ahead with the stored SARIMAX and LSTM of an upload ("dataset") or a
+    registry entry ("model_key"), from the upload's monthly totals or a given "series". Nothing is retrained."""
+    start = time.perf_counter()
+    payload = request.get_json(silent=True) or {}
+    try:
+        horizon = int(payload.get("horizon", 12))
+    except (TypeError, ValueError):
+        horizon = 0
+    if not 1 <= horizon <= FORECAST_MAX_HORIZON:
+        return jsonify({"error": f"horizon must be between 1 and {FORECAST_MAX_HORIZON}."}), 400
+    models = payload.get("models") or list(MODELS)
+    if not isinstance(models, list) or not set(models) <= set(MODELS):
+        return jsonify({"error": f"models must be a list of {', '.join(MODELS)}."}), 400
+
+    series, dates = payload.get("series"), None
+    if payload.get("dataset"):
+        entry = upload_store.entries().get(os.path.basename(str(payload["dataset"])))
+        if entry is None:
+            return jsonify({"error": "Dataset not found."}), 404
+        key = model_key(entry["sha256"], MODEL_CONFIG)
+        if series is None:
+            totals = load_cube(upload_store.blob_path(entry["sha256"])).totals()
+            series = totals.tolist()
+            if len(totals):
+                months = pd.date_range(totals.index[-1], periods=horizon + 1, freq="MS")[1:]
+                dates = [month.strftime("%Y-%m-%d") for month in months]
+    elif payload.get("model_key"):
+        key = str(payload["model_key"])
+    else:
+        return jsonify({"error": "Pass a dataset or a model_key."}), 400
+    try:
+        series = [float(value) for value in series]
+    except (TypeError, ValueError):
+        series = []
+    if not series or not all(math.isfinite(value) for value in series):
+        return jsonify({"error": "series must be a non-empty list of monthly values."}), 400
+
+    with span("api.forecast"):
+        try:
+            forecasts = forecast_batcher.forecast(key, series, horizon, models)
+        except LookupError as e:
+            return jsonify({"error": str(e)}), 404
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 422
+        except TimeoutError:
+            return jsonify({"error": "Forecast timed out."}), 504
+    return jsonify({"model_key": key, "horizon": horizon, "dates": dates, **forecasts,
+                    "milliseconds": (time.perf_counter() - start) * 1000})
+
 @app.route('/filter', methods=['GET', 'POST'])
 def filter_sales():
-    uploaded_files = os.listdir(UPLOAD_FOLDER)
+    # Plotly is only needed here; importing it at startup would cost every web worker.
+    import plotly.express as px
+    import plotly.io as pio
+
+    uploaded_files = sorted(upload_store.entries())
 
     if request.method == 'POST':
         selected_file = request.form.get('csv_file')
@@ -314,67 +732,166 @@ def filter_sales():
             flash('Please select a CSV file.', 'danger')
             return redirect(url_for('filter_sales'))
 
-        filepath = os.path.join(UPLOAD_FOLDER, selected_file)
+        filepath = upload_store.resolve(selected_file)
+        if filepath is None:
+            flash('File not found.', 'danger')
+            return redirect(url_for('filter_sales'))
 
+        # Raw transaction rows, as /filter has always returned; product totals are opt-in.
+        group_by = request.form.get('group_by', 'rows')
+        start = request.form.get('start_month') or None
+        end = request.form.get('end_month') or None
         try:
-            data = pd.read_csv(filepath)
+            n = int(request.form.get('top_n', 10))
+        except ValueError:
+            n = 0
+        if filter_type not in ('most_sold', 'least_sold') or group_by not in ('product_id', 'rows'):
+            flash('Invalid filter type!', 'danger')
+            return redirect(url_for('filter_sales'))
+        if not 1 <= n <= INDEX_MAX_N:
+            flash(f'Number of results must be between 1 and {INDEX_MAX_N}.', 'danger')
+            return redirect(url_for('filter_sales'))
 
-            if filter_type == 'most_sold':
-                filtered_data = data.sort_values(by='quantity_sold', ascending=False).head(10)
-            elif filter_type == 'least_sold':
-                filtered_data = data.sort_values(by='quantity_sold', ascending=True).head(10)
-            else:
-                flash('Invalid filter type!', 'danger')
-                return redirect(url_for('filter_sales'))
+        try:
+            filtered_data = top_n(filepath, n=n, kind=filter_type, group_by=group_by, start=start, end=end)
+            categories = category_breakdown(filepath, start=start, end=end)
 
             fig = px.bar(filtered_data, x='product_id', y='quantity_sold',
                          title=f"{filter_type.replace('_', ' ').title()} Products")
             fig.update_layout(
                 xaxis_title='Product ID',
-                yaxis_title='Quantity Sold'
+                yaxis_title='Quantity Sold',
+                xaxis_type='category'
             )
             graph_html = pio.to_html(fig, full_html=False)
 
             return render_template('forecast_dashboard.html',
-                                   filtered_data=filtered_data.to_html(classes="table table-bordered"),
+                                   filtered_data=filtered_data.to_html(classes="table table-bordered", index=False),
+                                   category_breakdown=categories.to_html(classes="table table-bordered", index=False),
                                    graph_html=graph_html)
 
         except Exception as e:
             flash(f"Error processing file: {e}", "danger")
 
-    return render_template('filter.html', files=uploaded_files)
+    return render_template('filter.html', files=uploaded_files, max_n=INDEX_MAX_N)
 
 @app.route("/reports")
 @login_required
 def reports():
     """Displays a list of uploaded files for reports."""
-    files = os.listdir(UPLOAD_FOLDER)
-    return render_template("reports.html", files=files)
+    entries = upload_store.entries()
+    files = sorted(entries)
+    summaries = {f: cached_summary(upload_store.blob_path(entries[f]["sha256"])) for f in files}
+    return render_template("reports.html", files=files, summaries=summaries)
 
 
 @app.route("/logs")
 @login_required
 def view_logs():
-    """Displays application logs from the database."""
-    logs = Log.query.order_by(Log.timestamp.desc()).all()
-    return render_template("logs.html", logs=logs)
+    """Displays one page of application logs, newest first, with optional filters.
+
+    Pages are keyset-paginated on (timestamp, id): the cursor is the last row shown, so each page
+    is an index range scan no matter how deep it is."""
+    audit_log.flush()
+    query = select(Log).where(*_log_filters(request.args))
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            timestamp, log_id = cursor.rsplit(",", 1)
+            query = query.where(tuple_(Log.timestamp, Log.id) < (datetime.fromisoformat(timestamp), int(log_id)))
+        except ValueError:
+            flash("Invalid page cursor.", "danger")
+    logs = db.session.scalars(query.order_by(Log.timestamp.desc(), Log.id.desc()).limit(LOG_PAGE_SIZE + 1)).all()
+    next_cursor = None
+    if len(logs) > LOG_PAGE_SIZE:
+        logs = logs[:LOG_PAGE_SIZE]
+        next_cursor = f"{logs[-1].timestamp.isoformat()},{logs[-1].id}"
+    filters = {key: request.args[key] for key in ("action", "user", "date_from", "date_to") if request.args.get(key)}
+    return render_template(
+        "logs.html",
+        logs=logs,
+        filters=filters,
+        next_cursor=next_cursor,
+        actions=db.session.scalars(select(Log.action).distinct().order_by(Log.action)).all(),
+        daily_counts=db.session.scalars(select(LogDailyCount).order_by(LogDailyCount.day.desc()).limit(30)).all(),
+        retention_days=LOG_RETENTION_DAYS,
+    )
+
+
+def _log_filters(args):
+    """WHERE clauses for the action, user and date range filters of the log viewer and export."""
+    clauses = []
+    if args.get("action"):
+        clauses.append(Log.action == args["action"])
+    if args.get("user"):
+        clauses.append(Log.username == args["user"])
+    try:
+        if args.get("date_from"):
+            clauses.append(Log.timestamp >= datetime.fromisoformat(args["date_from"]))
+        if args.get("date_to"):
+            clauses.append(Log.timestamp < datetime.fromisoformat(args["date_to"]) + timedelta(days=1))
+    except ValueError:
+        flash("Dates must be in YYYY-MM-DD format.", "danger")
+    return clauses
+
+
+@app.route("/logs/export.csv")
+@login_required
+def export_logs():
+    """Streams the (filtered) log table as CSV, fetching rows from the database in chunks."""
+    audit_log.flush()
+    query = (
+        select(Log.id, Log.timestamp, Log.username, Log.action, Log.details)
+        .where(*_log_filters(request.args))
+        .order_by(Log.timestamp.desc(), Log.id.desc())
+        .execution_options(yield_per=LOG_EXPORT_CHUNK)
+    )
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["id", "timestamp", "username", "action", "details"])
+        for partition in db.session.execute(query).partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=logs.csv"})
+
+
+@app.route("/logs/rollup", methods=["POST"])
+@login_required
+@admin_required
+def rollup_logs_now():
+    """Runs the log rollup on demand."""
+    try:
+        rolled = rollup_logs()
+        flash(f"Rolled {rolled} log entries older than {LOG_RETENTION_DAYS} days into daily counts.", "success")
+    except Exception as e:
+        flash(f"Log rollup failed: {e}", "danger")
+    return redirect(url_for("view_logs"))
 
 
 @app.route("/backup")
 @login_required
 def backup():
-    """Creates a zip backup of the uploaded files."""
-    backup_filename = f"project_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
-    backup_path = os.path.join(BACKUP_FOLDER, backup_filename)
-    shutil.make_archive(backup_path.replace(".zip", ""), "zip", UPLOAD_FOLDER)
+    """Streams a zip backup of uploads, forecast artifacts and caches; ?incremental=1 leaves out
+    content the previous backup already holds."""
+    backup_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    base = latest_manifest() if request.args.get("incremental") == "1" else None
+    backup_filename = f"project_backup_{backup_id}{'_incremental' if base else ''}.zip"
 
     log_to_database("Data Backup", f"User {current_user.username} created a backup: {backup_filename}")
-    flash("Backup created successfully!", "success")
-    return send_file(backup_path, as_attachment=True)
+    return Response(stream_backup(backup_id, base), mimetype="application/zip",
+                    headers={"Content-Disposition": f"attachment; filename={backup_filename}"})
 
 
 @app.route("/restore", methods=["GET", "POST"])
 @login_required
+@admin_required
 def restore():
     """Handles restoring files from a zip backup."""
     if request.method == "POST":
@@ -387,23 +904,14 @@ def restore():
             return redirect(request.url)
         if file and file.filename.endswith(".zip"):
             try:
-                # Clear existing files for a clean restore (optional but recommended)
-                for f in os.listdir(UPLOAD_FOLDER):
-                    file_path = os.path.join(UPLOAD_FOLDER, f)
-                    if os.path.isfile(file_path) or os.path.islink(file_path):
-                        os.unlink(file_path)
-                    elif os.path.isdir(file_path):
-                        shutil.rmtree(file_path)
-
-                zip_filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-                file.save(zip_filepath)
-                shutil.unpack_archive(zip_filepath, UPLOAD_FOLDER)
-                os.remove(zip_filepath)
-
+                restored = restore_backup(file.stream)
                 log_to_database(
                     "Data Restore", f"User {current_user.username} restored data from {file.filename}."
                 )
-                flash("Files restored successfully!", "success")
+                flash(f"Restored {restored['files']} files ({', '.join(restored['sections'])}) successfully!", "success")
+                if restored["skipped"]:
+                    flash(f"The archive is not signed by this server, so {', '.join(restored['skipped'])} were not "
+                          "restored; they are rebuilt from the uploads when next needed.", "info")
                 return redirect(url_for("reports"))
             except Exception as e:
                 flash(f"Failed to restore files: {e}", "danger")
@@ -411,16 +919,16 @@ def restore():
         else:
             flash("Invalid file type. Please upload a .zip file.", "danger")
 
-    return render_template("restore.html")
+    return render_template("restore.html", backups=list_manifests())
 
 
 @app.route("/download/<filename>")
 @login_required
 def download(filename):
     """Allows downloading of uploaded files."""
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    if os.path.exists(filepath):
-        return send_file(filepath, as_attachment=True)
+    filepath = upload_store.resolve(filename)
+    if filepath is not None:
+        return send_file(filepath, as_attachment=True, download_name=os.path.basename(filename))
     else:
         flash("File not found.", "danger")
         return redirect(url_for("reports"))
@@ -453,12 +961,3 @@ def change_username():
         form.new_username.data = current_user.username
 
     return render_template("change_username.html", form=form)
-
-if __name__ == "__main__":
-    with app.app_context():
-        try:
-            db.create_all()
-        except Exception as e:
-            print(f"[ERROR] Could not create tables: {e}")
-    
-  
\ No newline at end of file
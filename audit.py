@@ -0,0 +1,203 @@
+import atexit
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", "100"))
+AUDIT_FLUSH_SECONDS = float(os.environ.get("AUDIT_FLUSH_SECONDS", "2"))
+AUDIT_QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_FALLBACK_FILE = os.environ.get("AUDIT_FALLBACK_FILE", "logs/audit_fallback.jsonl")
+# Column sizes of the Log model; an oversized value would otherwise fail its whole batch.
+ACTION_LENGTH = 100
+DETAILS_LENGTH = 200
+USERNAME_LENGTH = 20
+
+
+class AuditLogWriter:
+    """Buffers audit rows in memory and bulk-inserts them from a background thread once
+    batch_size rows are waiting or flush_seconds have passed. When the insert fails the batch
+    is appended to a local JSON-lines file, which is replayed after the next successful insert, along
+    with any replay a crashed process left behind."""
+
+    def __init__(self, insert_rows, batch_size=AUDIT_BATCH_SIZE, flush_seconds=AUDIT_FLUSH_SECONDS,
+                 fallback_path=AUDIT_FALLBACK_FILE, max_queue=AUDIT_QUEUE_SIZE):
+        self.insert_rows = insert_rows
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.fallback_path = fallback_path
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_thread(self):
+        # Started lazily, and again in a forked web worker, which inherits the object but not the thread.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue(self.max_queue)
+                self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+                self._thread.start()
+
+    def log(self, action, details="", username=None):
+        """Queues one Log row; never waits on the database."""
+        row = {
+            "timestamp": datetime.utcnow(),
+            "action": str(action)[:ACTION_LENGTH],
+            "details": str(details or "")[:DETAILS_LENGTH],
+            "username": username[:USERNAME_LENGTH] if username else None,
+        }
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._write_fallback([row])
+
+    def flush(self, timeout=10):
+        """Blocks until every row queued so far has been written (or sent to the fallback file)."""
+        if self._pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._pid != os.getpid():
+            return
+        self.flush(timeout)
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._pid = None
+
+    def _run(self):
+        # Picks up rows a previous process left in the fallback file without waiting for a new row.
+        self._replay_fallback()
+        batch, waiters = [], []
+        deadline = None
+        while True:
+            try:
+                item = self._queue.get(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = False
+            if isinstance(item, dict):
+                batch.append(item)
+                deadline = deadline or time.monotonic() + self.flush_seconds
+            elif isinstance(item, threading.Event):
+                waiters.append(item)
+
+            if batch and (item is None or waiters or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+            if item is None:
+                return
+
+    def _write(self, rows):
+        try:
+            self.insert_rows(rows)
+        except Exception as e:
+            print(f"ERROR - Failed to write {len(rows)} audit log rows, keeping them in {self.fallback_path}: {e}")
+            self._write_fallback(rows)
+            return
+        self._replay_fallback()
+
+    def _write_fallback(self, rows):
+        self._write_rows(self.fallback_path, rows, "a")
+
+    def _write_rows(self, path, rows, mode):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, mode) as f:
+            for row in rows:
+                f.write(json.dumps({**row, "timestamp": row["timestamp"].isoformat()}) + "\n")
+
+    def _claim(self, path):
+        # Renamed to a name of this process first, so rows written meanwhile land in a fresh fallback
+        # file and no other process replays the same rows.
+        claimed = f"{self.fallback_path}.{os.getpid()}.{uuid.uuid4().hex}.replay"
+        try:
+            os.replace(path, claimed)
+        except OSError:
+            return None
+        return claimed
+
+    def _replay_fallback(self):
+        # Replay files of processes that died mid-replay are adopted too, as are this process's own
+        # from an earlier replay that failed part-way.
+        for path in sorted(glob.glob(f"{glob.escape(self.fallback_path)}.*.replay")):
+            pid = path[len(self.fallback_path) + 1:].split(".", 1)[0]
+            if pid.isdigit() and (int(pid) == os.getpid() or not _pid_alive(int(pid))):
+                claimed = self._claim(path)
+                if claimed is not None and not self._replay_file(claimed):
+                    return
+        if os.path.exists(self.fallback_path):
+            claimed = self._claim(self.fallback_path)
+            if claimed is not None:
+                self._replay_file(claimed)
+
+    def _replay_file(self, path):
+        """Inserts the rows of a claimed fallback file and removes it. On failure the rows not yet
+        inserted stay in the file for the next replay; returns whether it succeeded."""
+        rows, bad = [], []
+        try:
+            f = open(path)
+        except OSError as e:
+            print(f"ERROR - Failed to read audit log fallback file {path}: {e}")
+            return False
+        with f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                    row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+                    row.setdefault("username", None)
+                    rows.append(row)
+                except (ValueError, TypeError, KeyError):
+                    bad.append(line if line.endswith("\n") else line + "\n")
+        if bad:
+            # Truncated or corrupt lines (e.g. from a crash mid-write) are set aside instead of retried.
+            with open(f"{self.fallback_path}.bad", "a") as f:
+                f.writelines(bad)
+            print(f"ERROR - Moved {len(bad)} unreadable audit log rows to {self.fallback_path}.bad")
+
+        inserted = 0
+        try:
+            for start in range(0, len(rows), self.batch_size):
+                self.insert_rows(rows[start:start + self.batch_size])
+                inserted = min(len(rows), start + self.batch_size)
+        except Exception as e:
+            print(f"ERROR - Failed to replay audit log fallback file, keeping {len(rows) - inserted} rows: {e}")
+            self._write_rows(f"{path}.tmp", rows[inserted:], "w")
+            os.replace(f"{path}.tmp", path)
+            return False
+        os.remove(path)
+        print(f"[AUDIT] Replayed {len(rows)} rows from {self.fallback_path}")
+        return True
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to another user.
+        return True
+    return True
+
+
+def create_writer(insert_rows, **options):
+    """Returns a writer that is flushed when the process exits."""
+    writer = AuditLogWriter(insert_rows, **options)
+    atexit.register(writer.close)
+    return writer
@@ -0,0 +1,173 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+
+import numpy as np
+import pandas as pd
+
+from forecast import SARIMAX_ORDER, SEASONAL_ORDER
+from profiling import span
+from pso_lstm import FINAL_EPOCHS, FINE_TUNE_EPOCHS, PSO_SEED, cached_windows, create_lstm_model, recursive_forecast
+from utils import JOB_CORES, METRICS, batch_metrics
+
+BACKTEST_FOLDS = int(os.environ.get("BACKTEST_FOLDS", "6"))
+BACKTEST_HORIZON = int(os.environ.get("BACKTEST_HORIZON", "3"))
+# Months between adjacent origins; equal to the horizon, test windows tile the backtested span.
+BACKTEST_STEP = int(os.environ.get("BACKTEST_STEP", str(BACKTEST_HORIZON)))
+BACKTEST_WORKERS = int(os.environ.get("BACKTEST_WORKERS", JOB_CORES))
+# Two seasonal cycles, as the seasonal SARIMAX needs; earlier origins are skipped.
+BACKTEST_MIN_TRAIN = 2 * SEASONAL_ORDER[3]
+
+
+def rolling_origins(n_obs, folds=BACKTEST_FOLDS, horizon=BACKTEST_HORIZON, step=BACKTEST_STEP,
+                    min_train=BACKTEST_MIN_TRAIN):
+    """Training lengths of an expanding-window backtest, oldest first; the last fold's test window
+    ends at the last observation."""
+    last = n_obs - horizon
+    return [origin for origin in range(last - step * (folds - 1), last + 1, step) if origin >= min_train]
+
+
+def _fold(series, origin, horizon, forecast, start, refit):
+    test = series[origin:origin + horizon]
+    return {
+        "origin": test.index[0].strftime("%Y-%m-%d"),
+        "train_months": origin,
+        "actual": test.tolist(),
+        "forecast": np.asarray(forecast, dtype="float64").tolist(),
+        "refit": refit,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# --- Fold Workers ---
+# Each worker takes a run of adjacent origins: the first fold is fitted from scratch and the rest
+# carry its fitted state forward, so only one fit per worker pays the full price.
+def _sarimax_folds(values, months, origins, horizon, order, seasonal_order):
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+    series = pd.Series(values, index=pd.DatetimeIndex(months, freq="MS"))
+    folds, results, previous = [], None, None
+    for origin in origins:
+        start = time.perf_counter()
+        if results is None:
+            results = SARIMAX(series[:origin], order=order, seasonal_order=seasonal_order).fit(disp=False)
+        else:
+            # Filters in the months since the previous origin with the parameters already estimated.
+            results = results.append(series[previous:origin])
+        folds.append(_fold(series, origin, horizon, results.forecast(horizon), start, refit=previous is None))
+        previous = origin
+    return folds
+
+
+def _lstm_folds(values, months, origins, horizon, units, n_steps, epochs, fine_tune_epochs, seed):
+    from keras.utils import set_random_seed
+    from sklearn.preprocessing import MinMaxScaler
+
+    series = pd.Series(values, index=pd.DatetimeIndex(months, freq="MS"))
+    folds, model, scaler = [], None, None
+    for origin in origins:
+        start = time.perf_counter()
+        train = values[:origin]
+        refit = model is None
+        if refit:
+            if seed is not None:
+                set_random_seed(seed)
+            # Scaled on the first fold's training data only, like fine_tune_lstm_forecast keeps its scaler.
+            scaler = MinMaxScaler().fit(train.reshape(-1, 1))
+            model = create_lstm_model((n_steps, 1), units)
+        X, y = cached_windows(scaler.transform(train.reshape(-1, 1)).flatten(), n_steps)
+        model.fit(X, y, epochs=epochs if refit else fine_tune_epochs, verbose=0)
+        forecast = recursive_forecast(model, scaler, n_steps, [train], horizon)[0]
+        folds.append(_fold(series, origin, horizon, forecast, start, refit))
+    return folds
+
+
+def _init_backtest_worker(threads):
+    # Keep n_workers * threads at the core count for the LSTM folds.
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+# --- Backtest ---
+def _finite(value):
+    # NaN is not valid JSON; the result goes to the job store and the registry manifest.
+    return float(value) if np.isfinite(value) else None
+
+
+def _summary(folds, values):
+    """Scores every fold in one metrics pass, MASE scaled by each fold's own training months, and the
+    forecasts of all folds pooled together; adds up the compute time the folds took."""
+    width = max((len(fold["actual"]) for fold in folds), default=1)
+    actual = np.full((len(folds), width), np.nan)
+    forecast = actual.copy()
+    train = np.full((len(folds), len(values)), np.nan)
+    for row, fold in enumerate(folds):
+        actual[row, :len(fold["actual"])] = fold["actual"]
+        forecast[row, :len(fold["forecast"])] = fold["forecast"]
+        train[row, :fold["train_months"]] = values[:fold["train_months"]]
+    scores = batch_metrics(actual, forecast, train=train)
+    for row, fold in enumerate(folds):
+        fold.update({name: _finite(scores[name][row]) for name in METRICS})
+    # Pooled MASE is scaled by the longest training span.
+    pooled = batch_metrics(actual.ravel(), forecast.ravel(), train=train[-1] if folds else None)
+    return {
+        **{name: _finite(pooled[name][0]) for name in METRICS},
+        "folds": folds,
+        "refits": sum(fold["refit"] for fold in folds),
+        "compute_seconds": sum(fold["seconds"] for fold in folds),
+    }
+
+
+def run_backtest(series, folds=BACKTEST_FOLDS, horizon=BACKTEST_HORIZON, step=BACKTEST_STEP,
+                 n_workers=BACKTEST_WORKERS, order=SARIMAX_ORDER, seasonal_order=SEASONAL_ORDER, lstm=None,
+                 epochs=FINAL_EPOCHS, fine_tune_epochs=FINE_TUNE_EPOCHS, seed=PSO_SEED):
+    """Rolling-origin evaluation of the SARIMAX and, given its (units, n_steps) in lstm, the LSTM on a
+    monthly series. Adjacent origins are split into one contiguous run per worker and the runs of both
+    models go to one process pool. Returns per-model pooled metrics and folds, and the run's timings."""
+    start = time.perf_counter()
+    origins = rolling_origins(len(series), folds, horizon, step)
+    values, months = series.to_numpy("float64"), series.index.values
+    n_workers = max(1, min(n_workers, len(origins)))
+    size = max(1, ceil(len(origins) / n_workers))
+    runs = [origins[i:i + size] for i in range(0, len(origins), size)]
+    print(f"\n--- Backtesting {len(origins)} folds, horizon {horizon} ({n_workers} workers) ---")
+
+    tasks = [("sarimax", _sarimax_folds, (values, months, run, horizon, tuple(order), tuple(seasonal_order)))
+             for run in runs]
+    if lstm is not None:
+        tasks += [("lstm", _lstm_folds, (values, months, [o for o in run if o > lstm["n_steps"]], horizon,
+                                         lstm["units"], lstm["n_steps"], epochs, fine_tune_epochs, seed))
+                  for run in runs]
+    with span("backtest.run"):
+        if n_workers > 1:
+            # The initializer imports TensorFlow, which SARIMAX-only workers have no use for.
+            initializer, initargs = (_init_backtest_worker, (max(1, JOB_CORES // n_workers),)) if lstm else (None, ())
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=initializer, initargs=initargs) as executor:
+                futures = [(name, executor.submit(fn, *args)) for name, fn, args in tasks]
+                results = [(name, future.result()) for name, future in futures]
+        else:
+            results = [(name, fn(*args)) for name, fn, args in tasks]
+
+    by_model = {"sarimax": [], "lstm": []} if lstm is not None else {"sarimax": []}
+    for name, model_folds in results:
+        by_model[name].extend(model_folds)
+    backtest = {name: _summary(sorted(model_folds, key=lambda fold: fold["train_months"]), values)
+                for name, model_folds in by_model.items()}
+    elapsed = time.perf_counter() - start
+    backtest["stats"] = {
+        "folds": len(origins),
+        "horizon": horizon,
+        "step": step,
+        "workers": n_workers,
+        "compute_seconds": sum(summary["compute_seconds"] for summary in backtest.values()),
+        "wall_seconds": elapsed,
+    }
+    print(f"[BACKTEST] {len(origins)} folds in {elapsed:.2f}s wall, "
+          f"{backtest['stats']['compute_seconds']:.2f}s compute ({n_workers} workers): "
+          + ", ".join(f"{name} MAPE={round(summary['MAPE'], 2) if summary['MAPE'] is not None else None}%"
+                      for name, summary in backtest.items() if name != "stats"))
+    return backtest
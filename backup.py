@@ -0,0 +1,323 @@
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import time
+import uuid
+import zipfile
+
+from ingest import CACHE_FOLDER
+from profiling import span
+from registry import REGISTRY_DIR, file_hash
+from upload_store import BLOB_FOLDER, INDEX_FILE, UPLOAD_FOLDER
+
+# Archive prefix -> directory. Raw uploads, the published forecast plots, fitted models and the
+# columnar ingest cache, so a restored instance serves stored forecasts without re-ingesting.
+BACKUP_SECTIONS = {
+    "uploads": UPLOAD_FOLDER,
+    "plots": "static/plots",
+    "models": REGISTRY_DIR,
+    "columnar": CACHE_FOLDER,
+}
+# Restored from any archive. Models are unpickled and plots are served from the app's origin, so the
+# other sections are only restored from archives signed with BACKUP_SIGNING_KEY; otherwise they are
+# rebuilt from the restored uploads when next needed.
+RESTORE_SECTIONS = ("uploads",)
+BACKUP_SIGNING_KEY = os.environ.get("BACKUP_SIGNING_KEY")
+MANIFEST_DIR = os.environ.get("BACKUP_MANIFEST_DIR", "backups/manifests")
+HASH_CACHE_FILE = os.environ.get("BACKUP_HASH_CACHE", "cache/backup_hashes.json")
+CHUNK_BYTES = 1024 * 1024
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+SIGNATURE_NAME = "manifest.sig"
+OBJECTS = "objects"
+# Already compressed; deflating them again only costs CPU.
+STORED_SUFFIXES = (".png", ".zip", ".gz", ".npz")
+
+
+# --- Snapshots ---
+def _walk(sections):
+    for section, directory in sections.items():
+        for root, dirs, files in os.walk(directory):
+            # Dot-prefixed entries are in-flight staging directories and temp files.
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if name.startswith(".") or name.endswith(".tmp"):
+                    continue
+                local = os.path.join(root, name)
+                yield f"{section}/{os.path.relpath(local, directory).replace(os.sep, '/')}", local
+
+
+def _load_hash_cache():
+    try:
+        with open(HASH_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_hash_cache(cache):
+    os.makedirs(os.path.dirname(HASH_CACHE_FILE) or ".", exist_ok=True)
+    tmp_path = f"{HASH_CACHE_FILE}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, HASH_CACHE_FILE)
+
+
+def snapshot(sections=BACKUP_SECTIONS):
+    """Content hash, size and mtime of every backed-up file. Hashes are cached by (size, mtime),
+    so only files changed since the last backup are read."""
+    cache = _load_hash_cache()
+    files, fresh = {}, {}
+    for path, local in _walk(sections):
+        stat = os.stat(local)
+        cached = cache.get(local)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            digest = cached[2]
+        else:
+            digest = file_hash(local)
+        fresh[local] = [stat.st_size, stat.st_mtime_ns, digest]
+        files[path] = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if fresh != cache:
+        _save_hash_cache(fresh)
+    return files
+
+
+def latest_manifest():
+    """The manifest of the most recent completed backup, or None."""
+    manifests = list_manifests(limit=1)
+    return manifests[0] if manifests else None
+
+
+def list_manifests(limit=10):
+    try:
+        names = sorted((name for name in os.listdir(MANIFEST_DIR) if name.endswith(".json")), reverse=True)
+    except OSError:
+        return []
+    manifests = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(MANIFEST_DIR, name)) as f:
+                manifests.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return manifests
+
+
+# --- Backup ---
+class _Chunks:
+    """Write-only sink for ZipFile. It has no seek or tell, so zipfile streams each member with a data
+    descriptor and the archive can go out to the client while it is written."""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts, self.size = [], 0
+        return data
+
+
+def stream_backup(backup_id, base=None, sections=BACKUP_SECTIONS, chunk_size=CHUNK_BYTES):
+    """Yields a zip archive of sections in chunks. Each distinct content is stored once under
+    objects/<sha256>; with a base manifest, content that backup already holds is left out. The
+    manifest is recorded in MANIFEST_DIR only once the whole archive has been produced."""
+    with span("backup.snapshot"):
+        files = snapshot(sections)
+    known = {entry["sha256"] for entry in base["files"].values()} if base else set()
+    objects = {}
+    out = _Chunks()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for path, entry in files.items():
+            if entry["sha256"] in known:
+                entry["object"] = None
+                continue
+            if entry["sha256"] in objects:
+                entry["object"] = objects[entry["sha256"]]
+                continue
+            info = zipfile.ZipInfo(f"{OBJECTS}/{entry['sha256']}", time.localtime(entry["mtime_ns"] / 1e9)[:6])
+            info.compress_type = zipfile.ZIP_STORED if path.endswith(STORED_SUFFIXES) else zipfile.ZIP_DEFLATED
+            info.file_size = entry["size"]
+            digest = hashlib.sha256()
+            section, relative = path.split("/", 1)
+            with open(os.path.join(sections[section], relative), "rb") as src, archive.open(info, "w") as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    digest.update(chunk)
+                    dst.write(chunk)
+                    if out.size >= chunk_size:
+                        yield out.take()
+            if digest.hexdigest() != entry["sha256"]:
+                # Changed between hashing and archiving: record what was actually written.
+                print(f"[BACKUP] {path} changed while it was archived")
+                entry["sha256"] = digest.hexdigest()
+            objects[entry["sha256"]] = entry["object"] = info.filename
+        manifest = {
+            "version": FORMAT_VERSION,
+            "id": backup_id,
+            "created_at": time.time(),
+            "base": base["id"] if base else None,
+            "sections": sorted(sections),
+            "files": files,
+            "objects": len(objects),
+            "bytes": sum(entry["size"] for entry in files.values() if entry["object"]),
+        }
+        manifest_bytes = json.dumps(manifest).encode()
+        archive.writestr(MANIFEST_NAME, manifest_bytes)
+        if BACKUP_SIGNING_KEY:
+            # The manifest holds every file's hash, which restore checks, so this signs the whole archive.
+            archive.writestr(SIGNATURE_NAME, _signature(manifest_bytes))
+    yield out.take()
+
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    tmp_path = os.path.join(MANIFEST_DIR, f".{backup_id}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(MANIFEST_DIR, f"{backup_id}.json"))
+    print(f"[BACKUP] {backup_id}: {len(objects)} objects for {len(files)} files"
+          + (f", incremental on {base['id']}" if base else ""))
+
+
+# --- Restore ---
+def _signature(manifest_bytes):
+    return hmac.new(BACKUP_SIGNING_KEY.encode(), manifest_bytes, hashlib.sha256).hexdigest()
+
+
+def _is_signed(archive, manifest_bytes):
+    if not BACKUP_SIGNING_KEY or SIGNATURE_NAME not in archive.namelist():
+        return False
+    return hmac.compare_digest(archive.read(SIGNATURE_NAME).decode("ascii", "replace"), _signature(manifest_bytes))
+
+
+def _legacy_manifest(archive):
+    """Plain zips of the uploads folder, as written before backups had manifests."""
+    files = {
+        f"uploads/{info.filename}": {"sha256": None, "size": info.file_size, "mtime_ns": None, "object": info.filename}
+        for info in archive.infolist() if not info.is_dir()
+    }
+    return {"version": FORMAT_VERSION, "id": None, "base": None, "sections": ["uploads"], "files": files}
+
+
+def _check_uploads(staged, digests):
+    """Keeps the upload store content-addressed: every blob must be named after its own hash and every
+    name in the index must point to a restored blob."""
+    blob_prefix = f"{BLOB_FOLDER}{os.sep}"
+    blobs = set()
+    for relative, digest in digests.items():
+        if relative.startswith(blob_prefix):
+            if relative != os.path.join(BLOB_FOLDER, f"{digest}.csv"):
+                raise ValueError(f"{relative}: blob does not match its content")
+            blobs.add(digest)
+    try:
+        with open(os.path.join(staged, INDEX_FILE)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        raise ValueError(f"{INDEX_FILE} is not valid JSON")
+    names = index.get("names") if isinstance(index, dict) else None
+    if not isinstance(names, dict) or not isinstance(index.get("released", {}), dict):
+        raise ValueError(f"{INDEX_FILE} has an unexpected layout")
+    for name, entry in names.items():
+        if name != os.path.basename(name) or not isinstance(entry, dict) or entry.get("sha256") not in blobs:
+            raise ValueError(f"{INDEX_FILE}: {name} does not point to a restored upload")
+
+
+def _checked_path(path, sections):
+    """Splits an archive path into (section, relative path), rejecting anything that would land
+    outside the section's directory."""
+    section, _, relative = path.partition("/")
+    relative = os.path.normpath(relative)
+    if section not in sections or not relative or relative == "." or os.path.isabs(relative) \
+            or relative.split(os.sep)[0] == "..":
+        raise ValueError(f"Unexpected path in backup: {path}")
+    return section, relative
+
+
+def restore_backup(fileobj, sections=BACKUP_SECTIONS, chunk_size=CHUNK_BYTES):
+    """Restores the sections of a backup archive: all of them from an archive signed with
+    BACKUP_SIGNING_KEY, only RESTORE_SECTIONS from any other. Every file is extracted in chunks into
+    a staging directory next to its section and checked against the manifest's hash; only when all
+    of them pass is each section swapped in, so a bad archive leaves the current data untouched."""
+    with zipfile.ZipFile(fileobj) as archive:
+        try:
+            manifest_bytes = archive.read(MANIFEST_NAME)
+            manifest = json.loads(manifest_bytes)
+        except KeyError:
+            manifest_bytes, manifest = None, _legacy_manifest(archive)
+        if manifest.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported backup format {manifest.get('version')}")
+        if manifest_bytes is None or not _is_signed(archive, manifest_bytes):
+            sections = {section: directory for section, directory in sections.items() if section in RESTORE_SECTIONS}
+        members = set(archive.namelist())
+        restored = [section for section in manifest["sections"] if section in sections]
+
+        local = None
+        plan = []
+        for path, entry in manifest["files"].items():
+            section = path.partition("/")[0]
+            if section not in manifest["sections"]:
+                raise ValueError(f"{path}: section {section} is not listed in the manifest")
+            if section not in sections:
+                continue
+            section, relative = _checked_path(path, sections)
+            if entry["object"]:
+                if entry["object"] not in members:
+                    raise ValueError(f"{path}: {entry['object']} is missing from the archive")
+                plan.append((section, relative, entry, None))
+                continue
+            # Incremental archives leave out content their base already held; it must still be on disk.
+            if local is None:
+                local = {item["sha256"]: item_path for item_path, item in snapshot(sections).items()}
+            if entry["sha256"] not in local:
+                raise ValueError(f"{path} is neither in this archive nor on disk; restore backup {manifest['base']} first")
+            source_section, source_relative = local[entry["sha256"]].split("/", 1)
+            plan.append((section, relative, entry, os.path.join(sections[source_section], source_relative)))
+
+        token = uuid.uuid4().hex[:8]
+        staging = {section: f"{os.path.normpath(sections[section])}.restore-{token}" for section in restored}
+        digests = {section: {} for section in restored}
+        try:
+            with span("backup.extract"):
+                for section, relative, entry, source in plan:
+                    target = os.path.join(staging[section], relative)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    digest = hashlib.sha256()
+                    # Reading a member also checks its CRC, so legacy archives are validated too.
+                    with (open(source, "rb") if source else archive.open(entry["object"])) as src, open(target, "wb") as dst:
+                        for chunk in iter(lambda: src.read(chunk_size), b""):
+                            digest.update(chunk)
+                            dst.write(chunk)
+                    if entry["sha256"] and digest.hexdigest() != entry["sha256"]:
+                        raise ValueError(f"{relative}: checksum mismatch")
+                    digests[section][relative] = digest.hexdigest()
+                    if entry["mtime_ns"]:
+                        # Keeps the columnar cache's source signature valid for restored uploads.
+                        os.utime(target, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+            if "uploads" in staging:
+                _check_uploads(staging["uploads"], digests["uploads"])
+            for section, staged in staging.items():
+                os.makedirs(staged, exist_ok=True)
+                directory = sections[section]
+                previous = f"{staging[section]}.old"
+                if os.path.exists(directory):
+                    os.replace(directory, previous)
+                os.makedirs(os.path.dirname(os.path.normpath(directory)) or ".", exist_ok=True)
+                os.replace(staged, directory)
+                shutil.rmtree(previous, ignore_errors=True)
+        finally:
+            for staged in staging.values():
+                shutil.rmtree(staged, ignore_errors=True)
+
+    skipped = [section for section in manifest["sections"] if section not in sections]
+    return {"id": manifest["id"], "base": manifest["base"], "files": len(plan), "sections": restored, "skipped": skipped}
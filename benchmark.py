@@ -0,0 +1,337 @@
+"""Benchmarks for the forecasting pipeline on synthetic uploads.
+
+    python benchmark.py --size small
+    python benchmark.py --rows 500000 --products 200 --compare cache/benchmarks/baseline.json
+
+Every case runs in its own spawned process, so its peak RSS is its own, and all seeds are fixed.
+Nothing touches the network or a GPU.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+
+RESULTS_FOLDER = os.environ.get("BENCHMARK_RESULTS_DIR", "cache/benchmarks")
+SIZES = {
+    "small": {"rows": 50_000, "categories": 5, "products": 25, "years": 3},
+    "medium": {"rows": 500_000, "categories": 5, "products": 200, "years": 4},
+    "large": {"rows": 5_000_000, "categories": 10, "products": 2000, "years": 5},
+}
+CASES = ["ingest", "aggregation", "sarimax", "lstm_fit", "pso", "plots", "startup"]
+SEED = 42
+# Imported before the clock starts, so no case is charged for loading TensorFlow or statsmodels.
+CASE_MODULES = {
+    "ingest": ["ingest"],
+    "aggregation": ["ingest", "forecast"],
+    "sarimax": ["ingest", "forecast", "plots"],
+    "lstm_fit": ["ingest", "pso_lstm"],
+    "pso": ["ingest", "pso_lstm"],
+    "plots": ["ingest", "plots"],
+    "startup": [],
+}
+# Modules a web worker should not load until the first forecast; the startup case reports any that app imports.
+HEAVY_MODULES = ("tensorflow", "keras", "statsmodels", "sklearn", "matplotlib", "plotly")
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+seconds = time.perf_counter() - start
+from profiling import peak_rss_bytes
+loaded = sorted({name.split(".")[0] for name in sys.modules} & set(%r))
+print(json.dumps({"seconds": seconds, "peak_rss_mb": peak_rss_bytes() / 1e6, "heavy_modules": loaded}))
+"""
+REGRESSION_TOLERANCE = 0.2
+
+
+# --- Synthetic Data ---
+def generate_transactions(path, rows=50_000, categories=5, products=25, years=3, seed=SEED, chunk_rows=1_000_000):
+    """Writes a CSV in the upload schema (transaction_date, category_id, product_id, quantity_sold).
+    Each product gets its own base level and yearly seasonality, so aggregates look like real sales."""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    category_ids = np.arange(1, categories + 1) * 100 + 1
+    product_category = category_ids[np.arange(products) % categories]
+    product_ids = product_category * 100 + np.arange(products) // categories
+    product_base = rng.uniform(2, 20, products)
+    product_phase = rng.uniform(0, 2 * np.pi, products)
+    start = np.datetime64("2020-01-01")
+    days = int(365.25 * years)
+
+    with open(path, "w") as f:
+        f.write("transaction_date,category_id,product_id,quantity_sold\n")
+        for offset in range(0, rows, chunk_rows):
+            n = min(chunk_rows, rows - offset)
+            product = rng.integers(0, products, n)
+            day = rng.integers(0, days, n)
+            dates = start + day.astype("timedelta64[D]")
+            month = dates.astype("datetime64[M]").astype(int) % 12
+            trend = 1 + 0.3 * day / days
+            level = product_base[product] * trend * (1 + 0.4 * np.sin(2 * np.pi * month / 12 + product_phase[product]))
+            pd.DataFrame({
+                "transaction_date": dates,
+                "category_id": product_category[product],
+                "product_id": product_ids[product],
+                "quantity_sold": rng.poisson(level),
+            }).to_csv(f, header=False, index=False)
+    return path
+
+
+# --- Cases ---
+# Each returns (work units done, unit name, extra details); the runner times it.
+def _case_ingest(path, config):
+    import ingest
+    meta = ingest.ingest_csv(path)
+    return meta["rows"], "rows", {}
+
+
+def _case_aggregation(path, config):
+    import ingest
+    meta = ingest.ensure_cache(path)
+    cube = ingest.MonthlyCube.from_monthly(ingest.read_monthly(path))
+    cube.panel("category_id")
+    cube.group_totals("category_id")
+    cube.totals()
+    panel = cube.panel("product_id")
+    return meta["rows"], "rows", {"series": panel.shape[1], "months": panel.shape[0]}
+
+
+def _case_sarimax(path, config):
+    import ingest
+    from forecast import create_seasonal_forecast
+    from plots import PlotRenderer
+    renderer = PlotRenderer(max_workers=1, cache_dir=os.path.join(config["workdir"], "plots"))
+    _, metrics = create_seasonal_forecast(ingest.load_cube(path), renderer=renderer,
+                                          plot_path=os.path.join(config["workdir"], "sarimax.png"))
+    return 1, "fits", {"MAPE": float(metrics["MAPE"])}
+
+
+def _case_lstm_fit(path, config):
+    import ingest
+    import numpy as np
+    from pso_lstm import evaluate_particle
+    series = ingest.load_cube(path).totals().to_numpy("float64")
+    scaled = (series - series.min()) / max(np.ptp(series), 1e-12)
+    epochs = config["lstm_epochs"]
+    mse, _ = evaluate_particle(scaled, units=50, n_steps=6, epochs=epochs, seed=SEED)
+    return epochs, "epochs", {"mse": float(mse)}
+
+
+def _case_pso(path, config):
+    import ingest
+    from pso_lstm import LSTM_BOUNDS, pso_optimize
+    series = ingest.load_cube(path).totals().to_numpy("float64")
+    search = pso_optimize(series, n_particles=config["pso_particles"], iterations=config["pso_iterations"],
+                          bounds=LSTM_BOUNDS, seed=SEED, cache=None)
+    return config["pso_particles"] * config["pso_iterations"], "particle evaluations", {
+        "best_score": float(search["best_score"]),
+        "epochs_spent": int(search["epochs_spent"]),
+    }
+
+
+def _case_plots(path, config):
+    import pandas as pd
+
+    import ingest
+    from plots import CATEGORY_MAP, render_plot
+    cube = ingest.load_cube(path)
+    sales = cube.panel("category_id").rename(columns=CATEGORY_MAP)
+    totals = cube.totals()
+    pred_ci = {"lower": totals[-12:] * 0.9, "upper": totals[-12:] * 1.1}
+    figures = [
+        ("category_seasonal", sales),
+        ("category_total_sales", sales.sum().sort_values(ascending=False)),
+        ("arima_forecast", {"monthly_sales": totals, "test_data": totals[-12:],
+                            "forecast_values": totals[-12:] * 1.05, "pred_ci": pd.DataFrame(pred_ci)}),
+        ("lstm_forecast", {"y_true": totals.values, "y_pred": totals.values * 0.95}),
+    ]
+    rounds = config["plot_rounds"]
+    for _ in range(rounds):
+        for kind, data in figures:
+            render_plot(kind, data, os.path.join(config["workdir"], f"{kind}.png"))
+    return rounds * len(figures), "plots", {}
+
+
+def _case_startup(path, config):
+    """Imports the web app in fresh interpreters, as every web worker does when it boots."""
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+    folder = os.path.join(config["workdir"], "startup")
+    os.makedirs(folder, exist_ok=True)
+    runs = []
+    for _ in range(config["startup_rounds"]):
+        # Run from a scratch folder: importing app creates its upload and plot folders.
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE % (HEAVY_MODULES,)], cwd=folder, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return len(runs), "starts", {
+        "import_seconds": statistics.median(run["seconds"] for run in runs),
+        "import_peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "heavy_modules": runs[-1]["heavy_modules"],
+    }
+
+
+def _run_case(name, path, config):
+    import importlib
+    import random
+
+    import numpy as np
+    from profiling import peak_rss_bytes
+    for module in CASE_MODULES[name]:
+        importlib.import_module(module)
+    random.seed(SEED)
+    np.random.seed(SEED)
+    case = globals()[f"_case_{name}"]
+    timings = []
+    for _ in range(config["repeat"]):
+        start = time.perf_counter()
+        units, unit, details = case(path, config)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {
+        "seconds": best,
+        "median_seconds": statistics.median(timings),
+        "runs": timings,
+        "units": units,
+        "unit": unit,
+        "throughput": units / best if best > 0 else None,
+        "peak_rss_mb": peak_rss_bytes() / 1e6,
+        **details,
+    }
+
+
+# --- Runner ---
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(data_config, cases=CASES, repeat=1, lstm_epochs=5, pso_particles=5, pso_iterations=3,
+                   plot_rounds=10, startup_rounds=5):
+    """Generates the synthetic upload once and times each case in a fresh spawned process."""
+    workdir = tempfile.mkdtemp(prefix="forecast-bench-")
+    # Caches go to the scratch folder so runs never reuse each other's (or the app's) results.
+    os.environ["COLUMNAR_CACHE_DIR"] = os.path.join(workdir, "columnar")
+    os.environ["PSO_CACHE_DIR"] = os.path.join(workdir, "pso_fitness")
+    os.environ["PLOT_CACHE_DIR"] = os.path.join(workdir, "plots")
+    os.environ["METRICS_DIR"] = os.path.join(workdir, "metrics")
+    os.environ.setdefault("PSO_SEED", str(SEED))
+    config = {"workdir": workdir, "repeat": repeat, "lstm_epochs": lstm_epochs, "pso_particles": pso_particles,
+              "pso_iterations": pso_iterations, "plot_rounds": plot_rounds, "startup_rounds": startup_rounds}
+
+    path = os.path.join(workdir, "transactions.csv")
+    start = time.perf_counter()
+    generate_transactions(path, **data_config)
+    print(f"[BENCH] Generated {data_config['rows']} rows in {time.perf_counter() - start:.1f}s: {path}")
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    try:
+        for name in cases:
+            if name not in ("ingest", "startup"):
+                # Every later case reads the columnar cache; build it outside the timed process.
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    executor.submit(_prepare_cache, path).result()
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results[name] = executor.submit(_run_case, name, path, config).result()
+            r = results[name]
+            print(f"[BENCH] {name:<12} {r['seconds']:8.3f}s  {r['throughput']:12.1f} {r['unit']}/s  "
+                  f"peak RSS {r['peak_rss_mb']:.0f} MB")
+            if name == "startup":
+                print(f"[BENCH] {'':<12} app import {r['import_seconds']:.2f}s, peak RSS {r['import_peak_rss_mb']:.0f} MB, "
+                      f"heavy modules: {', '.join(r['heavy_modules']) or 'none'}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "data": data_config,
+        "config": {k: v for k, v in config.items() if k != "workdir"},
+        "results": results,
+    }
+
+
+def _prepare_cache(path):
+    import ingest
+    ingest.ensure_cache(path)
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Prints each case's time against a baseline run; returns the cases slower by more than tolerance."""
+    regressions = []
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["seconds"] / base["seconds"] if base["seconds"] else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  <-- regression"
+        print(f"[BENCH] {name:<12} {base['seconds']:8.3f}s -> {result['seconds']:8.3f}s  x{ratio:.2f}{flag}")
+    if baseline.get("data") != results.get("data") or baseline.get("config") != results.get("config"):
+        print("[BENCH] Warning: baseline was run with different data or settings")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="small")
+    parser.add_argument("--rows", type=int)
+    parser.add_argument("--categories", type=int)
+    parser.add_argument("--products", type=int)
+    parser.add_argument("--years", type=int)
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--lstm-epochs", type=int, default=5)
+    parser.add_argument("--pso-particles", type=int, default=5)
+    parser.add_argument("--pso-iterations", type=int, default=3)
+    parser.add_argument("--plot-rounds", type=int, default=10)
+    parser.add_argument("--startup-rounds", type=int, default=5)
+    parser.add_argument("--output", help=f"JSON path (default: {RESULTS_FOLDER}/<timestamp>.json)")
+    parser.add_argument("--compare", help="baseline JSON to compare against; exits 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    data_config = dict(SIZES[args.size])
+    for name in ("rows", "categories", "products", "years"):
+        if getattr(args, name) is not None:
+            data_config[name] = getattr(args, name)
+
+    results = run_benchmarks(data_config, cases=args.cases, repeat=args.repeat, lstm_epochs=args.lstm_epochs,
+                             pso_particles=args.pso_particles, pso_iterations=args.pso_iterations,
+                             plot_rounds=args.plot_rounds, startup_rounds=args.startup_rounds)
+    output = args.output or os.path.join(RESULTS_FOLDER, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[BENCH] Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"[BENCH] Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
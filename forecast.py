@@ -1,60 +1,337 @@
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, as_completed
+from math import ceil
+import numpy as np
 import pandas as pd
-import statsmodels.api as sm
-import matplotlib.pyplot as plt
 import warnings
-from utils import calculate_metrics
+from plots import CATEGORY_MAP, inline_renderer
+from profiling import span
+from utils import JOB_CORES, METRICS, batch_metrics, calculate_metrics
 warnings.filterwarnings("ignore")
 
 PLOT_FOLDER = "static/plots"
+SARIMAX_ORDER = (1, 1, 1)
+SEASONAL_ORDER = (1, 1, 1, 12)
+HOLDOUT_MONTHS = 12
+SERIES_WORKERS = int(os.environ.get("SERIES_WORKERS", JOB_CORES))
+# Shortest training series each model is attempted on; shorter ones fall through to the next.
+MIN_SEASONAL_TRAIN = 2 * SEASONAL_ORDER[3]
+MIN_ARIMA_TRAIN = 6
+ARIMA_ORDER_SEARCH = os.environ.get("ARIMA_ORDER_SEARCH", "1") == "1"
+ARIMA_SEARCH_BUDGET = float(os.environ.get("ARIMA_SEARCH_BUDGET", "30"))
+ARIMA_SEARCH_WORKERS = int(os.environ.get("ARIMA_SEARCH_WORKERS", JOB_CORES))
+ARIMA_SEARCH_MAX_PQ = 2
+ARIMA_SEARCH_MAX_SEASONAL_PQ = 1
+ARIMA_SEARCH_TOP_K = 3
+CHEAP_FIT_MAXITER = 25
 
-def analyze_product_categories(df):
+def analyze_product_categories(cube, renderer=inline_renderer, plot_paths=None):
     print("\n--- Analyzing Sales by Product Category ---")
-    df_indexed = df.set_index('transaction_date')
-    category_sales = df_indexed.groupby('category_id')['quantity_sold'].resample('MS').sum()
-    category_map = {101: 'Electronics', 201: 'Home Goods', 301: 'Clothing', 401: 'Books', 501: 'Food'}
-    plt.style.use('seaborn-v0_8-whitegrid')
+    plot_paths = plot_paths or {
+        "category_seasonal": f'{PLOT_FOLDER}/category_seasonal_plot.png',
+        "category_total_sales": f'{PLOT_FOLDER}/category_total_sales_plot.png',
+    }
 
     # Seasonal line
-    fig, ax = plt.subplots(figsize=(15, 7))
-    plot_data = category_sales.unstack(level=0)
-    plot_data.rename(columns=category_map, inplace=True)
-    plot_data.plot(ax=ax, marker='o', linestyle='--')
-    ax.set_title('Monthly Sales by Product Category')
-    plt.tight_layout()
-    plt.savefig(f'{PLOT_FOLDER}/category_seasonal_plot.png')
-    plt.close()
+    plot_data = cube.panel('category_id').rename(columns=CATEGORY_MAP)
+    renderer.submit("category_seasonal", plot_data, plot_paths["category_seasonal"])
 
     # Bar chart
-    total_sales = df_indexed.groupby('category_id')['quantity_sold'].sum().sort_values(ascending=False)
-    total_sales.index = total_sales.index.map(category_map)
-    fig, ax = plt.subplots(figsize=(10, 6))
-    total_sales.plot(kind='bar', ax=ax, color='skyblue')
-    ax.set_title('Total Sales by Product Category')
-    plt.tight_layout()
-    plt.savefig(f'{PLOT_FOLDER}/category_total_sales_plot.png')
-    plt.close()
-
-def create_seasonal_forecast(df):
+    total_sales = cube.group_totals('category_id').sort_values(ascending=False)
+    total_sales.index = total_sales.index.map(lambda category: CATEGORY_MAP.get(category, category))
+    renderer.submit("category_total_sales", total_sales, plot_paths["category_total_sales"])
+
+def create_seasonal_forecast(cube, return_model=False, renderer=inline_renderer,
+                             plot_path=f'{PLOT_FOLDER}/final_seasonal_forecast_plot.png',
+                             order=SARIMAX_ORDER, seasonal_order=SEASONAL_ORDER):
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
     print("\n--- Generating Overall Sales Forecast ---")
-    monthly_sales = df.set_index('transaction_date')['quantity_sold'].resample('MS').sum()
+    monthly_sales = cube.totals()
+    train_data = monthly_sales[:-12]
+    with span("sarimax.fit"):
+        model = SARIMAX(train_data, order=order, seasonal_order=seasonal_order).fit(disp=False)
+    return _score_forecast(model, monthly_sales, return_model, renderer, plot_path)
+
+def update_seasonal_forecast(model, cube, return_model=False, renderer=inline_renderer,
+                             plot_path=f'{PLOT_FOLDER}/final_seasonal_forecast_plot.png'):
+    """Brings a fitted SARIMAX up to date with appended transactions by state-space filtering the new
+    months with its existing parameters, instead of re-estimating it."""
+    print("\n--- Updating Overall Sales Forecast ---")
+    monthly_sales = cube.totals()
     train_data = monthly_sales[:-12]
+    fitted_end = model.fittedvalues.index[-1]
+    known = train_data[:fitted_end]
+    with span("sarimax.update"):
+        if len(known) == model.nobs and np.allclose(known.values, np.asarray(model.model.endog).flatten()):
+            new_months = train_data[fitted_end:].iloc[1:]
+            if len(new_months):
+                model = model.append(new_months)
+        else:
+            # A month the model already saw changed (e.g. late transactions for it): re-filter the whole span.
+            model = model.apply(train_data)
+    return _score_forecast(model, monthly_sales, return_model, renderer, plot_path)
+
+def _score_forecast(model, monthly_sales, return_model, renderer, plot_path):
     test_data = monthly_sales[-12:]
-    model = sm.tsa.statespace.SARIMAX(train_data, order=(1, 1, 1), seasonal_order=(1, 1, 1, 12)).fit(disp=False)
-    pred = model.get_prediction(start=test_data.index.min(), end=test_data.index.max())
-    forecast_values = pred.predicted_mean
-    pred_ci = pred.conf_int()
+    with span("sarimax.predict"):
+        pred = model.get_prediction(start=test_data.index.min(), end=test_data.index.max())
+        forecast_values = pred.predicted_mean
+        pred_ci = pred.conf_int()
 
     # Plot forecast
-    plt.style.use('seaborn-v0_8-whitegrid')
-    fig, ax = plt.subplots(figsize=(15, 7))
-    ax.plot(monthly_sales.index, monthly_sales, label='Historical Sales')
-    ax.plot(test_data.index, test_data, label='Actual Sales', color='royalblue', marker='o')
-    ax.plot(forecast_values.index, forecast_values, label='Forecast', color='forestgreen', linestyle='--')
-    ax.fill_between(pred_ci.index, pred_ci.iloc[:, 0], pred_ci.iloc[:, 1], color='g', alpha=.2)
-    ax.set_title('Sales Forecast vs Actuals')
-    plt.tight_layout()
-    plt.savefig(f'{PLOT_FOLDER}/final_seasonal_forecast_plot.png')
-    plt.close()
+    renderer.submit("arima_forecast", {
+        "monthly_sales": monthly_sales,
+        "test_data": test_data,
+        "forecast_values": forecast_values,
+        "pred_ci": pred_ci,
+    }, plot_path)
 
     metrics = calculate_metrics(test_data, forecast_values)
+    if return_model:
+        return forecast_values, metrics, model
     return forecast_values, metrics
+
+
+# --- Order Selection ---
+def differencing_orders(train, period=SEASONAL_ORDER[3]):
+    """Picks D from the STL seasonal strength and d from repeated ADF tests, once per series.
+    Returns (d, D, differenced), the differenced series being shared by every candidate fit."""
+    from statsmodels.tsa.seasonal import STL
+    from statsmodels.tsa.stattools import adfuller
+
+    values = train.astype("float64")
+    seasonal_diff = 0
+    if len(values) >= 2 * period + 1 and np.ptp(values) > 0:
+        decomposition = STL(values, period=period).fit()
+        remainder = np.var(decomposition.resid)
+        strength = 1 - remainder / max(np.var(decomposition.seasonal + decomposition.resid), 1e-12)
+        # Same threshold as the seasonal-strength test behind nsdiffs in R's forecast package.
+        if strength >= 0.64:
+            seasonal_diff = 1
+            values = values.diff(period).dropna()
+    diff = 0
+    while diff < 2 and len(values) > 10 and np.ptp(values) > 0 and adfuller(values, autolag="AIC")[1] > 0.05:
+        values = values.diff().dropna()
+        diff += 1
+    return diff, seasonal_diff, values
+
+
+def _cheap_aic(differenced, order, seasonal_order):
+    # ARMA on the pre-differenced series with a capped optimiser: only the AIC ranking matters here.
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+    try:
+        model = SARIMAX(
+            differenced, order=order, seasonal_order=seasonal_order,
+            enforce_stationarity=False, enforce_invertibility=False,
+        ).fit(disp=False, maxiter=CHEAP_FIT_MAXITER)
+        return model.aic if np.isfinite(model.aic) else np.inf
+    except Exception:
+        return np.inf
+
+
+def _full_aic(train, order, seasonal_order):
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+    try:
+        model = SARIMAX(train, order=order, seasonal_order=seasonal_order).fit(disp=False)
+        return model.aic if np.isfinite(model.aic) else np.inf
+    except Exception:
+        return np.inf
+
+
+def _map_within(executor, fn, arg_lists, deadline):
+    """Runs fn over arg_lists, inline or on executor, leaving None for calls the deadline cut off."""
+    results = [None] * len(arg_lists)
+    if executor is None:
+        for i, args in enumerate(arg_lists):
+            if time.perf_counter() >= deadline:
+                break
+            results[i] = fn(*args)
+        return results
+    futures = {executor.submit(fn, *args): i for i, args in enumerate(arg_lists)}
+    try:
+        for future in as_completed(futures, timeout=max(0.0, deadline - time.perf_counter())):
+            results[futures[future]] = future.result()
+    except TimeoutError:
+        for future in futures:
+            future.cancel()
+    return results
+
+
+def select_sarimax_order(monthly_sales, budget=ARIMA_SEARCH_BUDGET, n_workers=ARIMA_SEARCH_WORKERS,
+                         holdout=HOLDOUT_MONTHS):
+    """Searches a bounded (p,d,q)(P,D,Q,12) grid on the training part of a monthly series within a
+    time budget in seconds. d and D are chosen once by stationarity tests; every (p,q,P,Q) gets a
+    cheap fit on the shared differenced series, and only the best ARIMA_SEARCH_TOP_K by AIC are
+    fitted in full. Falls back to the fixed orders if nothing finishes in time or every full fit
+    fails."""
+    start = time.perf_counter()
+    deadline = start + budget
+    train = monthly_sales[:-holdout]
+    period = SEASONAL_ORDER[3]
+    diff, seasonal_diff, differenced = differencing_orders(train, period)
+    differenced = differenced.to_numpy()
+
+    # Simplest candidates first, so a budget cut keeps the cheap end of the grid.
+    grid = sorted(
+        itertools.product(range(ARIMA_SEARCH_MAX_PQ + 1), range(ARIMA_SEARCH_MAX_PQ + 1),
+                          range(ARIMA_SEARCH_MAX_SEASONAL_PQ + 1), range(ARIMA_SEARCH_MAX_SEASONAL_PQ + 1)),
+        key=sum,
+    )
+    cheap_args = [(differenced, (p, 0, q), (sp, 0, sq, period)) for p, q, sp, sq in grid]
+    full_args = []
+    n_workers = max(1, min(n_workers, len(grid)))
+    executor = None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        cheap = _map_within(executor, _cheap_aic, cheap_args, deadline)
+        ranked = sorted((aic, i) for i, aic in enumerate(cheap) if aic is not None and np.isfinite(aic))
+        shortlist = [grid[i] for _, i in ranked[:ARIMA_SEARCH_TOP_K]]
+        full_args = [(train, (p, diff, q), (sp, seasonal_diff, sq, period)) for p, q, sp, sq in shortlist]
+        full = _map_within(executor, _full_aic, full_args, deadline)
+    finally:
+        if executor is not None:
+            # Fits still running past the deadline would keep their cores busy until they finish; stop them.
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    scored = [(aic, i) for i, aic in enumerate(full) if aic is not None and np.isfinite(aic)]
+    if scored:
+        aic, best = min(scored)
+        order, seasonal_order = full_args[best][1], full_args[best][2]
+    elif None in full:
+        # No full fit finished in time; trust the cheap ranking, skipping shortlisted orders whose full
+        # fit finished but failed (inf), as those are known not to fit.
+        timed_out = full.index(None)
+        aic, order, seasonal_order = None, full_args[timed_out][1], full_args[timed_out][2]
+    else:
+        # Nothing shortlisted, or every full fit failed.
+        aic, order, seasonal_order = None, SARIMAX_ORDER, SEASONAL_ORDER
+
+    result = {
+        "order": list(order),
+        "seasonal_order": list(seasonal_order),
+        "aic": float(aic) if aic is not None else None,
+        "d": diff,
+        "D": seasonal_diff,
+        "candidates": len(grid),
+        "cheap_fits": sum(aic is not None for aic in cheap),
+        "full_fits": sum(aic is not None for aic in full),
+        "timed_out": None in cheap or None in full,
+        "seconds": time.perf_counter() - start,
+        "workers": n_workers,
+    }
+    print(f"[SARIMAX] Order search picked {tuple(order)}x{tuple(seasonal_order)} (AIC={result['aic']}) from "
+          f"{result['cheap_fits']}/{len(grid)} cheap and {result['full_fits']} full fits in {result['seconds']:.2f}s")
+    return result
+
+
+# --- Multi-Series Forecasting ---
+def _holdout(n_obs):
+    # Keep the original 12-month test window when the series can afford it, otherwise a quarter of it.
+    if n_obs >= HOLDOUT_MONTHS + MIN_SEASONAL_TRAIN:
+        return HOLDOUT_MONTHS
+    return max(1, n_obs // 4)
+
+
+def _fit_one(train, test):
+    """Fits the richest model the training length supports, falling back on short series or fit errors."""
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+    errors = []
+    candidates = []
+    if len(train) >= MIN_SEASONAL_TRAIN:
+        candidates.append(("sarimax_seasonal", SEASONAL_ORDER))
+    if len(train) >= MIN_ARIMA_TRAIN:
+        candidates.append(("sarimax", (0, 0, 0, 0)))
+    for name, seasonal_order in candidates:
+        try:
+            model = SARIMAX(train, order=SARIMAX_ORDER, seasonal_order=seasonal_order).fit(disp=False)
+            pred = model.get_prediction(start=test.index.min(), end=test.index.max())
+            ci = pred.conf_int()
+            return name, pred.predicted_mean, ci.iloc[:, 0], ci.iloc[:, 1], errors
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+    naive = pd.Series(float(train.iloc[-1]), index=test.index)
+    return "naive", naive, naive, naive, errors
+
+
+def _fit_batch(level, months, batch):
+    """Fits every (group, values) series in a batch against the shared month index."""
+    months = pd.DatetimeIndex(months, freq="MS", name="transaction_date")
+    summaries, forecasts, scored = [], [], []
+    for group, values in batch:
+        start = time.perf_counter()
+        series = pd.Series(values, index=months).dropna()
+        summary = {level: group, "n_obs": len(series), "model": "skipped", "holdout": 0,
+                   **dict.fromkeys(METRICS, np.nan), "error": None}
+        if len(series) >= 2:
+            holdout = _holdout(len(series))
+            train, test = series[:-holdout], series[-holdout:]
+            model, forecast, lower, upper, errors = _fit_one(train, test)
+            summary.update(model=model, holdout=holdout, error="; ".join(errors) or None)
+            if holdout >= 2:
+                scored.append((len(summaries), train.to_numpy("float64"), test.to_numpy("float64"),
+                               forecast.to_numpy("float64")))
+            forecasts.append(pd.DataFrame({
+                level: group, "month": test.index, "actual": test.values, "forecast": forecast.values,
+                "lower": lower.values, "upper": upper.values, "model": model,
+            }))
+        summary["fit_seconds"] = time.perf_counter() - start
+        summaries.append(summary)
+
+    # Every scored series of the batch in one metrics pass, NaN-padded to the longest holdout and history.
+    if scored:
+        train = np.full((len(scored), max(len(t) for _, t, _, _ in scored)), np.nan)
+        actual = np.full((len(scored), max(len(a) for _, _, a, _ in scored)), np.nan)
+        predicted = actual.copy()
+        for row, (_, history, test, forecast) in enumerate(scored):
+            train[row, :len(history)] = history
+            actual[row, :len(test)] = test
+            predicted[row, :len(forecast)] = forecast
+        scores = batch_metrics(actual, predicted, train=train)
+        for row, (i, _, _, _) in enumerate(scored):
+            summaries[i].update({name: float(scores[name][row]) for name in METRICS})
+    return summaries, forecasts
+
+
+def forecast_panel(cube, level="category_id", n_workers=SERIES_WORKERS, batch_size=None):
+    """Fits one SARIMAX per group (category_id or product_id) of a MonthlyCube across a process pool.
+    Returns (forecasts, metrics, stats): the holdout forecasts in long format, one row of
+    batch_metrics results per group, and the run's throughput."""
+    start = time.perf_counter()
+    panel = cube.panel(level)
+    series = [(group, panel[group].to_numpy("float64")) for group in panel.columns]
+    months = panel.index.values
+    n_workers = max(1, min(n_workers, len(series)))
+    # Several series per task amortise pickling the batch and the round trip to the worker.
+    batch_size = batch_size or max(1, ceil(len(series) / (n_workers * 4)))
+    batches = [series[i:i + batch_size] for i in range(0, len(series), batch_size)]
+    print(f"\n--- Forecasting {len(series)} series by {level} ({n_workers} workers) ---")
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(_fit_batch, [level] * len(batches), [months] * len(batches), batches))
+    else:
+        results = [_fit_batch(level, months, batch) for batch in batches]
+
+    summaries = [row for batch_summaries, _ in results for row in batch_summaries]
+    frames = [frame for _, batch_forecasts in results for frame in batch_forecasts]
+    metrics = pd.DataFrame(summaries, columns=[level, "n_obs", "model", "holdout", *METRICS, "error", "fit_seconds"])
+    forecasts = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=[level, "month", "actual", "forecast", "lower", "upper", "model"])
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "series": len(series),
+        "seconds": elapsed,
+        "series_per_second": len(series) / elapsed if elapsed > 0 else 0.0,
+        "workers": n_workers,
+        "models": {name: int(count) for name, count in metrics["model"].value_counts().items()},
+    }
+    print(f"[SARIMAX] {stats['series']} series in {elapsed:.2f}s "
+          f"({stats['series_per_second']:.1f} series/s, {n_workers} workers), models: {stats['models']}")
+    return forecasts, metrics, stats
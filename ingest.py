@@ -0,0 +1,447 @@
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from profiling import span
+
+CACHE_FOLDER = os.environ.get("COLUMNAR_CACHE_DIR", "cache/columnar")
+CHUNK_ROWS = int(os.environ.get("INGEST_CHUNK_ROWS", "200000"))
+INDEX_MAX_N = int(os.environ.get("TOPN_INDEX_SIZE", "100"))
+CUBE_CACHE_SIZE = 8
+CACHE_VERSION = 2
+
+COLUMNS = ["transaction_date", "category_id", "product_id", "quantity_sold"]
+DTYPES = {"category_id": "int32", "product_id": "int32", "quantity_sold": "float64"}
+STORED_DTYPES = {"transaction_date": "datetime64[ns]", **DTYPES}
+META_FILE = "meta.json"
+MONTHLY_FILE = "monthly.npz"
+INDEX_FILE = "index.npz"
+
+
+def _cache_dir(filepath):
+    return os.path.join(CACHE_FOLDER, os.path.basename(filepath))
+
+
+def _source_signature(filepath):
+    stat = os.stat(filepath)
+    return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def _read_meta(filepath):
+    try:
+        with open(os.path.join(_cache_dir(filepath), META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    signature = _source_signature(filepath)
+    if meta.get("version") != CACHE_VERSION or any(meta.get(name) != value for name, value in signature.items()):
+        return None
+    return meta
+
+
+def _partial_order(values, n, largest=True):
+    """Indices of the n largest (or smallest) values, sorted, without sorting the whole array."""
+    keys = -values if largest else values
+    if n < len(values):
+        candidates = np.argpartition(keys, n - 1)[:n]
+        return candidates[np.argsort(keys[candidates], kind="stable")]
+    return np.argsort(keys, kind="stable")
+
+
+class _RowExtremes:
+    """Running top-k and bottom-k rows by quantity for every month, merged chunk by chunk."""
+
+    def __init__(self, k=INDEX_MAX_N):
+        self.k = k
+        self.top = {}
+        self.bottom = {}
+
+    @classmethod
+    def from_arrays(cls, stored, k=INDEX_MAX_N):
+        """Rebuilds the running extremes from a saved index so new chunks can be merged in."""
+        extremes = cls(k)
+        for name, kept in (("top", extremes.top), ("bottom", extremes.bottom)):
+            months, rows, quantities = stored[f"{name}_month"], stored[f"{name}_row"], stored[f"{name}_quantity"]
+            for month in np.unique(months):
+                mask = months == month
+                kept[month] = (rows[mask], quantities[mask])
+        return extremes
+
+    def _merge(self, kept, month, row_ids, quantities, largest):
+        if month in kept:
+            row_ids = np.concatenate([kept[month][0], row_ids])
+            quantities = np.concatenate([kept[month][1], quantities])
+        keep = _partial_order(quantities, self.k, largest)[:self.k]
+        kept[month] = (row_ids[keep], quantities[keep])
+
+    def add(self, months, row_ids, quantities):
+        order = np.argsort(months, kind="stable")
+        unique_months, starts = np.unique(months[order], return_index=True)
+        for month, group in zip(unique_months, np.split(order, starts[1:])):
+            self._merge(self.top, month, row_ids[group], quantities[group], largest=True)
+            self._merge(self.bottom, month, row_ids[group], quantities[group], largest=False)
+
+    def arrays(self):
+        stored = {}
+        for name, kept in (("top", self.top), ("bottom", self.bottom)):
+            months = sorted(kept)
+            stored[f"{name}_month"] = np.concatenate(
+                [np.full(len(kept[m][0]), m) for m in months]) if months else np.empty(0, "datetime64[ns]")
+            stored[f"{name}_row"] = np.concatenate([kept[m][0] for m in months]) if months else np.empty(0, "int64")
+            stored[f"{name}_quantity"] = np.concatenate([kept[m][1] for m in months]) if months else np.empty(0)
+        return stored
+
+
+def _save_monthly(path, monthly):
+    if monthly is None:
+        monthly = pd.Series([], dtype="float64", index=pd.MultiIndex.from_arrays([[], [], []]))
+    monthly.index.names = ["month", "category_id", "product_id"]
+    monthly = monthly.reset_index()
+    np.savez(
+        path,
+        month=monthly["month"].to_numpy("datetime64[ns]"),
+        category_id=monthly["category_id"].to_numpy("int32"),
+        product_id=monthly["product_id"].to_numpy("int32"),
+        quantity_sold=monthly["quantity_sold"].to_numpy("float64"),
+    )
+
+
+def _replace_file(path, write, mode="wb"):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def ingest_csv(filepath, chunksize=CHUNK_ROWS):
+    """Streams a transactions CSV in chunks, writing one raw binary file per column and the
+    month x category x product totals, so memory is bounded by the chunk size and group count."""
+    cache_dir = _cache_dir(filepath)
+    staging = f"{cache_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(staging)
+    signature = _source_signature(filepath)
+    monthly = None
+    extremes = _RowExtremes()
+    rows = 0
+    min_date = max_date = None
+    columns = {}
+    try:
+        try:
+            for col in COLUMNS:
+                columns[col] = open(os.path.join(staging, f"{col}.bin"), "wb")
+            chunks = pd.read_csv(filepath, usecols=COLUMNS, dtype=DTYPES, parse_dates=["transaction_date"],
+                                 chunksize=chunksize)
+            for chunk in chunks:
+                dates = chunk["transaction_date"].values.astype("datetime64[ns]")
+                for col in COLUMNS:
+                    values = dates if col == "transaction_date" else chunk[col].to_numpy(STORED_DTYPES[col])
+                    values.tofile(columns[col])
+
+                months = dates.astype("datetime64[M]").astype("datetime64[ns]")
+                grouped = chunk.groupby([months, "category_id", "product_id"])["quantity_sold"].sum()
+                monthly = grouped if monthly is None else monthly.add(grouped, fill_value=0)
+                extremes.add(months, np.arange(rows, rows + len(chunk)), chunk["quantity_sold"].to_numpy("float64"))
+
+                rows += len(chunk)
+                if len(chunk):
+                    min_date = dates.min() if min_date is None else min(min_date, dates.min())
+                    max_date = dates.max() if max_date is None else max(max_date, dates.max())
+        finally:
+            for f in columns.values():
+                f.close()
+
+        _save_monthly(os.path.join(staging, MONTHLY_FILE), monthly)
+        np.savez(os.path.join(staging, INDEX_FILE), **extremes.arrays())
+
+        meta = {
+            "version": CACHE_VERSION,
+            **signature,
+            "rows": rows,
+            "columns": STORED_DTYPES,
+            "min_date": str(min_date) if min_date is not None else None,
+            "max_date": str(max_date) if max_date is not None else None,
+        }
+        with open(os.path.join(staging, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(staging, cache_dir)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return meta
+
+
+def append_csv(filepath, new_path, chunksize=CHUNK_ROWS):
+    """Appends the transactions in new_path to an uploaded CSV and folds them into its columnar
+    cache and monthly totals, instead of re-ingesting the whole history. Returns the new metadata."""
+    meta = ensure_cache(filepath)
+    cache_dir = _cache_dir(filepath)
+    with open(filepath, "rb") as f:
+        header = f.readline().strip()
+    with open(new_path, "rb") as f:
+        new_header = f.readline().strip()
+    if new_header != header:
+        raise ValueError("Appended file must have the same columns as the original upload.")
+
+    with np.load(os.path.join(cache_dir, MONTHLY_FILE)) as stored:
+        monthly = pd.Series(stored["quantity_sold"], index=pd.MultiIndex.from_arrays(
+            [stored["month"], stored["category_id"], stored["product_id"]]), name="quantity_sold")
+    with np.load(os.path.join(cache_dir, INDEX_FILE)) as stored:
+        extremes = _RowExtremes.from_arrays(stored)
+    rows = meta["rows"]
+    min_date = np.datetime64(meta["min_date"]) if meta["min_date"] else None
+    max_date = np.datetime64(meta["max_date"]) if meta["max_date"] else None
+
+    columns = {}
+    try:
+        for col in COLUMNS:
+            # Drop bytes left past meta["rows"] by an earlier append that failed before updating the metadata.
+            columns[col] = open(os.path.join(cache_dir, f"{col}.bin"), "r+b" if rows else "wb")
+            columns[col].truncate(rows * np.dtype(STORED_DTYPES[col]).itemsize)
+            columns[col].seek(0, os.SEEK_END)
+        chunks = pd.read_csv(new_path, usecols=COLUMNS, dtype=DTYPES, parse_dates=["transaction_date"],
+                             chunksize=chunksize)
+        for chunk in chunks:
+            dates = chunk["transaction_date"].values.astype("datetime64[ns]")
+            for col in COLUMNS:
+                values = dates if col == "transaction_date" else chunk[col].to_numpy(STORED_DTYPES[col])
+                values.tofile(columns[col])
+
+            months = dates.astype("datetime64[M]").astype("datetime64[ns]")
+            grouped = chunk.groupby([months, "category_id", "product_id"])["quantity_sold"].sum()
+            grouped.index.names = monthly.index.names
+            monthly = monthly.add(grouped, fill_value=0)
+            extremes.add(months, np.arange(rows, rows + len(chunk)), chunk["quantity_sold"].to_numpy("float64"))
+
+            rows += len(chunk)
+            if len(chunk):
+                min_date = dates.min() if min_date is None else min(min_date, dates.min())
+                max_date = dates.max() if max_date is None else max(max_date, dates.max())
+    finally:
+        for f in columns.values():
+            f.close()
+
+    _replace_file(os.path.join(cache_dir, MONTHLY_FILE), lambda f: _save_monthly(f, monthly.sort_index()))
+    _replace_file(os.path.join(cache_dir, INDEX_FILE), lambda f: np.savez(f, **extremes.arrays()))
+
+    with open(filepath, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        with open(new_path, "rb") as new:
+            new.readline()
+            shutil.copyfileobj(new, f)
+
+    # The metadata goes last: until it names the grown CSV, readers fall back to a full re-ingest.
+    meta.update(_source_signature(filepath), rows=rows,
+                min_date=str(min_date) if min_date is not None else None,
+                max_date=str(max_date) if max_date is not None else None)
+    _replace_file(os.path.join(cache_dir, META_FILE), lambda f: json.dump(meta, f), mode="w")
+    return meta
+
+
+def ensure_cache(filepath):
+    """Returns the columnar cache metadata for a CSV, ingesting it first if the cache is missing or stale."""
+    meta = _read_meta(filepath)
+    if meta is None:
+        with span("ingest.csv"):
+            meta = ingest_csv(filepath)
+    return meta
+
+
+def copy_cache(filepath, new_filepath):
+    """Gives new_filepath, a copy of filepath with the same size and mtime, its own copy of the cache."""
+    if _read_meta(filepath) is not None:
+        shutil.copytree(_cache_dir(filepath), _cache_dir(new_filepath), dirs_exist_ok=True)
+
+
+def move_cache(filepath, new_filepath):
+    """Moves a CSV's cache along with the CSV itself."""
+    if os.path.isdir(_cache_dir(filepath)):
+        shutil.rmtree(_cache_dir(new_filepath), ignore_errors=True)
+        os.replace(_cache_dir(filepath), _cache_dir(new_filepath))
+
+
+def remove_cache(filepath):
+    shutil.rmtree(_cache_dir(filepath), ignore_errors=True)
+
+
+def cached_summary(filepath):
+    """Returns the cache metadata if the CSV has already been ingested, without triggering ingestion."""
+    return _read_meta(filepath)
+
+
+def read_transactions(filepath, columns=COLUMNS):
+    """Loads transaction rows from memory-mapped columns instead of re-parsing the CSV."""
+    meta = ensure_cache(filepath)
+    data = {}
+    for col in columns:
+        dtype = np.dtype(meta["columns"][col])
+        if meta["rows"] == 0:
+            data[col] = np.empty(0, dtype=dtype)
+        else:
+            path = os.path.join(_cache_dir(filepath), f"{col}.bin")
+            data[col] = np.memmap(path, dtype=dtype, mode="r", shape=(meta["rows"],))
+    return pd.DataFrame(data)
+
+
+def read_monthly(filepath):
+    """Loads the month x category x product quantity totals computed at ingestion."""
+    ensure_cache(filepath)
+    with np.load(os.path.join(_cache_dir(filepath), MONTHLY_FILE)) as stored:
+        return pd.DataFrame({name: stored[name] for name in stored.files})
+
+
+# --- Monthly Cube ---
+class MonthlyCube:
+    """Month x category x product quantity totals with integer-coded axes, the one aggregate every
+    pipeline stage and the /filter views read. It holds one entry per (month, category, product) that
+    had sales; totals, panels and group sums are derived with bincount over the codes and memoized, so
+    callers share them and must treat them as read-only."""
+
+    LEVELS = ("category_id", "product_id")
+
+    def __init__(self, month, category_id, product_id, quantity):
+        month = np.asarray(month, dtype="datetime64[M]")
+        if len(month):
+            self.months = pd.date_range(month.min().astype("datetime64[ns]"), month.max().astype("datetime64[ns]"),
+                                        freq="MS", name="transaction_date")
+            self.month_code = (month - month.min()).astype("int32")
+        else:
+            self.months = pd.DatetimeIndex([], freq="MS", name="transaction_date")
+            self.month_code = np.empty(0, dtype="int32")
+        self.labels, self.codes = {}, {}
+        for level, values in zip(self.LEVELS, (category_id, product_id)):
+            labels, codes = np.unique(np.asarray(values, dtype="int32"), return_inverse=True)
+            self.labels[level], self.codes[level] = labels, codes.astype("int32")
+        self.quantity = np.asarray(quantity, dtype="float64")
+        self._views = {}
+
+    @classmethod
+    def from_monthly(cls, monthly):
+        """From read_monthly output."""
+        return cls(monthly["month"].to_numpy(), monthly["category_id"].to_numpy(),
+                   monthly["product_id"].to_numpy(), monthly["quantity_sold"].to_numpy())
+
+    @classmethod
+    def from_transactions(cls, df):
+        """From raw transaction rows, in one groupby over integer month, category and product keys."""
+        months = df["transaction_date"].to_numpy("datetime64[ns]").astype("datetime64[M]").astype("datetime64[ns]")
+        grouped = df["quantity_sold"].groupby(
+            [months, df["category_id"].to_numpy("int32"), df["product_id"].to_numpy("int32")]).sum()
+        return cls(*(grouped.index.get_level_values(i).to_numpy() for i in range(3)), grouped.to_numpy())
+
+    def _memo(self, key, build):
+        if key not in self._views:
+            self._views[key] = build()
+        return self._views[key]
+
+    def totals(self):
+        """The overall monthly series, zero-filled, matching resample('MS').sum() of the raw rows."""
+        return self._memo("totals", lambda: pd.Series(
+            np.bincount(self.month_code, weights=self.quantity, minlength=len(self.months)),
+            index=self.months, name="quantity_sold"))
+
+    def panel(self, level="category_id"):
+        """One month x group column per category or product. Months before a group's first sale are
+        NaN; gaps after it are zero, like resample('MS').sum() per group."""
+        return self._memo(("panel", level), lambda: self._panel(level))
+
+    def _panel(self, level):
+        n_months, labels, codes = len(self.months), self.labels[level], self.codes[level]
+        values = np.bincount(self.month_code * len(labels) + codes, weights=self.quantity,
+                             minlength=n_months * len(labels)).astype("float64").reshape(n_months, len(labels))
+        first = np.full(len(labels), n_months, dtype="int32")
+        np.minimum.at(first, codes, self.month_code)
+        values[np.arange(n_months)[:, np.newaxis] < first] = np.nan
+        return pd.DataFrame(values, index=self.months, columns=pd.Index(labels, name=level))
+
+    def group_totals(self, *levels):
+        """Total quantity per group, or per combination of groups, over the whole cube."""
+        return self._memo(("group_totals", levels), lambda: self._group_totals(levels))
+
+    def _group_totals(self, levels):
+        combined = np.zeros(len(self.quantity), dtype="int64")
+        for level in levels:
+            combined = combined * len(self.labels[level]) + self.codes[level]
+        present, inverse = np.unique(combined, return_inverse=True)
+        sums = np.bincount(inverse, weights=self.quantity, minlength=len(present))
+        labels = []
+        for level in reversed(levels):
+            labels.append(self.labels[level][present % len(self.labels[level])])
+            present = present // len(self.labels[level])
+        index = pd.MultiIndex.from_arrays(labels[::-1], names=levels) if len(levels) > 1 \
+            else pd.Index(labels[0], name=levels[0])
+        return pd.Series(sums, index=index, name="quantity_sold")
+
+    def between(self, start=None, end=None):
+        """The sub-cube of the months from start to end ("YYYY-MM"), inclusive."""
+        months = self.months.values[self.month_code]
+        mask = _month_mask(months, start, end)
+        return MonthlyCube(months[mask], self.labels["category_id"][self.codes["category_id"][mask]],
+                           self.labels["product_id"][self.codes["product_id"][mask]], self.quantity[mask])
+
+
+_cubes = {}
+
+
+def load_cube(filepath):
+    """The MonthlyCube of an uploaded CSV, ingesting it first if needed. The last few cubes are kept
+    in memory, keyed by the cached file's signature, so repeated /filter views reuse them."""
+    meta = ensure_cache(filepath)
+    key = (os.path.abspath(filepath), meta["rows"], meta["source_size"], meta["source_mtime"])
+    cube = _cubes.pop(key, None) or MonthlyCube.from_monthly(read_monthly(filepath))
+    _cubes[key] = cube
+    while len(_cubes) > CUBE_CACHE_SIZE:
+        del _cubes[next(iter(_cubes))]
+    return cube
+
+
+def _month_mask(months, start=None, end=None):
+    mask = np.ones(len(months), dtype=bool)
+    if start:
+        mask &= months >= np.datetime64(start, "M").astype("datetime64[ns]")
+    if end:
+        mask &= months <= np.datetime64(end, "M").astype("datetime64[ns]")
+    return mask
+
+
+def _read_rows(filepath, row_ids):
+    meta = ensure_cache(filepath)
+    data = {}
+    for col in COLUMNS:
+        path = os.path.join(_cache_dir(filepath), f"{col}.bin")
+        column = np.memmap(path, dtype=np.dtype(meta["columns"][col]), mode="r", shape=(meta["rows"],))
+        data[col] = np.asarray(column[row_ids])
+    return pd.DataFrame(data, index=row_ids)
+
+
+def top_n(filepath, n=10, kind="most_sold", group_by="rows", start=None, end=None):
+    """Answers the /filter views from the ingestion index: the n most or least sold rows (or, with
+    group_by="product_id", products) between the start and end months ("YYYY-MM"), without rescanning the file."""
+    largest = kind == "most_sold"
+    if group_by == "product_id":
+        totals = load_cube(filepath).between(start, end).group_totals("product_id", "category_id")
+        return totals.iloc[_partial_order(totals.to_numpy(), n, largest)].reset_index()
+
+    # Per-month extremes hold the top/bottom INDEX_MAX_N rows, so any month range's top n is among them.
+    ensure_cache(filepath)
+    name = "top" if largest else "bottom"
+    with np.load(os.path.join(_cache_dir(filepath), INDEX_FILE)) as index:
+        mask = _month_mask(index[f"{name}_month"], start, end)
+        row_ids, quantities = index[f"{name}_row"][mask], index[f"{name}_quantity"][mask]
+    pick = _partial_order(quantities, min(n, INDEX_MAX_N), largest)
+    return _read_rows(filepath, row_ids[pick])
+
+
+def category_breakdown(filepath, start=None, end=None):
+    """Total quantity per category between the start and end months, from the monthly aggregates."""
+    totals = load_cube(filepath).between(start, end).group_totals("category_id")
+    return totals.sort_values(ascending=False).reset_index()
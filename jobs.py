@@ -0,0 +1,503 @@
+import json
+import multiprocessing
+import os
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from backtest import BACKTEST_HORIZON, BACKTEST_STEP, run_backtest
+from ingest import append_csv, load_cube
+from forecast import (
+    ARIMA_ORDER_SEARCH, ARIMA_SEARCH_BUDGET, SARIMAX_ORDER, SEASONAL_ORDER, analyze_product_categories,
+    create_seasonal_forecast, forecast_panel, select_sarimax_order, update_seasonal_forecast
+)
+from plots import PlotRenderer, prune_job_plots, prune_plot_cache, publish_plot
+from profiling import PROFILE_JOBS, Profile, recorder
+from profiling import flush as flush_metrics
+from pso_lstm import (
+    FINAL_EPOCHS, GLOBAL_N_STEPS, GLOBAL_UNITS, LSTM_BOUNDS, PSO_EPOCHS, fine_tune_lstm_forecast,
+    run_global_lstm_forecast, run_lstm_pso_forecast
+)
+from registry import ModelRegistry, file_hash, model_key
+from upload_store import UploadStore
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "1"))
+JOB_BACKEND_URL = os.environ.get("JOB_BACKEND_URL", "")
+JOB_TTL_SECONDS = 24 * 60 * 60
+ACTIVE_STATUSES = ("queued", "running")
+# With JOB_PRELOAD=1 the job worker is started with the web process and imports the forecasting
+# stack up front, so the first upload does not wait for TensorFlow and the web process never loads it.
+JOB_PRELOAD = os.environ.get("JOB_PRELOAD", "0") == "1"
+PRELOAD_MODULES = ("keras", "sklearn.metrics", "sklearn.preprocessing", "statsmodels.tsa.statespace.sarimax",
+                   "statsmodels.tsa.seasonal", "matplotlib.figure")
+APPEND_FOLDER = "cache/appends"
+# An appended update whose MAPE exceeds DRIFT_RATIO x the stored model's is retrained from scratch.
+DRIFT_RATIO = float(os.environ.get("DRIFT_RATIO", "1.5"))
+DRIFT_MIN_MAPE = 1.0
+# Folds of the backtest stage every forecast and append job runs; fewer than a standalone
+# run_backtest's BACKTEST_FOLDS to keep uploads cheap. 0 skips the stage's fits entirely.
+JOB_BACKTEST_FOLDS = int(os.environ.get("JOB_BACKTEST_FOLDS", "3"))
+
+STATIC_FOLDER = "static"
+PLOT_FILES = {
+    "category_seasonal": "category_seasonal_plot.png",
+    "category_total_sales": "category_total_sales_plot.png",
+    "arima_forecast": "final_seasonal_forecast_plot.png",
+    "lstm_forecast": "lstm_pso_forecast.png",
+}
+# Part of every registry key, so changing how models are fitted never serves stale entries.
+MODEL_CONFIG = {
+    "sarimax_order": SARIMAX_ORDER,
+    "seasonal_order": SEASONAL_ORDER,
+    "order_search": {"enabled": ARIMA_ORDER_SEARCH, "budget": ARIMA_SEARCH_BUDGET},
+    "lstm_bounds": LSTM_BOUNDS,
+    "pso_epochs": PSO_EPOCHS,
+    "final_epochs": FINAL_EPOCHS,
+    "group_level": "category_id",
+    "global_lstm": {"level": "product_id", "n_steps": GLOBAL_N_STEPS, "units": GLOBAL_UNITS},
+    "backtest": {"folds": JOB_BACKTEST_FOLDS, "horizon": BACKTEST_HORIZON, "step": BACKTEST_STEP},
+}
+
+registry = ModelRegistry()
+
+
+# --- Job Stores ---
+class LocalJobStore:
+    """Job state shared between the web process and its worker pool, no broker needed."""
+
+    def __init__(self):
+        self._manager = multiprocessing.get_context("spawn").Manager()
+        self._jobs = self._manager.dict()
+        # Dedupe key -> id of the job that holds it.
+        self._claims = self._manager.dict()
+
+    def __getstate__(self):
+        # Only the dict proxies travel to the workers; the manager stays with its owner.
+        return {"_manager": None, "_jobs": self._jobs, "_claims": self._claims}
+
+    def get(self, job_id):
+        record = self._jobs.get(job_id)
+        return dict(record) if record is not None else None
+
+    def set(self, job_id, record):
+        self._jobs[job_id] = record
+
+    def update(self, job_id, **fields):
+        record = self.get(job_id) or {"id": job_id}
+        record.update(fields)
+        self.set(job_id, record)
+        return record
+
+    def delete(self, job_id):
+        self._jobs.pop(job_id, None)
+
+    def _active(self, job_id):
+        record = self.get(job_id)
+        return record is not None and record.get("status") in ACTIVE_STATUSES
+
+    def claim(self, key, job_id):
+        """Makes job_id the holder of key unless a queued or running job already holds it; returns the
+        holder's id. A finished or vanished holder is taken over."""
+        holder = self._claims.setdefault(key, job_id)
+        if holder != job_id and not self._active(holder):
+            self._claims[key] = holder = job_id
+        return holder
+
+    def release(self, key, job_id):
+        if self._claims.get(key) == job_id:
+            self._claims.pop(key, None)
+
+
+class RedisJobStore(LocalJobStore):
+    """Job state kept in a Redis-compatible server so every web worker sees it."""
+
+    def __init__(self, url, client=None):
+        self.url = url
+        self._client = client
+
+    def __getstate__(self):
+        return {"url": self.url, "_client": None}
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def get(self, job_id):
+        raw = self.client.get(f"job:{job_id}")
+        return json.loads(raw) if raw else None
+
+    def set(self, job_id, record):
+        self.client.set(f"job:{job_id}", json.dumps(record), ex=JOB_TTL_SECONDS)
+
+    def delete(self, job_id):
+        self.client.delete(f"job:{job_id}")
+
+    def claim(self, key, job_id):
+        if self.client.set(f"claim:{key}", job_id, nx=True, ex=JOB_TTL_SECONDS):
+            return job_id
+        holder = self.client.get(f"claim:{key}")
+        holder = holder.decode() if holder else None
+        if holder is not None and holder != job_id and self._active(holder):
+            return holder
+        self.client.set(f"claim:{key}", job_id, ex=JOB_TTL_SECONDS)
+        return job_id
+
+    def release(self, key, job_id):
+        holder = self.client.get(f"claim:{key}")
+        if holder is not None and holder.decode() == job_id:
+            self.client.delete(f"claim:{key}")
+
+
+def create_job_store(url=JOB_BACKEND_URL):
+    """Returns a Redis-backed store when a URL is configured, otherwise a local one."""
+    if url:
+        return RedisJobStore(url)
+    return LocalJobStore()
+
+
+# --- Pipeline ---
+@contextmanager
+def _stage(store, job_id, stages, name):
+    store.update(job_id, status="running", stage=name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        recorder.record(f"pipeline.{name}", elapsed)
+        stages[name] = round(elapsed, 3)
+        store.update(job_id, stages=stages)
+
+
+def _as_floats(metrics):
+    return {name: float(value) for name, value in metrics.items()}
+
+
+def _records(frame):
+    # NaN is not valid JSON; None survives both the job store and the registry manifest.
+    return frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+
+def _median(values):
+    median = values.median()
+    return None if pd.isna(median) else float(median)
+
+
+def plot_paths(plot_id):
+    """Plot paths relative to the static folder, one folder per job so concurrent uploads never clash."""
+    return {name: f"plots/{plot_id}/{filename}" for name, filename in PLOT_FILES.items()}
+
+
+def cached_forecast(filepath, plot_id, data_hash=None):
+    """Returns the registry key for a file and its stored pipeline result, or None when it was never forecast."""
+    key = model_key(data_hash or file_hash(filepath), MODEL_CONFIG)
+    manifest = registry.load(key)
+    if manifest is None:
+        return key, None
+    paths = plot_paths(plot_id)
+    for name, plot in paths.items():
+        publish_plot(manifest["plots"][name], os.path.join(STATIC_FOLDER, plot))
+    return key, {"plots": list(paths.values()), **manifest["metrics"], "model_key": key, "cached": True}
+
+
+def run_forecast_pipeline(job_id, filepath, store):
+    """Runs the upload forecast pipeline in a worker process, recording progress in the store."""
+    stages = {}
+    store.update(job_id, status="running", started_at=time.time())
+    try:
+        prune_job_plots()
+        prune_plot_cache()
+        with _stage(store, job_id, stages, "registry_lookup"):
+            key, result = cached_forecast(filepath, job_id)
+        if result is not None:
+            return store.update(job_id, status="finished", stage=None, result=result, finished_at=time.time())
+
+        with _stage(store, job_id, stages, "ingest"):
+            # Every stage below reads views of this one aggregate; the raw rows are never loaded.
+            cube = load_cube(filepath)
+
+        # Figures render in the plot pool while the models train.
+        renderer = PlotRenderer()
+        paths = plot_paths(job_id)
+        static_paths = {name: os.path.join(STATIC_FOLDER, plot) for name, plot in paths.items()}
+        with _stage(store, job_id, stages, "category_analysis"):
+            analyze_product_categories(cube, renderer=renderer, plot_paths=static_paths)
+        order_search = None
+        if MODEL_CONFIG["order_search"]["enabled"]:
+            with _stage(store, job_id, stages, "arima_order_search"):
+                order_search = select_sarimax_order(cube.totals())
+        with _stage(store, job_id, stages, "arima_forecast"):
+            forecast_results, arima_metrics, arima_model = create_seasonal_forecast(
+                cube, return_model=True, renderer=renderer, plot_path=static_paths["arima_forecast"],
+                order=tuple(order_search["order"]) if order_search else SARIMAX_ORDER,
+                seasonal_order=tuple(order_search["seasonal_order"]) if order_search else SEASONAL_ORDER,
+            )
+        with _stage(store, job_id, stages, "category_forecasts"):
+            _, category_metrics, category_stats = forecast_panel(cube, level=MODEL_CONFIG["group_level"])
+        with _stage(store, job_id, stages, "lstm_pso_forecast"):
+            lstm_metrics, lstm_model = run_lstm_pso_forecast(
+                cube.totals(), return_model=True, renderer=renderer, plot_path=static_paths["lstm_forecast"]
+            )
+        with _stage(store, job_id, stages, "product_forecasts"):
+            product_metrics, product_stats = run_global_lstm_forecast(
+                cube.panel(MODEL_CONFIG["global_lstm"]["level"])
+            )
+        with _stage(store, job_id, stages, "backtest"):
+            backtest = _backtest(cube, arima_model, lstm_model)
+        with _stage(store, job_id, stages, "render_plots"):
+            renderer.join()
+
+        metrics = {
+            "arima": _as_floats(arima_metrics),
+            "lstm": _as_floats(lstm_metrics),
+            "categories": _records(category_metrics),
+            "category_stats": category_stats,
+            "products": _records(product_metrics),
+            "product_stats": {**product_stats, "median_mape": _median(product_metrics["MAPE"])},
+            "arima_order": order_search,
+            "backtest": backtest,
+        }
+        result = _save_forecast(store, job_id, stages, key, metrics, forecast_results, arima_model, lstm_model, paths)
+        return store.update(job_id, status="finished", stage=None, result=result, finished_at=time.time())
+    except Exception as e:
+        return store.update(
+            job_id, status="failed", error=str(e), traceback=traceback.format_exc(), finished_at=time.time()
+        )
+
+
+def _backtest(cube, arima_model, lstm_model):
+    """Rolling-origin evaluation of the fitted model structure: the SARIMAX orders in use and the
+    LSTM's PSO-chosen units and n_steps."""
+    return run_backtest(
+        cube.totals(), **MODEL_CONFIG["backtest"], order=arima_model.model.order,
+        seasonal_order=arima_model.model.seasonal_order,
+        lstm={"units": lstm_model["units"], "n_steps": lstm_model["n_steps"]},
+    )
+
+
+def _save_forecast(store, job_id, stages, key, metrics, forecast_results, arima_model, lstm_model, paths):
+    with _stage(store, job_id, stages, "registry_save"):
+        registry.save(
+            key,
+            metrics=metrics,
+            config=MODEL_CONFIG,
+            forecast={date.strftime("%Y-%m-%d"): float(value) for date, value in forecast_results.items()},
+            sarimax=arima_model,
+            lstm=lstm_model,
+            plots={name: os.path.join(STATIC_FOLDER, plot) for name, plot in paths.items()},
+        )
+    return {"plots": list(paths.values()), **metrics, "model_key": key, "cached": False}
+
+
+def _drifted(metrics, stored):
+    """True when the updated model's MAPE is over DRIFT_RATIO times the stored one's."""
+    new, old = metrics.get("MAPE"), stored.get("MAPE")
+    if new is None or old is None or not np.isfinite(new) or not np.isfinite(old):
+        return False
+    return new > DRIFT_RATIO * max(old, DRIFT_MIN_MAPE)
+
+
+def run_append_pipeline(job_id, name, new_path, username, store):
+    """Folds transactions newly appended by username into the upload called name and updates its stored
+    models in place: the SARIMAX is re-filtered and the LSTM fine-tuned. A model is only retrained from
+    scratch (PSO included for the LSTM) when drift is detected or nothing is stored for the previous data."""
+    stages = {}
+    store.update(job_id, status="running", started_at=time.time())
+    uploads = UploadStore()
+    try:
+        prune_job_plots()
+        prune_plot_cache()
+        with _stage(store, job_id, stages, "ingest_append"):
+            try:
+                # Stored uploads are immutable: the append goes to a copy that becomes the name's new content.
+                filepath, previous_hash = uploads.checkout(name)
+                try:
+                    append_csv(filepath, new_path)
+                except Exception:
+                    uploads.discard(filepath)
+                    raise
+                data_hash, filepath = uploads.commit(name, filepath, previous_hash, username)
+            finally:
+                os.remove(new_path)
+            cube = load_cube(filepath)
+        with _stage(store, job_id, stages, "registry_lookup"):
+            previous_key = model_key(previous_hash, MODEL_CONFIG)
+            manifest = registry.load(previous_key)
+        if manifest is None:
+            print("[APPEND] No stored models for the previous data; running the full pipeline")
+            return run_forecast_pipeline(job_id, filepath, store)
+        key = model_key(data_hash, MODEL_CONFIG)
+        stored = manifest["metrics"]
+        drift = {"arima": False, "lstm": False}
+
+        renderer = PlotRenderer()
+        paths = plot_paths(job_id)
+        static_paths = {name: os.path.join(STATIC_FOLDER, plot) for name, plot in paths.items()}
+        with _stage(store, job_id, stages, "category_analysis"):
+            analyze_product_categories(cube, renderer=renderer, plot_paths=static_paths)
+        with _stage(store, job_id, stages, "arima_update"):
+            forecast_results, arima_metrics, arima_model = update_seasonal_forecast(
+                registry.load_sarimax(previous_key), cube, return_model=True, renderer=renderer,
+                plot_path=static_paths["arima_forecast"]
+            )
+        if _drifted(arima_metrics, stored["arima"]):
+            drift["arima"] = True
+            with _stage(store, job_id, stages, "arima_forecast"):
+                forecast_results, arima_metrics, arima_model = create_seasonal_forecast(
+                    cube, return_model=True, renderer=renderer, plot_path=static_paths["arima_forecast"],
+                    order=arima_model.model.order, seasonal_order=arima_model.model.seasonal_order
+                )
+        with _stage(store, job_id, stages, "category_forecasts"):
+            _, category_metrics, category_stats = forecast_panel(cube, level=MODEL_CONFIG["group_level"])
+
+        series = cube.totals()
+        lstm_model = registry.load_lstm(previous_key)
+        if lstm_model is not None:
+            with _stage(store, job_id, stages, "lstm_fine_tune"):
+                lstm_metrics, lstm_model = fine_tune_lstm_forecast(
+                    series, lstm_model, baseline_epochs=stored["lstm"].get("Baseline Epochs"), return_model=True,
+                    renderer=renderer, plot_path=static_paths["lstm_forecast"]
+                )
+        if lstm_model is None or _drifted(lstm_metrics, stored["lstm"]):
+            drift["lstm"] = True
+            with _stage(store, job_id, stages, "lstm_pso_forecast"):
+                lstm_metrics, lstm_model = run_lstm_pso_forecast(
+                    series, return_model=True, renderer=renderer, plot_path=static_paths["lstm_forecast"]
+                )
+        with _stage(store, job_id, stages, "backtest"):
+            backtest = _backtest(cube, arima_model, lstm_model)
+        with _stage(store, job_id, stages, "render_plots"):
+            renderer.join()
+        print(f"[APPEND] Updated {previous_key} -> {key}, drift: {drift}")
+
+        metrics = {
+            **stored,
+            "arima": _as_floats(arima_metrics),
+            "lstm": _as_floats(lstm_metrics),
+            "categories": _records(category_metrics),
+            "category_stats": category_stats,
+            "drift": drift,
+            "backtest": backtest,
+            "updated_from": previous_key,
+        }
+        result = _save_forecast(store, job_id, stages, key, metrics, forecast_results, arima_model, lstm_model, paths)
+        return store.update(job_id, status="finished", stage=None, result=result, finished_at=time.time())
+    except Exception as e:
+        return store.update(
+            job_id, status="failed", error=str(e), traceback=traceback.format_exc(), finished_at=time.time()
+        )
+
+
+# --- Queue ---
+def _run_job(fn, job_id, *args):
+    # Worker-side wrapper: optional cProfile capture, and the worker's spans reach /metrics right away.
+    try:
+        if PROFILE_JOBS:
+            with Profile(f"job-{job_id}"):
+                return fn(job_id, *args)
+        return fn(job_id, *args)
+    finally:
+        flush_metrics()
+
+
+def _preload_worker(modules):
+    import importlib
+    start = time.perf_counter()
+    for module in modules:
+        importlib.import_module(module)
+    print(f"[JOBS] Worker {os.getpid()} preloaded {len(modules)} modules in {time.perf_counter() - start:.1f}s")
+
+
+class JobQueue:
+    """Process pool executing pipeline jobs outside the web request."""
+
+    def __init__(self, store=None, max_workers=JOB_WORKERS, on_done=None, preload=JOB_PRELOAD):
+        self._store = store
+        self._executor = None
+        self.max_workers = max_workers
+        self.on_done = on_done
+        self.preload = preload
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = create_job_store()
+        return self._store
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # Spawned workers never inherit a half-initialised TensorFlow runtime from the web process.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_preload_worker if self.preload else None,
+                initargs=(PRELOAD_MODULES,) if self.preload else (),
+            )
+        return self._executor
+
+    def warm(self):
+        """Starts the worker pool now instead of on the first job. A no-op inside a spawned child, which
+        re-imports the app module when it is run as a script."""
+        if multiprocessing.parent_process() is None:
+            self.executor.submit(os.getpid)
+
+    def submit(self, fn, *args, job_id=None, dedupe_key=None, **meta):
+        """Queues fn(job_id, *args, store) and returns the job id. While a job queued with the same
+        dedupe_key is queued or running, from any web worker sharing the store, nothing is queued and
+        that job's id is returned instead."""
+        job_id = job_id or uuid.uuid4().hex
+        self.store.set(job_id, {"id": job_id, "status": "queued", "created_at": time.time(), "stages": {},
+                                "dedupe_key": dedupe_key, **meta})
+        if dedupe_key is not None:
+            holder = self.store.claim(dedupe_key, job_id)
+            if holder != job_id:
+                self.store.delete(job_id)
+                return holder
+        try:
+            future = self.executor.submit(_run_job, fn, job_id, *args, self.store)
+        except Exception:
+            if dedupe_key is not None:
+                self.store.release(dedupe_key, job_id)
+            self.store.delete(job_id)
+            raise
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def follow(self, job_id, holder, **meta):
+        """Records job_id as following holder, a job already doing the same work: it reports
+        holder's progress and result under its own id and owner."""
+        self.store.set(job_id, {"id": job_id, "status": "queued", "created_at": time.time(), "stages": {},
+                                "follows": holder, **meta})
+
+    def get(self, job_id):
+        record = self.store.get(job_id)
+        followed = self.store.get(record["follows"]) if record is not None and record.get("follows") else None
+        if followed is not None:
+            return {**followed, "id": job_id, "username": record.get("username"), "follows": record["follows"]}
+        return record
+
+    def _finish(self, job_id, future):
+        if future.exception() is not None:
+            # The worker died before it could record its own failure.
+            record = self.store.update(
+                job_id, status="failed", error=str(future.exception()), finished_at=time.time()
+            )
+        else:
+            record = future.result()
+        if record.get("dedupe_key") is not None:
+            self.store.release(record["dedupe_key"], job_id)
+        if self.on_done is not None:
+            self.on_done(record)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
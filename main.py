@@ -2,6 +2,7 @@ from flask import Flask, render_template, request, send_file, url_for, redirect
 import os, shutil
 import pandas as pd
 from forecast import analyze_product_categories, create_seasonal_forecast
+from ingest import MonthlyCube
 from utils import calculate_metrics
 from pso_lstm import run_lstm_pso_forecast
 from datetime import datetime
@@ -52,10 +53,11 @@ def upload():
 
     try:
         df = pd.read_csv(filepath, parse_dates=["transaction_date"])
-        analyze_product_categories(df)
-        forecast_results, arima_metrics = create_seasonal_forecast(df)
+        cube = MonthlyCube.from_transactions(df)
+        analyze_product_categories(cube)
+        forecast_results, arima_metrics = create_seasonal_forecast(cube)
         log_action("Generated ARIMA forecast")
-        lstm_metrics = run_lstm_pso_forecast(df.set_index('transaction_date')['quantity_sold'].resample('MS').sum())
+        lstm_metrics = run_lstm_pso_forecast(cube.totals())
         log_action("Generated LSTM-PSO forecast")
     except Exception as e:
         return f"Error processing file: {str(e)}"
@@ -0,0 +1,249 @@
+import hashlib
+import multiprocessing
+import os
+import pickle
+import shutil
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from profiling import span
+
+PLOT_FOLDER = "static/plots"
+PLOT_CACHE_DIR = os.environ.get("PLOT_CACHE_DIR", "cache/plots")
+PLOT_WORKERS = int(os.environ.get("PLOT_WORKERS", min(4, os.cpu_count() or 1)))
+PLOT_RETENTION_DAYS = float(os.environ.get("PLOT_RETENTION_DAYS", "7"))
+PLOT_CACHE_MAX_MB = float(os.environ.get("PLOT_CACHE_MAX_MB", "512"))
+
+CATEGORY_MAP = {101: 'Electronics', 201: 'Home Goods', 301: 'Clothing', 401: 'Books', 501: 'Food'}
+
+
+# --- Figures ---
+# Each builder draws on a bare Figure: nothing is registered with pyplot, so a figure is freed
+# as soon as it goes out of scope instead of accumulating in long-lived workers.
+# Matplotlib is imported on first render, so importing this module (the web process does, for
+# CATEGORY_MAP and publish_plot) stays cheap.
+def _category_seasonal(plot_data):
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(15, 7))
+    ax = fig.add_subplot()
+    for column in plot_data.columns:
+        ax.plot(plot_data.index, plot_data[column], marker='o', linestyle='--', label=column)
+    ax.set_xlabel(plot_data.index.name)
+    ax.legend(title=plot_data.columns.name)
+    ax.set_title('Monthly Sales by Product Category')
+    return fig
+
+
+def _category_totals(total_sales):
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(10, 6))
+    ax = fig.add_subplot()
+    positions = range(len(total_sales))
+    ax.bar(positions, total_sales.values, color='skyblue')
+    ax.set_xticks(positions)
+    ax.set_xticklabels([str(label) for label in total_sales.index], rotation=90)
+    ax.set_xlabel(total_sales.index.name)
+    ax.set_title('Total Sales by Product Category')
+    return fig
+
+
+def _arima_forecast(data):
+    from matplotlib.figure import Figure
+    monthly_sales, test_data = data["monthly_sales"], data["test_data"]
+    forecast_values, pred_ci = data["forecast_values"], data["pred_ci"]
+    fig = Figure(figsize=(15, 7))
+    ax = fig.add_subplot()
+    ax.plot(monthly_sales.index, monthly_sales, label='Historical Sales')
+    ax.plot(test_data.index, test_data, label='Actual Sales', color='royalblue', marker='o')
+    ax.plot(forecast_values.index, forecast_values, label='Forecast', color='forestgreen', linestyle='--')
+    ax.fill_between(pred_ci.index, pred_ci.iloc[:, 0], pred_ci.iloc[:, 1], color='g', alpha=.2)
+    ax.set_title('Sales Forecast vs Actuals')
+    return fig
+
+
+def _lstm_forecast(data):
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(12, 6))
+    ax = fig.add_subplot()
+    ax.plot(data["y_true"], label='True')
+    ax.plot(data["y_pred"], label='LSTM-PSO Forecast')
+    ax.legend()
+    ax.set_title("LSTM-PSO Forecast")
+    return fig
+
+
+FIGURES = {
+    "category_seasonal": (_category_seasonal, 'seaborn-v0_8-whitegrid'),
+    "category_total_sales": (_category_totals, 'seaborn-v0_8-whitegrid'),
+    "arima_forecast": (_arima_forecast, 'seaborn-v0_8-whitegrid'),
+    "lstm_forecast": (_lstm_forecast, 'default'),
+}
+
+
+def render_plot(kind, data, path):
+    """Draws one figure kind to a PNG at path."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import style
+    build, figure_style = FIGURES[kind]
+    with span("plot.render"), style.context(figure_style):
+        fig = build(data)
+        fig.tight_layout()
+        fig.savefig(path)
+    return path
+
+
+def _render_to_cache(kind, data, cache_path):
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.png"
+    render_plot(kind, data, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def publish_plot(cache_path, path):
+    """Places a rendered PNG at path, hard-linking it when the filesystem allows."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(cache_path, path)
+    except OSError:
+        shutil.copyfile(cache_path, path)
+    return path
+
+
+# --- Renderer ---
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PLOT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+class PlotRenderer:
+    """Renders figures in a shared process pool, caching PNGs by a hash of their data."""
+
+    def __init__(self, max_workers=PLOT_WORKERS, cache_dir=PLOT_CACHE_DIR):
+        self.max_workers = max_workers
+        self.cache_dir = cache_dir
+        self.pending = []
+        self.cache_hits = 0
+
+    def submit(self, kind, data, path):
+        """Queues a figure for path and returns a Future resolving to path."""
+        digest = hashlib.sha256(pickle.dumps((kind, data), protocol=5)).hexdigest()[:32]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = os.path.join(self.cache_dir, f"{kind}_{digest}.png")
+
+        if os.path.exists(cache_path):
+            self.cache_hits += 1
+            # Marks the entry as recently used for prune_plot_cache.
+            os.utime(cache_path)
+            future = Future()
+            future.set_result(publish_plot(cache_path, path))
+        elif self.max_workers > 1:
+            rendered = _get_executor().submit(_render_to_cache, kind, data, cache_path)
+            future = Future()
+            rendered.add_done_callback(lambda f: _resolve(future, f, path))
+        else:
+            future = Future()
+            future.set_result(publish_plot(_render_to_cache(kind, data, cache_path), path))
+        self.pending.append(future)
+        return future
+
+    def join(self):
+        """Waits for every submitted figure, re-raising the first rendering error."""
+        paths = [future.result() for future in self.pending]
+        self.pending = []
+        return paths
+
+
+def _resolve(future, rendered, path):
+    try:
+        future.set_result(publish_plot(rendered.result(), path))
+    except Exception as e:
+        future.set_exception(e)
+
+
+# Used when a caller does not pass its own renderer: draws in-process, like the original pyplot code.
+inline_renderer = PlotRenderer(max_workers=1)
+
+
+def prune_job_plots(max_age_days=PLOT_RETENTION_DAYS):
+    """Removes per-job plot folders older than the retention period."""
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    for name in os.listdir(PLOT_FOLDER):
+        path = os.path.join(PLOT_FOLDER, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def prune_plot_cache(cache_dir=PLOT_CACHE_DIR, max_age_days=PLOT_RETENTION_DAYS, max_mb=PLOT_CACHE_MAX_MB):
+    """Evicts cached PNGs unused for the retention period, then the least recently used ones until the
+    cache fits in max_mb. Published plots are hard links or copies, so they survive the eviction."""
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    entries = []
+    for entry in os.scandir(cache_dir) if os.path.isdir(cache_dir) else []:
+        # Skips the temporary files of renders still in flight.
+        if not entry.is_file() or ".png." in entry.name:
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if mtime >= cutoff and total <= max_mb * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+# --- Memory Check ---
+def _rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def check_render_memory(uploads=300, tolerance_mb=20):
+    """Renders every figure kind for many simulated uploads in-process and reports resident memory.
+    Returns True when growth after warm-up stays within tolerance_mb."""
+    import tempfile
+
+    import numpy as np
+    import pandas as pd
+
+    months = pd.date_range("2021-01-01", periods=48, freq="MS", name="transaction_date")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "plot.png")
+        baseline = None
+        for upload in range(uploads):
+            sales = pd.DataFrame(rng.integers(0, 500, size=(48, 5)), index=months,
+                                 columns=pd.Index(list(CATEGORY_MAP.values()), name="category_id"))
+            totals = sales.sum().sort_values(ascending=False)
+            monthly = sales.sum(axis=1)
+            pred_ci = pd.DataFrame({"lower": monthly[-12:] * 0.9, "upper": monthly[-12:] * 1.1})
+            render_plot("category_seasonal", sales, path)
+            render_plot("category_total_sales", totals, path)
+            render_plot("arima_forecast", {"monthly_sales": monthly, "test_data": monthly[-12:],
+                                           "forecast_values": monthly[-12:] * 1.05, "pred_ci": pred_ci}, path)
+            render_plot("lstm_forecast", {"y_true": monthly.values, "y_pred": monthly.values * 0.95}, path)
+
+            if upload == 10:
+                baseline = _rss_bytes()
+            if upload % 50 == 0 or upload == uploads - 1:
+                print(f"[PLOTS] upload {upload + 1}/{uploads}: RSS={_rss_bytes() / 1e6:.1f} MB")
+    growth_mb = (_rss_bytes() - baseline) / 1e6
+    print(f"[PLOTS] RSS growth after warm-up: {growth_mb:.1f} MB (tolerance {tolerance_mb} MB)")
+    return growth_mb <= tolerance_mb
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if check_render_memory() else 1)
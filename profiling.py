@@ -0,0 +1,264 @@
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from multiprocessing import util
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "cache/metrics")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "cache/profiles")
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+PROFILER = os.environ.get("PROFILER", "cprofile")
+PROFILE_JOBS = os.environ.get("PROFILE_JOBS", "0") == "1"
+# ?profile=1 captures are off unless enabled, and then only honoured for logged-in users.
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+# Bearer token /metrics requires; without one it only answers scrapes from the same host.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+ARCHIVE_FILE = "archive.json"
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process so far, from the kernel's own high-water mark."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+# --- Spans ---
+class SpanRecorder:
+    """Per-process span totals. Each process periodically writes its own file to METRICS_DIR, so the
+    web process can merge what its job and pool workers recorded without any shared state."""
+
+    def __init__(self, directory=METRICS_DIR, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _reset(self):
+        # Called lazily in every new process, so forked or spawned children never inherit a parent's totals.
+        self._pid = os.getpid()
+        self._path = os.path.join(self.directory, f"{self._pid}-{uuid.uuid4().hex[:8]}.json")
+        self.spans = {}
+        self._last_flush = time.monotonic()
+        util.Finalize(self, self.flush, exitpriority=10)
+
+    def record(self, name, seconds):
+        peak = peak_rss_bytes()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            entry = self.spans.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0, "peak_rss": 0})
+            entry["count"] += 1
+            entry["sum"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["peak_rss"] = max(entry["peak_rss"], peak)
+            due = time.monotonic() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pid != os.getpid() or not self.spans:
+                return
+            snapshot = {"pid": self._pid, "updated": time.time(), "peak_rss": peak_rss_bytes(), "spans": self.spans}
+            self._last_flush = time.monotonic()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = f"{self._path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp_path, self._path)
+            except OSError as e:
+                print(f"[METRICS] Could not write {self._path}: {e}")
+
+
+recorder = SpanRecorder()
+
+
+@contextmanager
+def span(name):
+    """Times a block under name; costs two clock reads and a dict update."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.record(name, time.perf_counter() - start)
+
+
+def flush():
+    recorder.flush()
+
+
+# --- Aggregation ---
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def _merge(into, spans):
+    for name, entry in spans.items():
+        total = into.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0, "peak_rss": 0})
+        total["count"] += entry["count"]
+        total["sum"] += entry["sum"]
+        total["max"] = max(total["max"], entry["max"])
+        total["peak_rss"] = max(total["peak_rss"], entry["peak_rss"])
+
+
+def collect(directory=METRICS_DIR):
+    """Merges every process's span file. Files of exited processes are folded into an archive file
+    so the directory does not grow with each pool worker ever started."""
+    flush()
+    archive_path = os.path.join(directory, ARCHIVE_FILE)
+    try:
+        with open(archive_path) as f:
+            archive = json.load(f)
+    except (OSError, ValueError):
+        archive = {"spans": {}, "peak_rss": 0}
+    spans = {}
+    _merge(spans, archive["spans"])
+    peak = archive["peak_rss"]
+    finished = []
+    for path in glob.glob(os.path.join(directory, "*-*.json")):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        _merge(spans, snapshot["spans"])
+        peak = max(peak, snapshot["peak_rss"])
+        if not _pid_alive(snapshot["pid"]):
+            finished.append((path, snapshot))
+
+    claimed = []
+    for path, snapshot in finished:
+        # Renaming claims the file, so two web workers never fold the same one into the archive.
+        try:
+            os.rename(path, f"{path}.archived")
+        except OSError:
+            continue
+        claimed.append(f"{path}.archived")
+        _merge(archive["spans"], snapshot["spans"])
+        archive["peak_rss"] = max(archive["peak_rss"], snapshot["peak_rss"])
+    if claimed:
+        tmp_path = f"{archive_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(archive, f)
+        os.replace(tmp_path, archive_path)
+        for path in claimed:
+            os.remove(path)
+    return {"spans": spans, "peak_rss": peak}
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(directory=METRICS_DIR):
+    """Renders the merged spans in the Prometheus text exposition format."""
+    metrics = collect(directory)
+    spans = sorted(metrics["spans"].items())
+    lines = [
+        "# HELP forecast_span_seconds Wall time spent in instrumented spans.",
+        "# TYPE forecast_span_seconds summary",
+    ]
+    for name, entry in spans:
+        lines.append(f'forecast_span_seconds_count{{span="{_label(name)}"}} {entry["count"]}')
+        lines.append(f'forecast_span_seconds_sum{{span="{_label(name)}"}} {entry["sum"]:.6f}')
+    lines += [
+        "# HELP forecast_span_max_seconds Longest single run of a span.",
+        "# TYPE forecast_span_max_seconds gauge",
+    ]
+    lines += [f'forecast_span_max_seconds{{span="{_label(name)}"}} {entry["max"]:.6f}' for name, entry in spans]
+    lines += [
+        "# HELP forecast_span_peak_rss_bytes Peak resident memory of the process running a span, at span exit.",
+        "# TYPE forecast_span_peak_rss_bytes gauge",
+    ]
+    lines += [f'forecast_span_peak_rss_bytes{{span="{_label(name)}"}} {entry["peak_rss"]}' for name, entry in spans]
+    lines += [
+        "# HELP forecast_process_peak_rss_bytes Highest peak resident memory of any app or worker process.",
+        "# TYPE forecast_process_peak_rss_bytes gauge",
+        f"forecast_process_peak_rss_bytes {metrics['peak_rss']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def summary(limit=10, directory=METRICS_DIR):
+    """The spans with the most total time, for the dashboard."""
+    spans = collect(directory)["spans"]
+    rows = [
+        {
+            "span": name,
+            "count": entry["count"],
+            "total": entry["sum"],
+            "mean": entry["sum"] / entry["count"] if entry["count"] else 0.0,
+            "max": entry["max"],
+            "peak_rss_mb": entry["peak_rss"] / 1e6,
+        }
+        for name, entry in spans.items()
+    ]
+    return sorted(rows, key=lambda row: row["total"], reverse=True)[:limit]
+
+
+# --- Profiles ---
+class Profile:
+    """On-demand cProfile (or pyinstrument, when installed and PROFILER=pyinstrument) capture of one
+    request or job, written to PROFILE_DIR."""
+
+    def __init__(self, name, directory=PROFILE_DIR, profiler=PROFILER):
+        self.path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}")
+        self.kind = profiler
+        self._profiler = None
+
+    def start(self):
+        if self.kind == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+                self._profiler = Profiler()
+            except ImportError:
+                print("[PROFILE] pyinstrument is not installed; using cProfile")
+                self.kind = "cprofile"
+        if self._profiler is None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler.start()
+        return self
+
+    def stop(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.kind == "pyinstrument":
+            self._profiler.stop()
+            with open(f"{self.path}.html", "w") as f:
+                f.write(self._profiler.output_html())
+            return f"{self.path}.html"
+        self._profiler.disable()
+        self._profiler.dump_stats(f"{self.path}.prof")
+        report = io.StringIO()
+        pstats.Stats(self._profiler, stream=report).sort_stats("cumulative").print_stats(30)
+        with open(f"{self.path}.txt", "w") as f:
+            f.write(report.getvalue())
+        return f"{self.path}.prof"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,32 +1,131 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+import multiprocessing
 import pandas as pd
 import numpy as np
-from keras.models import Sequential
-from keras.layers import LSTM, Dense
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.metrics import mean_squared_error, mean_absolute_percentage_error, r2_score
-import matplotlib.pyplot as plt
-import random
-
-class Particle:
-    def __init__(self, bounds):
-        self.position = [random.uniform(b[0], b[1]) for b in bounds]
-        self.velocity = [random.uniform(-1, 1) for _ in bounds]
-        self.best_position = list(self.position)
-        self.best_score = float('inf')
-
-    def update_velocity(self, global_best, inertia=0.5, cognitive=1.5, social=1.5):
-        for i in range(len(self.velocity)):
-            r1, r2 = random.random(), random.random()
-            cognitive_component = cognitive * r1 * (self.best_position[i] - self.position[i])
-            social_component = social * r2 * (global_best[i] - self.position[i])
-            self.velocity[i] = inertia * self.velocity[i] + cognitive_component + social_component
-
-    def update_position(self, bounds):
-        for i in range(len(self.position)):
-            self.position[i] += self.velocity[i]
-            self.position[i] = max(bounds[i][0], min(bounds[i][1], self.position[i]))
+from numpy.lib.stride_tricks import sliding_window_view
+from plots import inline_renderer
+from profiling import recorder, span
+from utils import JOB_CORES, METRICS, batch_metrics
 
+PSO_WORKERS = int(os.environ.get("PSO_WORKERS", JOB_CORES))
+PSO_SEED = int(os.environ["PSO_SEED"]) if os.environ.get("PSO_SEED") else None
+PSO_CACHE_SIZE = int(os.environ.get("PSO_CACHE_SIZE", "1024"))
+PSO_CACHE_DIR = os.environ.get("PSO_CACHE_DIR", "cache/pso_fitness")
+LSTM_WARM_START = os.environ.get("LSTM_WARM_START", "1") == "1"
+PSO_EPOCHS = 5
+PSO_MIN_EPOCHS = int(os.environ.get("PSO_MIN_EPOCHS", "1"))
+PSO_ETA = int(os.environ.get("PSO_ETA", "2"))
+FINAL_EPOCHS = 20
+LSTM_BOUNDS = [(20, 100), (5, 30)]
+EARLY_STOPPING_PATIENCE = 3
+VALIDATION_FRACTION = 0.2
+FINE_TUNE_EPOCHS = int(os.environ.get("LSTM_FINE_TUNE_EPOCHS", "3"))
+GLOBAL_UNITS = int(os.environ.get("GLOBAL_LSTM_UNITS", "64"))
+GLOBAL_N_STEPS = int(os.environ.get("GLOBAL_LSTM_STEPS", "6"))
+GLOBAL_EMBEDDING_DIM = int(os.environ.get("GLOBAL_LSTM_EMBEDDING", "8"))
+GLOBAL_BATCH_SIZE = int(os.environ.get("GLOBAL_LSTM_BATCH", "256"))
+GLOBAL_HOLDOUT = 12
+
+class Swarm:
+    """Particle positions, velocities and personal bests held as (n_particles, n_dims) arrays."""
+
+    def __init__(self, bounds, n_particles, rng, inertia=0.5, cognitive=1.5, social=1.5):
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.rng = rng
+        self.inertia, self.cognitive, self.social = inertia, cognitive, social
+        shape = (n_particles, len(self.bounds))
+        self.positions = rng.uniform(self.bounds[:, 0], self.bounds[:, 1], size=shape)
+        self.velocities = rng.uniform(-1, 1, size=shape)
+        self.best_positions = self.positions.copy()
+        self.best_scores = np.full(n_particles, np.inf)
+        self.global_best_position = None
+        self.global_best_score = np.inf
+
+    def update_bests(self, scores):
+        improved = scores < self.best_scores
+        self.best_scores[improved] = scores[improved]
+        self.best_positions[improved] = self.positions[improved]
+        best = int(np.argmin(scores))
+        if scores[best] < self.global_best_score:
+            self.global_best_score = float(scores[best])
+            self.global_best_position = self.positions[best].copy()
+
+    def step(self):
+        r1 = self.rng.random(self.positions.shape)
+        r2 = self.rng.random(self.positions.shape)
+        cognitive_component = self.cognitive * r1 * (self.best_positions - self.positions)
+        social_component = self.social * r2 * (self.global_best_position - self.positions)
+        self.velocities = self.inertia * self.velocities + cognitive_component + social_component
+        self.positions = np.clip(self.positions + self.velocities, self.bounds[:, 0], self.bounds[:, 1])
+
+def series_fingerprint(scaled_data):
+    return hashlib.sha1(np.ascontiguousarray(scaled_data, dtype=np.float64).tobytes()).hexdigest()[:16]
+
+class FitnessCache:
+    """LRU of particle fitness keyed on (series fingerprint, units, n_steps, epochs), with an optional disk tier."""
+
+    def __init__(self, maxsize=PSO_CACHE_SIZE, cache_dir=PSO_CACHE_DIR):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._loaded = set()
+
+    def _path(self, fingerprint):
+        return os.path.join(self.cache_dir, f"{fingerprint}.json")
+
+    def _read_disk(self, fingerprint):
+        try:
+            with open(self._path(fingerprint)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load(self, fingerprint):
+        if not self.cache_dir or fingerprint in self._loaded:
+            return
+        self._loaded.add(fingerprint)
+        for key, score in self._read_disk(fingerprint).items():
+            units, n_steps, epochs = map(int, key.split(","))
+            self.put((fingerprint, units, n_steps, epochs), score)
+
+    def get(self, key):
+        self._load(key[0])
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, score):
+        self._entries[key] = score
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def save(self, fingerprint):
+        """Merges this fingerprint's in-memory entries into its file on disk."""
+        if not self.cache_dir:
+            return
+        stored = self._read_disk(fingerprint)
+        stored.update({f"{u},{n},{e}": score for (fp, u, n, e), score in self._entries.items() if fp == fingerprint})
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._path(fingerprint)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(stored, f)
+        os.replace(tmp_path, self._path(fingerprint))
+
+fitness_cache = FitnessCache()
+
+# Keras and sklearn are imported where they are used, so importing this module (as the web process
+# does through jobs) does not load TensorFlow.
 def create_lstm_model(input_shape, units):
+    from keras.layers import LSTM, Dense
+    from keras.models import Sequential
     model = Sequential()
     model.add(LSTM(units=int(units), input_shape=input_shape))
     model.add(Dense(1))
@@ -34,73 +133,390 @@ def create_lstm_model(input_shape, units):
     return model
 
 def prepare_data(series, n_steps):
-    X, y = [], []
-    for i in range(len(series) - n_steps):
-        X.append(series[i:i+n_steps])
-        y.append(series[i+n_steps])
-    return np.array(X), np.array(y)
+    """Returns (N - n_steps, n_steps) input windows and their next values as read-only views of the series."""
+    series = np.asarray(series)
+    if len(series) <= n_steps:
+        return np.empty((0, n_steps), dtype=series.dtype), np.empty(0, dtype=series.dtype)
+    return sliding_window_view(series[:-1], n_steps), series[n_steps:]
+
+_window_cache = OrderedDict()
+MAX_CACHED_WINDOWS = 64
+
+def cached_windows(scaled_data, n_steps):
+    """Returns (X, y) shaped for the LSTM, building the views once per series and n_steps."""
+    key = (series_fingerprint(scaled_data), int(n_steps))
+    if key in _window_cache:
+        _window_cache.move_to_end(key)
+    else:
+        X, y = prepare_data(scaled_data, n_steps)
+        _window_cache[key] = (X[..., np.newaxis], y)
+        while len(_window_cache) > MAX_CACHED_WINDOWS:
+            _window_cache.popitem(last=False)
+    return _window_cache[key]
+
+class SuccessiveHalving:
+    """Epoch budget for PSO candidates: everyone trains briefly, the worst are pruned at each rung."""
+
+    def __init__(self, min_epochs=PSO_MIN_EPOCHS, max_epochs=PSO_EPOCHS, eta=PSO_ETA):
+        self.eta = max(2, eta)
+        self.rungs = []
+        epochs = max(1, min(min_epochs, max_epochs))
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= self.eta
+        self.rungs.append(max_epochs)
+        self.epochs_spent = 0
+
+    def run(self, candidates, train):
+        """Trains {key: seed} candidates rung by rung; train(jobs) maps (key, seed, epochs, initial_epoch, weights)
+        jobs to (score, weights) results. Returns {key: (score, weights, epochs)}."""
+        state = {key: (None, None, 0) for key in candidates}
+        alive = list(candidates)
+        for rung, epochs in enumerate(self.rungs):
+            jobs = [(key, candidates[key], epochs, state[key][2], state[key][1]) for key in alive]
+            for key, (score, weights) in zip(alive, train(jobs)):
+                self.epochs_spent += epochs - state[key][2]
+                state[key] = (score, weights, epochs)
+            if rung < len(self.rungs) - 1:
+                alive = sorted(alive, key=lambda key: state[key][0])[:max(1, ceil(len(alive) / self.eta))]
+        return state
+
+def evaluate_particle(scaled_data, units, n_steps, epochs=PSO_EPOCHS, seed=None, initial_epoch=0, weights=None):
+    """Trains a candidate to epochs, resuming from the weights of its previous rung with a fresh optimizer,
+    so a rung gives the same result in this process and on a pool worker."""
+    from keras.utils import set_random_seed
+    from sklearn.metrics import mean_squared_error
+    X, y = cached_windows(scaled_data, n_steps)
+
+    if seed is not None:
+        set_random_seed(seed + initial_epoch)
+    model = create_lstm_model((X.shape[1], 1), units)
+    if weights is not None:
+        model.set_weights(weights)
+    with span("pso.fit"):
+        model.fit(X, y, epochs=epochs, initial_epoch=initial_epoch, verbose=0)
+
+    with span("pso.predict"):
+        y_pred = model.predict(X, verbose=0).flatten()
+    return mean_squared_error(y, y_pred), model.get_weights()
 
-def pso_optimize(data, n_particles=5, iterations=10, bounds=[(10, 100), (5, 30)]):
+def _init_pso_worker(threads):
+    # Keep n_workers * threads at the core count instead of every worker grabbing all cores.
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _train_candidates(executor, scaled_data, jobs):
+    args = (
+        [scaled_data] * len(jobs),
+        [key[1] for key, _, _, _, _ in jobs],
+        [key[2] for key, _, _, _, _ in jobs],
+        [epochs for _, _, epochs, _, _ in jobs],
+        [seed for _, seed, _, _, _ in jobs],
+        [initial_epoch for _, _, _, initial_epoch, _ in jobs],
+        [weights for _, _, _, _, weights in jobs],
+    )
+    results = executor.map(evaluate_particle, *args) if executor is not None else map(evaluate_particle, *args)
+    return list(results)
+
+def pso_optimize(data, n_particles=5, iterations=10, bounds=[(10, 100), (5, 30)], n_workers=PSO_WORKERS, seed=PSO_SEED,
+                 cache=fitness_cache):
+    from sklearn.preprocessing import MinMaxScaler
     scaler = MinMaxScaler()
     scaled_data = scaler.fit_transform(data.reshape(-1, 1)).flatten()
-    best_global_position = None
-    best_global_score = float('inf')
-    particles = [Particle(bounds) for _ in range(n_particles)]
+    fingerprint = series_fingerprint(scaled_data)
+    cache_hits = cache_misses = 0
+    rng = np.random.default_rng(seed)
+    swarm = Swarm(bounds, n_particles, rng)
+    n_workers = max(1, min(n_workers, n_particles))
+    iteration_times = []
+    best_key, best_weights, best_epochs = None, None, 0
+    scheduler = SuccessiveHalving()
+    budget_epochs = scheduler.rungs[-1]
+
+    executor = None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pso_worker,
+            initargs=(max(1, JOB_CORES // n_workers),),
+        )
+    try:
+        for iteration in range(iterations):
+            start = time.perf_counter()
+            keys = [(fingerprint, int(u), int(n), budget_epochs) for u, n in swarm.positions]
+            seeds = rng.integers(0, 2**31 - 1, size=n_particles).tolist() if seed is not None else [None] * n_particles
 
-    for _ in range(iterations):
-        for particle in particles:
-            units, n_steps = int(particle.position[0]), int(particle.position[1])
-            X, y = prepare_data(scaled_data, n_steps)
-            X = X.reshape((X.shape[0], X.shape[1], 1))
+            # Particles often truncate to the same (units, n_steps); train each distinct uncached pair once.
+            known, pending = {}, {}
+            for key, particle_seed in zip(keys, seeds):
+                cached = cache.get(key) if cache is not None else None
+                if cached is not None:
+                    known[key] = cached
+                    cache_hits += 1
+                elif key in pending:
+                    cache_hits += 1
+                else:
+                    pending[key] = particle_seed
+                    cache_misses += 1
+            trained = scheduler.run(pending, lambda jobs: _train_candidates(executor, scaled_data, jobs))
+            for key, (score, _, epochs) in trained.items():
+                # A candidate pruned at a lower rung keeps the score of the last rung it completed, so the swarm
+                # still moves on it; it is not a full-budget fitness, so it is not cached.
+                known[key] = score
+                if cache is not None and epochs == budget_epochs:
+                    cache.put(key, score)
+            scores = [known[key] for key in keys]
 
-            model = create_lstm_model((X.shape[1], 1), units)
-            model.fit(X, y, epochs=5, verbose=0)
+            swarm.update_bests(np.asarray(scores))
+            winner = (fingerprint, *swarm.global_best_position.astype(int).tolist(), budget_epochs)
+            if winner != best_key:
+                # A winner served from the fitness cache has no weights to hand over.
+                best_key = winner
+                best_weights, best_epochs = trained[winner][1:] if winner in trained else (None, 0)
+            swarm.step()
+            iteration_times.append(time.perf_counter() - start)
+            recorder.record("pso.iteration", iteration_times[-1])
+            print(f"[LSTM-PSO] Iteration {iteration + 1}/{iterations}: best MSE={swarm.global_best_score:.6f}, "
+                  f"wall time={iteration_times[-1]:.2f}s ({n_workers} workers)")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        else:
+            # Trained in this process: drop the graphs of the candidates' models.
+            from keras.backend import clear_session
+            clear_session()
+        if cache is not None:
+            cache.save(fingerprint)
 
-            y_pred = model.predict(X).flatten()
-            score = mean_squared_error(y, y_pred)
+    return {
+        "best_position": swarm.global_best_position.tolist(),
+        "best_score": swarm.global_best_score,
+        "best_weights": best_weights,
+        "best_epochs": best_epochs,
+        "epochs_spent": scheduler.epochs_spent,
+        "baseline_epochs": n_particles * iterations * PSO_EPOCHS,
+        "scaler": scaler,
+        "scaled_data": scaled_data,
+        "iteration_times": iteration_times,
+        "cache_hits": cache_hits,
+        "cache_misses": cache_misses,
+    }
 
-            if score < particle.best_score:
-                particle.best_score = score
-                particle.best_position = list(particle.position)
+def run_lstm_pso_forecast(series, warm_start=LSTM_WARM_START, return_model=False, renderer=inline_renderer,
+                          plot_path="static/plots/lstm_pso_forecast.png"):
+    from keras.callbacks import EarlyStopping
+    search = pso_optimize(series.values, bounds=LSTM_BOUNDS)
+    best_params = search["best_position"]
+    units, n_steps = int(best_params[0]), int(best_params[1])
+    print(f"[LSTM-PSO] Best Params: units={units}, n_steps={n_steps} "
+          f"(search wall time={sum(search['iteration_times']):.2f}s, "
+          f"fitness cache hits={search['cache_hits']}, misses={search['cache_misses']})")
 
-            if score < best_global_score:
-                best_global_score = score
-                best_global_position = list(particle.position)
+    scaler = search["scaler"]
+    X, y = cached_windows(search["scaled_data"], n_steps)
 
-        for particle in particles:
-            particle.update_velocity(best_global_position)
-            particle.update_position(bounds)
+    model = create_lstm_model((X.shape[1], 1), units)
+    initial_epoch = 0
+    if warm_start and search["best_weights"] is not None:
+        # Continue from the PSO winner instead of training a fresh model for every epoch.
+        model.set_weights(search["best_weights"])
+        initial_epoch = search["best_epochs"]
+        print(f"[LSTM-PSO] Warm start from PSO winner at epoch {initial_epoch}/{FINAL_EPOCHS}")
 
-    return best_global_position
+    # Hold out the tail windows for early stopping when there are enough of them.
+    n_val = int(len(X) * VALIDATION_FRACTION)
+    with span("lstm.final_fit"):
+        if n_val >= 1 and len(X) - n_val >= 1:
+            callbacks = [EarlyStopping(monitor="val_loss", patience=EARLY_STOPPING_PATIENCE, restore_best_weights=True)]
+            history = model.fit(X[:-n_val], y[:-n_val], validation_data=(X[-n_val:], y[-n_val:]),
+                                epochs=FINAL_EPOCHS, initial_epoch=initial_epoch, callbacks=callbacks, verbose=1)
+        else:
+            history = model.fit(X, y, epochs=FINAL_EPOCHS, initial_epoch=initial_epoch, verbose=1)
+    epochs_spent = search["epochs_spent"] + len(history.history["loss"])
+    baseline_epochs = search["baseline_epochs"] + FINAL_EPOCHS
+    print(f"[LSTM-PSO] Epochs spent: {epochs_spent} (fixed-epoch baseline: {baseline_epochs})")
 
-def run_lstm_pso_forecast(series):
-    bounds = [(20, 100), (5, 30)]
-    best_params = pso_optimize(series.values, bounds=bounds)
-    units, n_steps = int(best_params[0]), int(best_params[1])
-    print(f"[LSTM-PSO] Best Params: units={units}, n_steps={n_steps}")
+    return _score_lstm(model, X, y, scaler, units, n_steps, epochs_spent, baseline_epochs, return_model,
+                       renderer, plot_path)
 
-    scaler = MinMaxScaler()
-    scaled_data = scaler.fit_transform(series.values.reshape(-1, 1)).flatten()
-    X, y = prepare_data(scaled_data, n_steps)
-    X = X.reshape((X.shape[0], X.shape[1], 1))
+def fine_tune_lstm_forecast(series, lstm, epochs=FINE_TUNE_EPOCHS, baseline_epochs=None, return_model=False,
+                            renderer=inline_renderer, plot_path="static/plots/lstm_pso_forecast.png"):
+    """Continues a stored LSTM (the dict from run_lstm_pso_forecast) for a few epochs on an extended
+    series, keeping its scaler and PSO-chosen hyperparameters instead of searching again."""
+    units, n_steps, scaler = lstm["units"], lstm["n_steps"], lstm["scaler"]
+    scaled_data = scaler.transform(np.asarray(series.values, dtype="float64").reshape(-1, 1)).flatten()
+    X, y = cached_windows(scaled_data, n_steps)
 
     model = create_lstm_model((X.shape[1], 1), units)
-    model.fit(X, y, epochs=20, verbose=1)
+    model.set_weights(lstm["weights"])
+    model.fit(X, y, epochs=epochs, verbose=0)
+    print(f"[LSTM-PSO] Fine-tuned stored model (units={units}, n_steps={n_steps}) for {epochs} epochs")
+    return _score_lstm(model, X, y, scaler, units, n_steps, epochs,
+                       baseline_epochs if baseline_epochs is not None else epochs, return_model, renderer, plot_path)
 
-    y_pred = model.predict(X).flatten()
+def recursive_forecast(model, scaler, n_steps, histories, horizon):
+    """Forecasts horizon steps past the end of each history (at least n_steps values, unscaled) by feeding
+    every prediction back as the newest input. All histories go through the model in one call per step.
+    Returns a (len(histories), horizon) array."""
+    windows = np.stack([
+        scaler.transform(np.asarray(history[-n_steps:], dtype="float64").reshape(-1, 1)).flatten()
+        for history in histories
+    ])
+    predicted = np.empty((len(histories), horizon))
+    for step in range(horizon):
+        predicted[:, step] = np.asarray(model.predict_on_batch(windows[..., np.newaxis])).flatten()
+        windows = np.concatenate([windows[:, 1:], predicted[:, step:step + 1]], axis=1)
+    return scaler.inverse_transform(predicted.reshape(-1, 1)).reshape(predicted.shape)
+
+def _score_lstm(model, X, y, scaler, units, n_steps, epochs_spent, baseline_epochs, return_model, renderer, plot_path):
+    with span("lstm.predict"):
+        y_pred = model.predict(X).flatten()
     y_true = scaler.inverse_transform(y.reshape(-1, 1)).flatten()
     y_pred_rescaled = scaler.inverse_transform(y_pred.reshape(-1, 1)).flatten()
 
-    plt.figure(figsize=(12, 6))
-    plt.plot(y_true, label='True')
-    plt.plot(y_pred_rescaled, label='LSTM-PSO Forecast')
-    plt.legend()
-    plt.title("LSTM-PSO Forecast")
-    plt.tight_layout()
-    plt.savefig("static/plots/lstm_pso_forecast.png")
+    renderer.submit("lstm_forecast", {"y_true": y_true, "y_pred": y_pred_rescaled}, plot_path)
+
+    scores = batch_metrics(y_true, y_pred_rescaled)
+    metrics = {
+        "MAPE": scores["MAPE"][0],
+        "RMSE": scores["RMSE"][0],
+        "R2": scores["R2"][0],
+        "Epochs": epochs_spent,
+        "Baseline Epochs": baseline_epochs,
+    }
+    if return_model:
+        return metrics, {"weights": model.get_weights(), "scaler": scaler, "units": units, "n_steps": n_steps}
+    return metrics
+
+
+# --- Global Multi-Series Model ---
+def create_global_lstm_model(n_steps, n_series, units=GLOBAL_UNITS, embedding_dim=GLOBAL_EMBEDDING_DIM):
+    """One LSTM shared by every series; a learned series embedding is fed alongside each time step."""
+    from keras.layers import LSTM, Concatenate, Dense, Embedding, Flatten, Input, RepeatVector
+    from keras.models import Model
+    window = Input(shape=(n_steps, 1), name="window")
+    series_id = Input(shape=(1,), dtype="int32", name="series_id")
+    embedding = Flatten()(Embedding(n_series, embedding_dim)(series_id))
+    features = Concatenate()([window, RepeatVector(n_steps)(embedding)])
+    output = Dense(1)(LSTM(units)(features))
+    model = Model(inputs=[window, series_id], outputs=output)
+    model.compile(optimizer='adam', loss='mean_squared_error')
+    return model
+
+def stack_windows(panel, n_steps=GLOBAL_N_STEPS, holdout=GLOBAL_HOLDOUT):
+    """Min-max scales every column of a month x series panel on its own range and stacks the
+    sliding windows of all series into one batch. Leading NaNs (months before a series starts)
+    are dropped; each series keeps its last windows, up to a quarter of them, for evaluation, and
+    its range is taken from the months before those windows' targets so the holdout stays unseen."""
+    values = panel.to_numpy("float64")
+    lows, spans = np.zeros(values.shape[1]), np.ones(values.shape[1])
 
+    X, y, ids, is_test, last_windows = [], [], [], [], []
+    for i in range(values.shape[1]):
+        series = values[:, i]
+        series = series[np.argmax(~np.isnan(series)):] if not np.isnan(series).all() else series[:0]
+        n_test = min(holdout, max(0, len(series) - n_steps) // 4)
+        fit = series[:len(series) - n_test]
+        if np.isfinite(fit).any():
+            lows[i] = np.nanmin(fit)
+            span = np.nanmax(fit) - lows[i]
+            spans[i] = span if span > 0 else 1.0
+        series = (series - lows[i]) / spans[i]
+        windows, targets = prepare_data(series, n_steps)
+        X.append(windows)
+        y.append(targets)
+        ids.append(np.full(len(targets), i, dtype="int32"))
+        is_test.append(np.arange(len(targets)) >= len(targets) - n_test)
+        # The window ending at the last observed month feeds the next-month forecast.
+        last_windows.append(series[-n_steps:] if len(series) >= n_steps else None)
     return {
-        "MAPE": mean_absolute_percentage_error(y_true, y_pred_rescaled) * 100,
-        "RMSE": np.sqrt(mean_squared_error(y_true, y_pred_rescaled)),
-        "R2": r2_score(y_true, y_pred_rescaled)
+        "X": np.concatenate(X)[..., np.newaxis] if X else np.empty((0, n_steps, 1)),
+        "y": np.concatenate(y) if y else np.empty(0),
+        "series_id": np.concatenate(ids) if ids else np.empty(0, "int32"),
+        "is_test": np.concatenate(is_test) if is_test else np.empty(0, bool),
+        "last_windows": last_windows,
+        "lows": lows,
+        "spans": spans,
+    }
+
+def run_global_lstm_forecast(panel, n_steps=GLOBAL_N_STEPS, units=GLOBAL_UNITS, epochs=FINAL_EPOCHS,
+                             batch_size=GLOBAL_BATCH_SIZE, seed=PSO_SEED, return_model=False):
+    """Trains one LSTM on the windows of every column of a month x series panel (see
+    ingest.MonthlyCube.panel) and scores all series with a single predict call. Returns a
+    per-series table of holdout metrics and next-month forecasts, and the run's stats."""
+    from keras.callbacks import EarlyStopping
+    from keras.utils import set_random_seed
+    start = time.perf_counter()
+    level = panel.columns.name or "series"
+    stacked = stack_windows(panel, n_steps)
+    X, y, ids, is_test = stacked["X"], stacked["y"], stacked["series_id"], stacked["is_test"]
+    n_series = panel.shape[1]
+    print(f"[LSTM-GLOBAL] {n_series} series, {len(y)} windows ({int(is_test.sum())} held out), "
+          f"n_steps={n_steps}, units={units}")
+
+    if seed is not None:
+        set_random_seed(seed)
+    model = create_global_lstm_model(n_steps, max(1, n_series), units)
+    train = ~is_test
+    history = None
+    if train.any():
+        callbacks = [EarlyStopping(monitor="loss", patience=EARLY_STOPPING_PATIENCE, restore_best_weights=True)]
+        history = model.fit([X[train], ids[train]], y[train], epochs=epochs, batch_size=batch_size,
+                            shuffle=True, callbacks=callbacks, verbose=0)
+    train_seconds = time.perf_counter() - start
+
+    # Holdout windows and every series' next-month window go through the model in one call.
+    next_ids = np.array([i for i, w in enumerate(stacked["last_windows"]) if w is not None], dtype="int32")
+    next_X = np.array([stacked["last_windows"][i] for i in next_ids]).reshape(-1, n_steps, 1)
+    batch_X = np.concatenate([X[is_test], next_X])
+    batch_ids = np.concatenate([ids[is_test], next_ids])
+    predict_start = time.perf_counter()
+    predicted = model.predict([batch_X, batch_ids], batch_size=max(batch_size, 1024), verbose=0).flatten() \
+        if len(batch_ids) else np.empty(0)
+    predict_seconds = time.perf_counter() - predict_start
+
+    lows, spans = stacked["lows"], stacked["spans"]
+    test_ids = ids[is_test]
+    test_true = y[is_test] * spans[test_ids] + lows[test_ids]
+    test_pred = predicted[:len(test_ids)] * spans[test_ids] + lows[test_ids]
+    next_pred = predicted[len(test_ids):] * spans[next_ids] + lows[next_ids]
+    next_by_series = dict(zip(next_ids.tolist(), next_pred.tolist()))
+
+    # Each series' holdout windows are contiguous, so they lay out as the rows of a (series, holdout) batch.
+    holdouts = np.bincount(test_ids, minlength=n_series)
+    position = np.arange(len(test_ids)) - np.searchsorted(test_ids, test_ids)
+    actual = np.full((n_series, max(1, holdouts.max(initial=0))), np.nan)
+    predicted_holdout = actual.copy()
+    actual[test_ids, position] = test_true
+    predicted_holdout[test_ids, position] = test_pred
+    # Months before each holdout are the in-sample history MASE is scaled by.
+    values = panel.to_numpy("float64").T
+    in_sample = np.where(np.arange(values.shape[1]) < values.shape[1] - holdouts[:, np.newaxis], values, np.nan)
+    scores = batch_metrics(actual, predicted_holdout, train=in_sample)
+    scored = holdouts >= 2
+    metrics = pd.DataFrame({
+        level: panel.columns,
+        "windows": np.bincount(ids, minlength=n_series),
+        "holdout": holdouts,
+        **{name: np.where(scored, scores[name], np.nan) for name in METRICS},
+        "next_forecast": [next_by_series.get(i, np.nan) for i in range(n_series)],
+    })
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "series": n_series,
+        "windows": int(len(y)),
+        "epochs": len(history.history["loss"]) if history is not None else 0,
+        "train_seconds": train_seconds,
+        "predict_seconds": predict_seconds,
+        "seconds": elapsed,
+        "series_per_second": n_series / elapsed if elapsed > 0 else 0.0,
     }
+    print(f"[LSTM-GLOBAL] Trained {stats['epochs']} epochs in {train_seconds:.2f}s, predicted {len(batch_ids)} "
+          f"windows in {predict_seconds:.2f}s ({stats['series_per_second']:.1f} series/s)")
+    if return_model:
+        return metrics, stats, {"weights": model.get_weights(), "lows": lows, "spans": spans,
+                                "series": list(panel.columns), "units": units, "n_steps": n_steps}
+    return metrics, stats
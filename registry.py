@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+REGISTRY_DIR = os.environ.get("MODEL_REGISTRY_DIR", "models")
+REGISTRY_MAX_BYTES = int(os.environ.get("MODEL_REGISTRY_MAX_MB", "500")) * 1024 * 1024
+REGISTRY_MAX_AGE_DAYS = float(os.environ.get("MODEL_REGISTRY_MAX_AGE_DAYS", "30"))
+
+MANIFEST = "manifest.json"
+SARIMAX_FILE = "sarimax.pkl"
+LSTM_WEIGHTS_FILE = "lstm_weights.npz"
+SCALER_FILE = "scaler.pkl"
+
+
+def file_hash(filepath, chunk_size=1024 * 1024):
+    """Returns the SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_key(data_hash, config):
+    """Combines a data hash and a model configuration into a registry key."""
+    payload = json.dumps({"data": data_hash, "config": config}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def is_model_key(key):
+    return len(key) == 32 and all(c in "0123456789abcdef" for c in key)
+
+
+class ModelRegistry:
+    """Fitted models, scalers, metrics and plots on disk, one directory per key."""
+
+    def __init__(self, root=REGISTRY_DIR, max_bytes=REGISTRY_MAX_BYTES, max_age_days=REGISTRY_MAX_AGE_DAYS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+
+    def _path(self, key, *parts):
+        return os.path.join(self.root, key, *parts)
+
+    def _read_manifest(self, key):
+        if not is_model_key(key):
+            return None
+        try:
+            with open(self._path(key, MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, directory, manifest):
+        tmp_path = os.path.join(directory, f"{MANIFEST}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, default=str)
+        os.replace(tmp_path, os.path.join(directory, MANIFEST))
+
+    def save(self, key, metrics, config, forecast=None, sarimax=None, lstm=None, plots=None):
+        """Stores a fitted pipeline under key and evicts old entries; lstm is the dict from run_lstm_pso_forecast."""
+        os.makedirs(self.root, exist_ok=True)
+        staging = os.path.join(self.root, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(os.path.join(staging, "plots"))
+        manifest = {
+            "key": key,
+            "created_at": time.time(),
+            "last_used": time.time(),
+            "config": config,
+            "metrics": metrics,
+            "forecast": forecast,
+            "plots": {},
+        }
+        if sarimax is not None:
+            sarimax.save(os.path.join(staging, SARIMAX_FILE))
+        if lstm is not None:
+            np.savez(os.path.join(staging, LSTM_WEIGHTS_FILE), *lstm["weights"])
+            with open(os.path.join(staging, SCALER_FILE), "wb") as f:
+                pickle.dump(lstm["scaler"], f)
+            manifest["lstm"] = {"units": lstm["units"], "n_steps": lstm["n_steps"]}
+        for name, plot_path in (plots or {}).items():
+            stored = os.path.join("plots", os.path.basename(plot_path))
+            shutil.copyfile(plot_path, os.path.join(staging, stored))
+            manifest["plots"][name] = stored
+        self._write_manifest(staging, manifest)
+
+        # Publish the finished directory in one rename so readers never see a partial entry.
+        self.invalidate(key)
+        os.replace(staging, self._path(key))
+        self.evict()
+        return manifest
+
+    def load(self, key):
+        """Returns the manifest for key, or None on a miss, and marks the entry as recently used."""
+        manifest = self._read_manifest(key)
+        if manifest is None:
+            return None
+        manifest["last_used"] = time.time()
+        try:
+            self._write_manifest(self._path(key), manifest)
+        except OSError:
+            pass
+        manifest["plots"] = {name: self._path(key, stored) for name, stored in manifest["plots"].items()}
+        return manifest
+
+    def load_sarimax(self, key):
+        from statsmodels.tsa.statespace.sarimax import SARIMAXResults
+        return SARIMAXResults.load(self._path(key, SARIMAX_FILE))
+
+    def load_lstm(self, key):
+        """Returns the stored LSTM weights, scaler and hyperparameters in run_lstm_pso_forecast's format."""
+        manifest = self._read_manifest(key)
+        if manifest is None or "lstm" not in manifest:
+            return None
+        with np.load(self._path(key, LSTM_WEIGHTS_FILE)) as stored:
+            weights = [stored[f"arr_{i}"] for i in range(len(stored.files))]
+        with open(self._path(key, SCALER_FILE), "rb") as f:
+            scaler = pickle.load(f)
+        return {"weights": weights, "scaler": scaler, **manifest["lstm"]}
+
+    def list(self):
+        """Returns the manifests of every stored entry with its size on disk."""
+        if not os.path.isdir(self.root):
+            return []
+        entries = []
+        for key in os.listdir(self.root):
+            if key.startswith("."):
+                continue
+            manifest = self._read_manifest(key)
+            if manifest is not None:
+                manifest["size_bytes"] = self._size(key)
+                entries.append(manifest)
+        return sorted(entries, key=lambda m: m["last_used"], reverse=True)
+
+    def invalidate(self, key):
+        """Removes a stored entry; returns whether it existed."""
+        if not is_model_key(key) or not os.path.isdir(self._path(key)):
+            return False
+        shutil.rmtree(self._path(key), ignore_errors=True)
+        return True
+
+    def _size(self, key):
+        total = 0
+        for dirpath, _, filenames in os.walk(self._path(key)):
+            total += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+        return total
+
+    def evict(self):
+        """Drops entries unused for longer than the max age, then least recently used ones over the size cap."""
+        removed = []
+        now = time.time()
+        entries = self.list()
+        for manifest in list(entries):
+            if now - manifest["last_used"] > self.max_age_seconds:
+                self.invalidate(manifest["key"])
+                entries.remove(manifest)
+                removed.append(manifest["key"])
+        total = sum(m["size_bytes"] for m in entries)
+        while entries and total > self.max_bytes:
+            oldest = entries.pop()
+            self.invalidate(oldest["key"])
+            total -= oldest["size_bytes"]
+            removed.append(oldest["key"])
+        return removed
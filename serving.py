@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from jobs import registry
+from profiling import span
+from pso_lstm import create_lstm_model, recursive_forecast
+
+FORECAST_MAX_HORIZON = int(os.environ.get("FORECAST_MAX_HORIZON", "36"))
+# Requests arriving within this window of each other share one predict call per forecast step.
+FORECAST_BATCH_WAIT_MS = float(os.environ.get("FORECAST_BATCH_WAIT_MS", "5"))
+FORECAST_MAX_BATCH = int(os.environ.get("FORECAST_MAX_BATCH", "64"))
+FORECAST_MODEL_CACHE = int(os.environ.get("FORECAST_MODEL_CACHE", "8"))
+FORECAST_TIMEOUT_SECONDS = float(os.environ.get("FORECAST_TIMEOUT_SECONDS", "60"))
+MODELS = ("sarimax", "lstm")
+
+
+# --- Serving Worker ---
+# Runs in the serving process: fitted models stay loaded between batches, keyed on registry key and
+# creation time so a re-saved entry is never served from a stale copy.
+_loaded = OrderedDict()
+
+
+def _load_models(key):
+    manifest = registry.load(key)
+    if manifest is None:
+        return None
+    cache_key = (key, manifest["created_at"])
+    if cache_key in _loaded:
+        _loaded.move_to_end(cache_key)
+        return _loaded[cache_key]
+
+    with span("serving.load"):
+        models = {"sarimax": None, "lstm": None}
+        try:
+            models["sarimax"] = registry.load_sarimax(key)
+        except OSError:
+            pass
+        lstm = registry.load_lstm(key)
+        if lstm is not None:
+            model = create_lstm_model((lstm["n_steps"], 1), lstm["units"])
+            model.set_weights(lstm["weights"])
+            models["lstm"] = {"model": model, "scaler": lstm["scaler"], "n_steps": lstm["n_steps"]}
+    _loaded[cache_key] = models
+    while len(_loaded) > FORECAST_MODEL_CACHE:
+        _loaded.popitem(last=False)
+    return models
+
+
+def _sarimax_forecast(results, series, horizon):
+    # Re-filters the request's series with the stored parameters; nothing is re-estimated.
+    return np.asarray(results.apply(series).forecast(horizon), dtype="float64").tolist()
+
+
+def predict_batch(requests):
+    """Forecasts a batch of {"key", "series", "horizon", "models"} requests with their stored models.
+    Returns one dict per request, holding either a forecast per model or an error."""
+    results = [{} for _ in requests]
+    by_key = {}
+    for i, request in enumerate(requests):
+        by_key.setdefault(request["key"], []).append(i)
+
+    with span("serving.predict"):
+        for key, indices in by_key.items():
+            models = _load_models(key)
+            if models is None:
+                for i in indices:
+                    results[i] = {"error": f"No stored models for {key}.", "not_found": True}
+                continue
+            lstm_batch = []
+            for i in indices:
+                request = requests[i]
+                series = np.asarray(request["series"], dtype="float64")
+                for name in request["models"]:
+                    if models[name] is None:
+                        results[i][name] = None
+                    elif name == "sarimax":
+                        try:
+                            results[i][name] = _sarimax_forecast(models[name], series, request["horizon"])
+                        except Exception as e:
+                            results[i] = {"error": f"SARIMAX forecast failed: {e}"}
+                            break
+                    elif len(request["series"]) < models[name]["n_steps"]:
+                        results[i][name] = None
+                    else:
+                        lstm_batch.append(i)
+            lstm_batch = [i for i in lstm_batch if "error" not in results[i]]
+            if lstm_batch:
+                # Every request on this model shares one predict call per step.
+                lstm = models["lstm"]
+                forecasts = recursive_forecast(lstm["model"], lstm["scaler"], lstm["n_steps"],
+                                               [requests[i]["series"] for i in lstm_batch],
+                                               max(requests[i]["horizon"] for i in lstm_batch))
+                for i, forecast in zip(lstm_batch, forecasts):
+                    results[i]["lstm"] = forecast[:requests[i]["horizon"]].tolist()
+    return results
+
+
+def _init_serving_worker():
+    # One thread is enough for batches this small and keeps the worker off the job workers' cores.
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _serving_executor():
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_serving_worker)
+
+
+# --- Batcher ---
+class ForecastBatcher:
+    """Collects concurrent forecast requests from the web threads and hands them to a single serving
+    process in batches, so TensorFlow is loaded there and never in the web process."""
+
+    def __init__(self, wait_ms=FORECAST_BATCH_WAIT_MS, max_batch=FORECAST_MAX_BATCH):
+        self.wait_seconds = wait_ms / 1000
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._executor = None
+
+    def _ensure_thread(self):
+        # Started lazily, and again in a forked web worker, which inherits the object but not the thread.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._executor = _serving_executor()
+                threading.Thread(target=self._run, name="forecast-batcher", daemon=True).start()
+
+    def warm(self):
+        """Starts the serving process now instead of on the first request; a no-op in a spawned child."""
+        if multiprocessing.parent_process() is None:
+            self._ensure_thread()
+            self._executor.submit(os.getpid)
+
+    def forecast(self, key, series, horizon, models=MODELS, timeout=FORECAST_TIMEOUT_SECONDS):
+        """Blocks until the request's batch has been forecast; returns the forecasts by model name.
+        Raises LookupError when key has no stored models."""
+        self._ensure_thread()
+        future = Future()
+        request = {"key": key, "series": [float(value) for value in series], "horizon": int(horizon),
+                   "models": list(models)}
+        self._queue.put((request, future))
+        result = future.result(timeout)
+        if "error" in result:
+            raise (LookupError if result.get("not_found") else ValueError)(result["error"])
+        return result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.wait_seconds
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                results = self._executor.submit(predict_batch, [request for request, _ in batch]).result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    # The serving process died (e.g. out of memory); the next batch starts a new one.
+                    self._executor = _serving_executor()
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from ingest import MonthlyCube
+
+
+def _transactions():
+    rng = np.random.default_rng(0)
+    n = 500
+    dates = pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 3 * 365, n), unit="D")
+    df = pd.DataFrame({
+        "transaction_date": dates,
+        "category_id": rng.integers(1, 4, n),
+        "product_id": rng.integers(100, 110, n),
+        "quantity_sold": rng.integers(1, 20, n),
+    })
+    # Nothing sold in one month, and every category sells in the last one.
+    df = df[df["transaction_date"].dt.to_period("M") != pd.Period("2022-06", "M")]
+    last = df["transaction_date"].max()
+    tail = pd.DataFrame({"transaction_date": [last] * 3, "category_id": [1, 2, 3], "product_id": [100] * 3,
+                         "quantity_sold": [5, 6, 7]})
+    return pd.concat([df, tail], ignore_index=True)
+
+
+def test_totals_match_resample():
+    df = _transactions()
+    expected = df.set_index("transaction_date")["quantity_sold"].resample("MS").sum()
+    totals = MonthlyCube.from_transactions(df).totals()
+    pd.testing.assert_series_equal(totals, expected.astype("float64"), check_names=False, check_freq=False)
+
+
+def test_category_panel_matches_resample():
+    df = _transactions()
+    expected = df.set_index("transaction_date").groupby("category_id")["quantity_sold"].resample("MS").sum()
+    expected = expected.unstack(level=0).astype("float64")
+    panel = MonthlyCube.from_transactions(df).panel("category_id")
+    pd.testing.assert_frame_equal(panel, expected, check_names=False, check_freq=False, check_column_type=False)
+
+
+def test_group_totals_match_groupby():
+    df = _transactions()
+    expected = df.groupby(["category_id", "product_id"])["quantity_sold"].sum().astype("float64")
+    totals = MonthlyCube.from_transactions(df).group_totals("category_id", "product_id")
+    pd.testing.assert_series_equal(totals, expected, check_names=False, check_index_type=False)
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_absolute_percentage_error, mean_squared_error, r2_score
+
+from utils import batch_metrics, calculate_metrics
+
+
+def _reference(y_true, y_pred):
+    # The per-series metrics calculate_metrics computed with sklearn before batch_metrics.
+    return {
+        "MAPE": mean_absolute_percentage_error(y_true, y_pred) * 100,
+        "RMSE": np.sqrt(mean_squared_error(y_true, y_pred)),
+        "R2": r2_score(y_true, y_pred),
+    }
+
+
+def test_batch_metrics_matches_per_series_metrics():
+    rng = np.random.default_rng(0)
+    y_true = rng.uniform(10, 100, size=(5, 12))
+    y_pred = y_true + rng.normal(0, 5, size=y_true.shape)
+    scores = batch_metrics(y_true, y_pred)
+    for row in range(len(y_true)):
+        expected = _reference(y_true[row], y_pred[row])
+        for name, value in expected.items():
+            assert np.isclose(scores[name][row], value), name
+
+
+def test_batch_metrics_skips_padding():
+    rng = np.random.default_rng(1)
+    short_true, short_pred = rng.uniform(10, 100, 7), rng.uniform(10, 100, 7)
+    y_true = np.full((1, 12), np.nan)
+    y_pred = np.full((1, 12), np.nan)
+    y_true[0, :7], y_pred[0, :7] = short_true, short_pred
+    scores = batch_metrics(y_true, y_pred)
+    for name, value in _reference(short_true, short_pred).items():
+        assert np.isclose(scores[name][0], value), name
+
+
+def test_calculate_metrics_aligns_series():
+    index = pd.date_range("2023-01-01", periods=12, freq="MS")
+    y_true = pd.Series(np.arange(1, 13, dtype=float) * 10, index=index)
+    y_pred = pd.Series(np.arange(1, 13, dtype=float) * 9, index=index)[3:]
+    metrics = calculate_metrics(y_true, y_pred)
+    expected = _reference(y_true[3:], y_pred)
+    assert metrics.keys() == expected.keys()
+    for name, value in expected.items():
+        assert np.isclose(metrics[name], value), name
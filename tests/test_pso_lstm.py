@@ -0,0 +1,27 @@
+import numpy as np
+
+from pso_lstm import cached_windows
+
+
+def _loop_windows(series, n_steps):
+    # The windows prepare_data built with a Python loop before it returned strided views.
+    X, y = [], []
+    for i in range(len(series) - n_steps):
+        X.append(series[i:i + n_steps])
+        y.append(series[i + n_steps])
+    return np.array(X), np.array(y)
+
+
+def test_cached_windows_match_loop():
+    series = np.random.default_rng(0).random(40)
+    for n_steps in (1, 5, 12, 39):
+        X, y = cached_windows(series, n_steps)
+        expected_X, expected_y = _loop_windows(series, n_steps)
+        assert X.shape == (len(series) - n_steps, n_steps, 1)
+        np.testing.assert_array_equal(X[..., 0], expected_X)
+        np.testing.assert_array_equal(y, expected_y)
+
+
+def test_cached_windows_short_series():
+    X, y = cached_windows(np.arange(5, dtype=float), 5)
+    assert X.shape == (0, 5, 1) and y.shape == (0,)
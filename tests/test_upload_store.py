@@ -0,0 +1,51 @@
+import io
+import os
+
+import pytest
+
+from upload_store import UploadStore
+
+
+def _save(store, content, username="alice"):
+    return store.save(io.BytesIO(content), "sales.csv", username=username)
+
+
+def _append(path, content):
+    with open(path, "ab") as f:
+        f.write(content)
+
+
+def test_commit_replaces_content(tmp_path):
+    store = UploadStore(root=str(tmp_path))
+    _save(store, b"a,b\n1,2\n")
+    work_path, base = store.checkout("sales.csv")
+    _append(work_path, b"3,4\n")
+    digest, blob = store.commit("sales.csv", work_path, base, "bob")
+    entry = store.entries()["sales.csv"]
+    assert entry["sha256"] == digest and entry["username"] == "bob"
+    with open(blob, "rb") as f:
+        assert f.read() == b"a,b\n1,2\n3,4\n"
+
+
+def test_commit_after_concurrent_commit_fails(tmp_path):
+    store = UploadStore(root=str(tmp_path))
+    _save(store, b"a,b\n1,2\n")
+    first, base = store.checkout("sales.csv")
+    second, _ = store.checkout("sales.csv")
+    _append(first, b"3,4\n")
+    _append(second, b"5,6\n")
+    digest, _ = store.commit("sales.csv", first, base)
+    with pytest.raises(ValueError):
+        store.commit("sales.csv", second, base)
+    assert not os.path.exists(second)
+    assert store.entries()["sales.csv"]["sha256"] == digest
+
+
+def test_commit_after_save_fails(tmp_path):
+    store = UploadStore(root=str(tmp_path))
+    _save(store, b"a,b\n1,2\n")
+    work_path, base = store.checkout("sales.csv")
+    digest, _, _ = _save(store, b"a,b\n7,8\n")
+    with pytest.raises(ValueError):
+        store.commit("sales.csv", work_path, base)
+    assert store.entries()["sales.csv"]["sha256"] == digest
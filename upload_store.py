@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from ingest import copy_cache, move_cache, remove_cache
+from registry import file_hash
+
+UPLOAD_FOLDER = "uploads"
+BLOB_FOLDER = "blobs"
+INDEX_FILE = "names.json"
+LOCK_FILE = ".names.lock"
+CHUNK_BYTES = 1024 * 1024
+# Content no name points to any more is kept this long, for jobs still reading it.
+RELEASE_GRACE_SECONDS = float(os.environ.get("UPLOAD_RELEASE_GRACE_HOURS", "24")) * 60 * 60
+
+
+class UploadStore:
+    """Uploaded CSVs stored once per distinct content as blobs/<sha256>.csv, with the user-visible
+    names mapped to hashes in names.json. Blobs are never modified in place, so a blob path doubles
+    as a content key: the columnar cache and the model registry are shared by identical uploads."""
+
+    def __init__(self, root=UPLOAD_FOLDER, release_grace_seconds=RELEASE_GRACE_SECONDS):
+        self.root = root
+        self.blobs = os.path.join(root, BLOB_FOLDER)
+        self.release_grace_seconds = release_grace_seconds
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs, f"{digest}.csv")
+
+    @contextmanager
+    def _locked(self):
+        # The index is shared by every web and job worker process.
+        os.makedirs(self.blobs, exist_ok=True)
+        with open(os.path.join(self.root, LOCK_FILE), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self._load()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.root, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {"names": {}, "released": {}}
+        if self._adopt_loose_files(index):
+            self._save(index)
+        return index
+
+    def _save(self, index):
+        tmp_path = os.path.join(self.root, f".{INDEX_FILE}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.root, INDEX_FILE))
+
+    def _adopt_loose_files(self, index):
+        """Moves plain files in the upload folder, saved before the store existed or restored from an
+        old backup, into the store under their file names."""
+        adopted = False
+        for entry in os.scandir(self.root):
+            if not entry.is_file() or entry.name.startswith(".") or entry.name == INDEX_FILE:
+                continue
+            digest = file_hash(entry.path)
+            stat = entry.stat()
+            self._add_blob(entry.path, digest)
+            self._assign(index, entry.name, digest, stat.st_size, None, uploaded_at=stat.st_mtime)
+            adopted = True
+        return adopted
+
+    def _add_blob(self, path, digest):
+        """Moves path, with its columnar cache, into the store, or drops it if the content is already stored."""
+        target = self.blob_path(digest)
+        if os.path.exists(target):
+            os.remove(path)
+            remove_cache(path)
+            return False
+        move_cache(path, target)
+        os.replace(path, target)
+        return True
+
+    def _assign(self, index, name, digest, size, username, uploaded_at=None):
+        previous = index["names"].get(name, {}).get("sha256")
+        index["names"][name] = {
+            "sha256": digest, "size": size, "username": username, "uploaded_at": uploaded_at or time.time(),
+        }
+        index["released"].pop(digest, None)
+        if previous and previous != digest and all(entry["sha256"] != previous for entry in index["names"].values()):
+            index["released"][previous] = time.time()
+        self._prune(index)
+
+    def _prune(self, index):
+        for digest, released_at in list(index["released"].items()):
+            if time.time() - released_at >= self.release_grace_seconds:
+                blob = self.blob_path(digest)
+                remove_cache(blob)
+                if os.path.exists(blob):
+                    os.remove(blob)
+                del index["released"][digest]
+
+    # --- Names ---
+    def entries(self):
+        """Every stored name with its hash, size, uploader and upload time."""
+        with self._locked() as index:
+            return index["names"]
+
+    def resolve(self, name):
+        """Path of the blob a name points to, or None."""
+        entry = self.entries().get(os.path.basename(name))
+        return self.blob_path(entry["sha256"]) if entry else None
+
+    def save(self, stream, name, username=None, chunk_size=CHUNK_BYTES):
+        """Streams an upload into the store, hashing it on the way. Returns (sha256, blob path, whether
+        the content was new); a name uploaded again only changes which blob it points to."""
+        name = os.path.basename(name)
+        os.makedirs(self.blobs, exist_ok=True)
+        tmp_path = os.path.join(self.blobs, f".upload-{uuid.uuid4().hex}.tmp")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: stream.read(chunk_size), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self._locked() as index:
+            new = self._add_blob(tmp_path, digest.hexdigest())
+            self._assign(index, name, digest.hexdigest(), size, username)
+            self._save(index)
+        return digest.hexdigest(), self.blob_path(digest.hexdigest()), new
+
+    # --- Updates ---
+    def checkout(self, name):
+        """Copies a name's blob, and its columnar cache, to a private working file that may be modified.
+        Returns (working path, sha256 of the checked-out content)."""
+        entry = self.entries().get(name)
+        if entry is None:
+            raise FileNotFoundError(f"No upload named {name}")
+        blob = self.blob_path(entry["sha256"])
+        work_path = os.path.join(self.blobs, f".work-{uuid.uuid4().hex}.csv")
+        shutil.copy2(blob, work_path)
+        copy_cache(blob, work_path)
+        return work_path, entry["sha256"]
+
+    def commit(self, name, work_path, base_digest, username=None):
+        """Stores a modified working file as the new content of name. Fails, discarding the working
+        file, if name was pointed elsewhere since it was checked out. Returns (sha256, blob path)."""
+        digest = file_hash(work_path)
+        with self._locked() as index:
+            if index["names"].get(name, {}).get("sha256") != base_digest:
+                self.discard(work_path)
+                raise ValueError(f"{name} was changed by another upload; please try again.")
+            self._add_blob(work_path, digest)
+            self._assign(index, name, digest, os.path.getsize(self.blob_path(digest)), username)
+            self._save(index)
+        return digest, self.blob_path(digest)
+
+    def discard(self, work_path):
+        remove_cache(work_path)
+        if os.path.exists(work_path):
+            os.remove(work_path)
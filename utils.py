@@ -1,10 +1,57 @@
+import os
+
 import numpy as np
-from sklearn.metrics import mean_squared_error, r2_score, mean_absolute_percentage_error
+
+# Each of the JOB_WORKERS job processes (see jobs) may run a forecast at once, so the pools a job
+# starts split the cores between them instead of each starting a full-width pool.
+JOB_CORES = max(1, (os.cpu_count() or 1) // int(os.environ.get("JOB_WORKERS", "1")))
+METRICS = ("MAPE", "RMSE", "R2", "sMAPE", "MASE")
+
+
+def batch_metrics(y_true, y_pred, mask=None, train=None, season=1):
+    """Forecast metrics for a batch of series at once. y_true and y_pred are (series, horizon) arrays
+    (a 1-D pair is one series); a point counts when mask is True there, if given, and both values are
+    finite, so ragged series are NaN-padded. Returns {metric: array with one value per series}.
+
+    MAPE skips zero actuals, which have no percentage error, and sMAPE counts a point where actual and
+    forecast are both zero as exact. MASE divides the mean absolute error by that of the season-step
+    naive forecast on train (an array of the same series' history), or on y_true when train is None.
+    A metric with nothing to average over is NaN, as is R2 for fewer than two points."""
+    y_true = np.atleast_2d(np.asarray(y_true, dtype="float64"))
+    y_pred = np.atleast_2d(np.asarray(y_pred, dtype="float64"))
+    valid = np.isfinite(y_true) & np.isfinite(y_pred)
+    if mask is not None:
+        valid &= np.atleast_2d(np.asarray(mask, dtype=bool))
+    actual = np.where(valid, y_true, 0.0)
+    abs_error = np.abs(np.where(valid, y_true - y_pred, 0.0))
+    n = valid.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nonzero = valid & (actual != 0)
+        mape = (abs_error / np.where(nonzero, np.abs(actual), 1.0) * nonzero).sum(axis=1) / nonzero.sum(axis=1) * 100
+
+        sq_error = (abs_error ** 2).sum(axis=1)
+        rmse = np.sqrt(sq_error / n)
+
+        mean = actual.sum(axis=1) / n
+        ss_tot = (np.where(valid, actual - mean[:, np.newaxis], 0.0) ** 2).sum(axis=1)
+        # A constant actual series scores 1 when matched exactly and 0 otherwise, as sklearn's r2_score.
+        r2 = np.where(ss_tot > 0, 1 - sq_error / np.where(ss_tot > 0, ss_tot, 1.0), np.where(sq_error == 0, 1.0, 0.0))
+        r2 = np.where(n >= 2, r2, np.nan)
+
+        scale = np.abs(actual) + np.abs(np.where(valid, y_pred, 0.0))
+        smape = (2 * abs_error / np.where(scale > 0, scale, 1.0)).sum(axis=1) / n * 100
+
+        history = np.where(valid, y_true, np.nan) if train is None else np.atleast_2d(np.asarray(train, dtype="float64"))
+        naive = np.abs(history[:, season:] - history[:, :-season])
+        naive_valid = np.isfinite(naive)
+        naive_mae = np.where(naive_valid, naive, 0.0).sum(axis=1) / naive_valid.sum(axis=1)
+        mase = np.where(naive_mae > 0, abs_error.sum(axis=1) / n / np.where(naive_mae > 0, naive_mae, 1.0), np.nan)
+
+    return {"MAPE": mape, "RMSE": rmse, "R2": r2, "sMAPE": smape, "MASE": mase}
+
 
 def calculate_metrics(y_true, y_pred):
     y_true, y_pred = y_true.align(y_pred, join='inner')
-    return {
-        "MAPE": mean_absolute_percentage_error(y_true, y_pred) * 100,
-        "RMSE": np.sqrt(mean_squared_error(y_true, y_pred)),
-        "R2": r2_score(y_true, y_pred)
-    }
+    metrics = batch_metrics(y_true.to_numpy("float64"), y_pred.to_numpy("float64"))
+    return {name: float(metrics[name][0]) for name in ("MAPE", "RMSE", "R2")}